@@ -1,7 +1,3 @@
-import speech_recognition as sr
-from gtts import gTTS
-from pydub import AudioSegment
-from pydub.playback import play
 import os
 import subprocess
 import threading
@@ -11,11 +7,78 @@ import importlib.util
 import sys
 import logging
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
 import re
 import datetime
 import time
 import socket
+import io
+import hashlib
+import math
+import itertools
+import heapq
+import sqlite3
+import copy
+import array
+import unicodedata
+import ast
+import tracemalloc
+from collections import deque
+from collections import OrderedDict
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 from dotenv import load_dotenv
+from gemini_backend import (
+    GeminiBackendError,
+    GeminiBackend,
+    CliGeminiBackend,
+    SubprocessGeminiBackend,
+    DirectGeminiBackend,
+    StubGeminiBackend,
+    create_gemini_backend
+)
+
+# --- Importaciones diferidas ---
+
+class _DeferredImport:
+    """Módulo (o atributo de un módulo) que se importa la primera vez que se usa.
+
+    speech_recognition, gTTS y pydub tardan en importarse y no hacen falta hasta
+    abrir el micrófono o hablar, así que se importan dentro de las fases de
+    arranque en paralelo en vez de al cargar este módulo.
+    """
+
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            self._target = getattr(target, self._attribute) if self._attribute else target
+        return self._target
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+sr = _DeferredImport("speech_recognition")
+gTTS = _DeferredImport("gtts", "gTTS")
+AudioSegment = _DeferredImport("pydub", "AudioSegment")
+play = _DeferredImport("pydub.playback", "play")
+make_chunks = _DeferredImport("pydub.utils", "make_chunks")
+
+def preload_deferred_imports():
+    """Importa en segundo plano lo que se necesita para la primera respuesta hablada."""
+    for deferred in (gTTS, AudioSegment, play, make_chunks):
+        deferred.load()
 
 # --- Bloqueo de instancia única ---
 LOCK_FILE = os.path.join(os.path.dirname(__file__), ".assistant_lock")
@@ -55,18 +118,78 @@ if not logger.handlers:
 def _load_config():
     config = {
         "USER_DATA_FILE": os.getenv("USER_DATA_FILE", os.path.join(os.path.dirname(__file__), "user_data.json")),
+        "USER_DATA_DB": os.getenv("USER_DATA_DB", os.path.join(os.path.dirname(__file__), "user_data.db")),
         "CUSTOM_COMMANDS_FILE": os.getenv("CUSTOM_COMMANDS_FILE", os.path.join(os.path.dirname(__file__), "custom_commands.json")),
         "HA_URL": os.getenv("HA_URL", "http://localhost:8123"),
         "HA_TOKEN": os.getenv("HA_TOKEN"),
         "MCP_GITHUB_SERVER_URL": os.getenv("MCP_GITHUB_SERVER_URL", "http://localhost:8080"),
         "GITHUB_PAT": os.getenv("GITHUB_PAT"),
+        "MCP_BATCH_WINDOW": float(os.getenv("MCP_BATCH_WINDOW", 0.01)),
+        "HA_BATCH_WINDOW": float(os.getenv("HA_BATCH_WINDOW", 0.05)),
+        "HA_STATE_CACHE": os.getenv("HA_STATE_CACHE", "true").lower() == "true",
+        "HA_STATE_MAX_AGE": float(os.getenv("HA_STATE_MAX_AGE", 300)),
+        "RESPONSE_CACHE_ENABLED": os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true",
+        "RESPONSE_CACHE_TTLS": json.loads(os.getenv("RESPONSE_CACHE_TTLS", "{}")),
+        "HTTP_CONNECT_TIMEOUT": float(os.getenv("HTTP_CONNECT_TIMEOUT", 3.05)),
+        "HTTP_READ_TIMEOUT": float(os.getenv("HTTP_READ_TIMEOUT", 10)),
+        "HTTP_RETRIES": int(os.getenv("HTTP_RETRIES", 2)),
+        "HTTP_RETRY_BACKOFF": float(os.getenv("HTTP_RETRY_BACKOFF", 0.3)),
+        "HTTP_POOL_SIZE": int(os.getenv("HTTP_POOL_SIZE", 4)),
         "SPEECH_RECOGNITION_PAUSE_THRESHOLD": float(os.getenv("SPEECH_RECOGNITION_PAUSE_THRESHOLD", 0.8)),
         "SPEECH_RECOGNITION_PHRASE_TIME_LIMIT": int(os.getenv("SPEECH_RECOGNITION_PHRASE_TIME_LIMIT", 8)),
         "SPEECH_RECOGNITION_TIMEOUT": int(os.getenv("SPEECH_RECOGNITION_TIMEOUT", 10)),
         "SPEECH_RECOGNITION_LANGUAGE": os.getenv("SPEECH_RECOGNITION_LANGUAGE", "es-ES"),
+        "AUDIO_CAPTURE_MODE": os.getenv("AUDIO_CAPTURE_MODE", "continuous"),
+        "AUDIO_PRE_ROLL_SECONDS": float(os.getenv("AUDIO_PRE_ROLL_SECONDS", 0.5)),
+        "AUDIO_MIN_PHRASE_SECONDS": float(os.getenv("AUDIO_MIN_PHRASE_SECONDS", 0.3)),
+        "ADAPTIVE_NOISE": os.getenv("ADAPTIVE_NOISE", "true").lower() == "true",
+        "NOISE_FLOOR_TIME_CONSTANT": float(os.getenv("NOISE_FLOOR_TIME_CONSTANT", 5.0)),
+        "NOISE_THRESHOLD_FACTOR": float(os.getenv("NOISE_THRESHOLD_FACTOR", 3.0)),
+        "NOISE_THRESHOLD_HYSTERESIS": float(os.getenv("NOISE_THRESHOLD_HYSTERESIS", 0.2)),
+        "NOISE_THRESHOLD_MIN": float(os.getenv("NOISE_THRESHOLD_MIN", 100)),
+        "NOISE_THRESHOLD_MAX": float(os.getenv("NOISE_THRESHOLD_MAX", 4000)),
+        "NOISE_WARMUP_SECONDS": float(os.getenv("NOISE_WARMUP_SECONDS", 0.5)),
+        "PIPELINE_QUEUE_SIZE": int(os.getenv("PIPELINE_QUEUE_SIZE", 4)),
+        "BARGE_IN_ENABLED": os.getenv("BARGE_IN_ENABLED", "true").lower() == "true",
+        "BARGE_IN_ENERGY_FACTOR": float(os.getenv("BARGE_IN_ENERGY_FACTOR", 3.0)),
+        "BARGE_IN_MIN_SECONDS": float(os.getenv("BARGE_IN_MIN_SECONDS", 0.3)),
+        "STT_ENGINE": os.getenv("STT_ENGINE", "google"),
+        "STT_MIN_CONFIDENCE": float(os.getenv("STT_MIN_CONFIDENCE", 0.6)),
+        "VOSK_MODEL_PATH": os.getenv("VOSK_MODEL_PATH", os.path.join(os.path.dirname(__file__), "models", "vosk-model-small-es")),
+        "WAKE_WORD_ENABLED": os.getenv("WAKE_WORD_ENABLED", "false").lower() == "true",
+        "WAKE_WORD_PHRASES": [phrase.strip() for phrase in os.getenv("WAKE_WORD_PHRASES", "oye asistente").split(",") if phrase.strip()],
+        "WAKE_WORD_WINDOW_SECONDS": float(os.getenv("WAKE_WORD_WINDOW_SECONDS", 8)),
         "TTS_LANGUAGE": os.getenv("TTS_LANGUAGE", "es"),
-        "MAX_HISTORY_LENGTH": int(os.getenv("MAX_HISTORY_LENGTH", 10)),
-        "PLUGINS_DIR": os.getenv("PLUGINS_DIR", os.path.join(os.path.dirname(__file__), "plugins"))
+        "TTS_MIN_CHUNK_CHARS": int(os.getenv("TTS_MIN_CHUNK_CHARS", 20)),
+        "TTS_MAX_CHUNK_CHARS": int(os.getenv("TTS_MAX_CHUNK_CHARS", 200)),
+        "TTS_PREFETCH_CHUNKS": int(os.getenv("TTS_PREFETCH_CHUNKS", 1)),
+        "TTS_CACHE_DIR": os.getenv("TTS_CACHE_DIR", os.path.join(os.path.dirname(__file__), "tts_cache")),
+        "TTS_CACHE_MAX_MB": float(os.getenv("TTS_CACHE_MAX_MB", 50)),
+        "SCHEDULER_STATE_FILE": os.getenv("SCHEDULER_STATE_FILE", os.path.join(os.path.dirname(__file__), "scheduler_state.json")),
+        "SCHEDULER_CATCH_UP_HOURS": float(os.getenv("SCHEDULER_CATCH_UP_HOURS", 12)),
+        "TIMED_ACTION_WORKERS": int(os.getenv("TIMED_ACTION_WORKERS", 4)),
+        "TIMED_ACTION_TIMEOUT": float(os.getenv("TIMED_ACTION_TIMEOUT", 30)),
+        "HISTORY_MAX_TOKENS": int(os.getenv("HISTORY_MAX_TOKENS", 2000)),
+        "HISTORY_SUMMARY_MAX_TOKENS": int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", 300)),
+        "HISTORY_SUMMARIZE": os.getenv("HISTORY_SUMMARIZE", "true").lower() == "true",
+        "GEMINI_CACHE_ENABLED": os.getenv("GEMINI_CACHE_ENABLED", "true").lower() == "true",
+        "GEMINI_CACHE_DB": os.getenv("GEMINI_CACHE_DB", os.path.join(os.path.dirname(__file__), "gemini_cache.db")),
+        "GEMINI_CACHE_TTL": float(os.getenv("GEMINI_CACHE_TTL", 7 * 24 * 3600)),
+        "GEMINI_CACHE_THRESHOLD": float(os.getenv("GEMINI_CACHE_THRESHOLD", 0.85)),
+        "GEMINI_CACHE_MAX_ENTRIES": int(os.getenv("GEMINI_CACHE_MAX_ENTRIES", 500)),
+        "GEMINI_CACHE_EXCLUDE": [word.strip() for word in os.getenv("GEMINI_CACHE_EXCLUDE", "").split(",") if word.strip()],
+        "GEMINI_BACKEND": os.getenv("GEMINI_BACKEND", "cli"),
+        "GEMINI_WORKER_TIMEOUT": float(os.getenv("GEMINI_WORKER_TIMEOUT", 60)),
+        "GEMINI_MODEL": os.getenv("GEMINI_MODEL", "gemini-1.5-flash"),
+        "GEMINI_STREAMING": os.getenv("GEMINI_STREAMING", "true").lower() == "true",
+        "GEMINI_API_KEY": os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY"),
+        "PLUGINS_DIR": os.getenv("PLUGINS_DIR", os.path.join(os.path.dirname(__file__), "plugins")),
+        "PLUGINS_LAZY": os.getenv("PLUGINS_LAZY", "true").lower() == "true",
+        "PLUGINS_PROFILE_MEMORY": os.getenv("PLUGINS_PROFILE_MEMORY", "false").lower() == "true",
+        "HOT_RELOAD": os.getenv("HOT_RELOAD", "true").lower() == "true",
+        "HOT_RELOAD_INTERVAL": float(os.getenv("HOT_RELOAD_INTERVAL", 1.0)),
+        "AMBIENT_NOISE_SECONDS": float(os.getenv("AMBIENT_NOISE_SECONDS", 2)),
+        "STARTUP_WORKERS": int(os.getenv("STARTUP_WORKERS", 6))
     }
     return config
 
@@ -87,9 +210,9 @@ def check_internet_connection(hostname="8.8.8.8"):
 # Cargar configuración global
 CONFIG = _load_config()
 
-# Cola para la comunicación entre el hilo de escucha y el hilo principal
-q_input = queue.Queue()
-q_output = queue.Queue()
+# Colas acotadas del pipeline: texto reconocido -> enrutado, y texto a decir -> síntesis
+q_input = queue.Queue(maxsize=CONFIG["PIPELINE_QUEUE_SIZE"])
+q_output = queue.Queue(maxsize=CONFIG["PIPELINE_QUEUE_SIZE"] * 4)
 
 # Global variable to store information about the last executed command
 last_executed_command_info = {}
@@ -113,22 +236,242 @@ ERROR_MESSAGES = {
     "general_unexpected_error": "Lo siento, ocurrió un error inesperado."
 }
 
-# --- Home Assistant Integration ---
+# --- Cliente HTTP compartido ---
+
+class HttpClient:
+    """Cliente HTTP con una requests.Session (y su pool de conexiones keep-alive) por host.
+
+    Aplica un timeout por defecto a todas las peticiones y reintenta con backoff
+    exponencial los fallos de conexión y las respuestas 502/503/504. Los POST solo
+    se reintentan si la conexión no llegó a establecerse, para no repetir acciones.
+    Se usa igual que el módulo requests: get(), post() y request().
+    """
+
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, timeout=(3.05, 10), retries=2, backoff_factor=0.3, pool_size=4):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._host_headers = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _host_key(url):
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def set_host_headers(self, base_url, headers):
+        """Cabeceras fijas (p. ej. Authorization) que se envían en todas las peticiones a un host."""
+        key = self._host_key(base_url)
+        with self._lock:
+            self._host_headers[key] = dict(headers)
+            session = self._sessions.get(key)
+            if session is not None:
+                session.headers.update(headers)
 
-def call_ha_service(domain, service, entity_id=None, data=None):
-    HA_HEADERS = {
-        "Authorization": f"Bearer {CONFIG["HA_TOKEN"]}",
+    def _create_session(self, key):
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.RETRY_STATUSES,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self._host_headers.get(key, {}))
+        return session
+
+    def session_for(self, url):
+        key = self._host_key(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._create_session(key)
+                self._sessions[key] = session
+            return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session_for(url).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def warm(self, base_url):
+        """Abre por adelantado una conexión con el host para que la primera petición no pague el TCP/TLS."""
+        try:
+            self.request("HEAD", base_url)
+            return True
+        except requests.exceptions.RequestException as e:
+            logging.debug(f"No se pudo precalentar la conexión con {base_url}: {e}")
+            return False
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+def create_http_client(config):
+    client = HttpClient(
+        timeout=(config["HTTP_CONNECT_TIMEOUT"], config["HTTP_READ_TIMEOUT"]),
+        retries=config["HTTP_RETRIES"],
+        backoff_factor=config["HTTP_RETRY_BACKOFF"],
+        pool_size=config["HTTP_POOL_SIZE"]
+    )
+    client.set_host_headers(config["HA_URL"], {
+        "Authorization": f"Bearer {config["HA_TOKEN"]}",
         "Content-Type": "application/json",
-    }
+    })
+    client.set_host_headers(config["MCP_GITHUB_SERVER_URL"], {
+        "Authorization": f"Bearer {config["GITHUB_PAT"]}", # Usar PAT para autenticación
+        "Content-Type": "application/json",
+    })
+    return client
+
+http_client = create_http_client(CONFIG)
+# --- Fin Cliente HTTP compartido ---
+
+# --- Caché de respuestas de consultas ---
+
+# Segundos que se reutiliza la respuesta de cada método de solo lectura.
+# Los métodos que no aparecen aquí no se cachean y se tratan como escrituras.
+DEFAULT_RESPONSE_CACHE_TTLS = {
+    "github.pull_requests.list": 60,
+    "github.issues.list": 60,
+    "calendar.events.list": 120,
+    "weather.current": 600,
+}
+
+class ResponseCache:
+    """Caché read-through con caducidad por método para consultas a MCP y APIs externas.
+
+    Las entradas se indexan por (método, params). Si varias peticiones piden a
+    la vez la misma clave solo una va a la red y las demás esperan su resultado
+    (single-flight); los errores no se guardan. Una escritura invalida las
+    entradas de su espacio de nombres (github.issues.create invalida
+    github.issues.*) o las que indique invalidation_rules.
+    """
+
+    def __init__(self, ttls, invalidation_rules=None, max_entries=256):
+        self.ttls = dict(ttls)
+        self.invalidation_rules = dict(invalidation_rules or {})
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(method, params):
+        return method, json.dumps(params if params is not None else {}, sort_keys=True, default=str)
+
+    def is_cacheable(self, method):
+        return self.ttls.get(method, 0) > 0
+
+    def peek(self, method, params=None):
+        """Devuelve (True, valor) si hay una respuesta vigente, o (False, None)."""
+        key = self._key(method, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            value, expires_at = entry
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def store(self, method, params, value):
+        if not self.is_cacheable(method):
+            return
+        key = self._key(method, params)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttls[method])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_fetch(self, method, params, fetch):
+        """Devuelve la respuesta cacheada o llama a fetch() (una sola vez por clave a la vez)."""
+        if not self.is_cacheable(method):
+            result = fetch()
+            self.invalidate_after_write(method)
+            return result
+        hit, value = self.peek(method, params)
+        if hit:
+            logging.debug(f"Respuesta en caché para {method}")
+            return value
+        key = self._key(method, params)
+        with self._lock:
+            future = self._in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self._in_flight[key] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = fetch()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.store(method, params, value)
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def invalidate(self, prefix):
+        """Elimina las entradas cuyo método es prefix o empieza por "prefix."."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == prefix or key[0].startswith(prefix + ".")]:
+                del self._entries[key]
+
+    def invalidate_after_write(self, method):
+        prefixes = self.invalidation_rules.get(method)
+        if prefixes is None:
+            prefixes = [method.rsplit(".", 1)[0]] if "." in method else []
+        for prefix in prefixes:
+            self.invalidate(prefix)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+def create_response_cache(config):
+    if not config["RESPONSE_CACHE_ENABLED"]:
+        return ResponseCache({})
+    return ResponseCache({**DEFAULT_RESPONSE_CACHE_TTLS, **config["RESPONSE_CACHE_TTLS"]})
+
+response_cache = create_response_cache(CONFIG)
+# --- Fin Caché de respuestas de consultas ---
+
+# --- Home Assistant Integration ---
+
+def call_ha_service(domain, service, entity_id=None, data=None, area_id=None):
+    """Llama a un servicio de HA. entity_id y area_id aceptan un valor, una lista o "all"."""
     url = f"{CONFIG["HA_URL"]}/api/services/{domain}/{service}"
     payload = {}
     if entity_id:
         payload["entity_id"] = entity_id
+    if area_id:
+        payload["area_id"] = area_id
     if data:
         payload.update(data)
 
     try:
-        response = requests.post(url, headers=HA_HEADERS, json=payload)
+        response = http_client.post(url, json=payload)
         response.raise_for_status()
         logging.info(f"Llamada a HA exitosa: {domain}.{service} para {entity_id}")
         return True
@@ -137,433 +480,2785 @@ def call_ha_service(domain, service, entity_id=None, data=None):
         hablar(ERROR_MESSAGES["ha_service_failed"])
         return False
 
+def _extend_targets(targets, value):
+    """Añade uno o varios destinos (entity_id/area_id) sin repetir; "all" absorbe al resto."""
+    if not value:
+        return
+    for target in (value if isinstance(value, (list, tuple)) else [value]):
+        if "all" in targets:
+            return
+        if target == "all":
+            targets[:] = ["all"]
+            return
+        if target not in targets:
+            targets.append(target)
+
+class HAServiceBatcher:
+    """Agrupa las llamadas a servicios de HA emitidas dentro de una ventana corta.
+
+    Las llamadas con el mismo (domain, service, data) se envían en una sola
+    petición con la lista de entity_id/area_id de todas ellas. submit() devuelve
+    un Future que se resuelve con True/False cuando se envía su grupo.
+    """
+
+    def __init__(self, send, window=0.05):
+        self.send = send
+        self.window = window
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def submit(self, domain, service, entity_id=None, data=None, area_id=None):
+        future = Future()
+        data = dict(data or {})
+        # Las llamadas sin destino no se mezclan con las que sí lo tienen
+        has_target = bool(entity_id or area_id)
+        key = (domain, service, json.dumps(data, sort_keys=True), has_target)
+        with self._lock:
+            batch = self._pending.get(key)
+            if batch is None:
+                batch = self._pending[key] = {"domain": domain, "service": service, "data": data, "entity_ids": [], "area_ids": [], "futures": []}
+            _extend_targets(batch["entity_ids"], entity_id)
+            _extend_targets(batch["area_ids"], area_id)
+            batch["futures"].append(future)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def flush(self):
+        """Envía ya todos los grupos pendientes."""
+        with self._lock:
+            batches = list(self._pending.values())
+            self._pending.clear()
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        for batch in batches:
+            try:
+                success = self.send(batch["domain"], batch["service"], batch["entity_ids"] or None, batch["data"] or None, batch["area_ids"] or None)
+            except Exception as e:
+                logging.error(f"Error al enviar el lote de HA {batch['domain']}.{batch['service']}: {e}")
+                success = False
+            for future in batch["futures"]:
+                future.set_result(success)
+
+def _send_ha_service(domain, service, entity_id=None, data=None, area_id=None):
+    # Se resuelve en cada envío para que los tests puedan sustituir call_ha_service
+    return call_ha_service(domain, service, entity_id, data, area_id)
+
+ha_service_batcher = HAServiceBatcher(_send_ha_service, CONFIG["HA_BATCH_WINDOW"])
+
+def call_ha_services(calls):
+    """Ejecuta varias llamadas a servicios de HA con una petición por (domain, service, data).
+
+    calls es una lista de diccionarios con domain, service y opcionalmente
+    entity_id, area_id y data. Devuelve True si todas tuvieron éxito.
+    """
+    futures = [
+        ha_service_batcher.submit(call.get("domain"), call.get("service"), call.get("entity_id"), call.get("data"), call.get("area_id"))
+        for call in calls
+    ]
+    ha_service_batcher.flush()
+    return all(future.result() for future in futures)
+
 def get_ha_state(entity_id):
-    HA_HEADERS = {
-        "Authorization": f"Bearer {CONFIG["HA_TOKEN"]}",
-        "Content-Type": "application/json",
-    }
+    cache = ha_state_cache
+    if cache is not None:
+        state_data = cache.get(entity_id)
+        if state_data is not None:
+            logging.debug(f"Estado de HA en caché para {entity_id}: {state_data.get('state')}")
+            return state_data
+
     url = f"{CONFIG["HA_URL"]}/api/states/{entity_id}"
     try:
-        response = requests.get(url, headers=HA_HEADERS)
+        response = http_client.get(url)
         response.raise_for_status()
         state_data = response.json()
         logging.info(f"Estado de HA obtenido para {entity_id}: {state_data.get('state')}")
+        if cache is not None:
+            cache.update(entity_id, state_data)
         return state_data
     except requests.exceptions.RequestException as e:
         logging.error(f"Error al obtener el estado de Home Assistant para {entity_id}: {e}")
         hablar(ERROR_MESSAGES["ha_state_failed"])
         return None
+
+class HAStateCache:
+    """Mapa en memoria entity_id -> estado de Home Assistant.
+
+    Se carga con una sola petición a /api/states y luego se mantiene al día en
+    un hilo suscrito a los eventos state_changed de la API websocket de HA.
+    Mientras la suscripción está viva (se comprueba con ping cada
+    ping_interval segundos) el mapa se considera actual; si se cae, cada
+    entrada solo vale durante max_age segundos desde que se recibió y después
+    get() devuelve None para que se consulte por REST. Requiere el paquete
+    websocket-client; sin él funciona como caché con caducidad de las
+    respuestas REST.
+    """
+
+    def __init__(self, base_url, token, client, max_age=300, ping_interval=30, ws_connect=None):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.client = client
+        self.max_age = max_age
+        self.ping_interval = ping_interval
+        self.ws_connect = ws_connect
+        self.connected = False
+        self._states = {}
+        self._last_sync = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._message_ids = None
+        self._timeout_errors = (TimeoutError, socket.timeout)
+
+    @property
+    def websocket_url(self):
+        parts = urlsplit(self.base_url)
+        scheme = "wss" if parts.scheme == "https" else "ws"
+        return f"{scheme}://{parts.netloc}{parts.path}/api/websocket"
+
+    def get(self, entity_id):
+        """Devuelve el estado en memoria, o None si no se conoce o está caducado."""
+        with self._lock:
+            entry = self._states.get(entity_id)
+            if entry is None:
+                return None
+            state_data, received_at = entry
+            fresh_since = max(received_at, self._last_sync) if self.connected else received_at
+        if time.monotonic() - fresh_since > self.max_age:
+            return None
+        return state_data
+
+    def update(self, entity_id, state_data):
+        with self._lock:
+            if state_data is None:
+                self._states.pop(entity_id, None)
+            else:
+                self._states[entity_id] = (state_data, time.monotonic())
+
+    def bootstrap(self):
+        """Carga todos los estados con una única petición a /api/states."""
+        response = self.client.get(f"{self.base_url}/api/states")
+        response.raise_for_status()
+        now = time.monotonic()
+        states = {state["entity_id"]: (state, now) for state in response.json()}
+        with self._lock:
+            self._states = states
+        logging.info(f"Caché de estados de HA cargada con {len(states)} entidades.")
+
+    def start(self):
+        if self.ws_connect is None:
+            try:
+                import websocket
+            except ImportError:
+                logging.warning("websocket-client no está instalado; los estados de HA se consultarán por REST con caducidad.")
+                try:
+                    self.bootstrap()
+                except requests.exceptions.RequestException as e:
+                    logging.error(f"No se pudo cargar la caché de estados de HA: {e}")
+                return self
+            self.ws_connect = lambda url: websocket.create_connection(url, timeout=self.ping_interval)
+            self._timeout_errors += (websocket.WebSocketTimeoutException,)
+        self._thread = threading.Thread(target=self._run, name="ha-estados", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        delay = 1
+        while not self._stop.is_set():
+            ws = None
+            try:
+                ws = self.ws_connect(self.websocket_url)
+                self._subscribe(ws)
+                # La carga completa va después de suscribirse para no perder cambios intermedios
+                self.bootstrap()
+                with self._lock:
+                    self.connected = True
+                    self._last_sync = time.monotonic()
+                delay = 1
+                self._listen(ws)
+            except Exception as e:
+                logging.warning(f"Suscripción a eventos de Home Assistant interrumpida: {e}")
+            finally:
+                self.connected = False
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+            self._stop.wait(delay)
+            delay = min(delay * 2, 60)
+
+    def _subscribe(self, ws):
+        message = json.loads(ws.recv())
+        if message.get("type") == "auth_required":
+            ws.send(json.dumps({"type": "auth", "access_token": self.token}))
+            message = json.loads(ws.recv())
+        if message.get("type") != "auth_ok":
+            raise RuntimeError(f"Autenticación websocket rechazada: {message.get('message', message.get('type'))}")
+        self._message_ids = itertools.count(1)
+        ws.send(json.dumps({"id": next(self._message_ids), "type": "subscribe_events", "event_type": "state_changed"}))
+
+    def _listen(self, ws):
+        awaiting_pong = False
+        while not self._stop.is_set():
+            try:
+                raw = ws.recv()
+            except self._timeout_errors:
+                if awaiting_pong:
+                    raise RuntimeError("Home Assistant no respondió al ping.")
+                ws.send(json.dumps({"id": next(self._message_ids), "type": "ping"}))
+                awaiting_pong = True
+                continue
+            if not raw:
+                raise RuntimeError("Conexión websocket cerrada por Home Assistant.")
+            message = json.loads(raw)
+            if message.get("type") == "event":
+                data = message.get("event", {}).get("data", {})
+                if data.get("entity_id"):
+                    self.update(data["entity_id"], data.get("new_state"))
+            elif message.get("type") == "pong":
+                awaiting_pong = False
+            elif message.get("type") == "result" and not message.get("success", True):
+                raise RuntimeError(f"Home Assistant rechazó la suscripción: {message.get('error')}")
+            with self._lock:
+                self._last_sync = time.monotonic()
+
+# Caché de estados activa (la crea main() si HA_STATE_CACHE está habilitado)
+ha_state_cache = None
 # --- End Home Assistant Integration ---
 
 # --- MCP Integration ---
 
-def send_mcp_request(method, params=None):
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {CONFIG["GITHUB_PAT"]}" # Usar PAT para autenticación
-    }
-    payload = {
-        "jsonrpc": "2.0",
-        "method": method,
-        "params": params if params is not None else {},
-        "id": 1 # Un ID de solicitud, puede ser incremental
-    }
-    try:
-        response = requests.post(CONFIG["MCP_GITHUB_SERVER_URL"], headers=headers, json=payload)
+class MCPError(Exception):
+    """Error devuelto por el servidor MCP en una respuesta JSON-RPC."""
+
+    def __init__(self, error):
+        self.error = error
+        super().__init__(str(error))
+
+class MCPClient:
+    """Cliente JSON-RPC 2.0 para el servidor MCP.
+
+    Cada llamada recibe un id creciente. call() hace una petición bloqueante;
+    submit() devuelve un Future y las llamadas enviadas dentro de la misma
+    ventana (batch_window segundos) viajan juntas en un único array JSON-RPC,
+    cuyas respuestas se emparejan por id. Si el servidor no acepta lotes se
+    envían las llamadas por separado en paralelo.
+    """
+
+    def __init__(self, client, batch_window=0.01, max_workers=4):
+        self.client = client
+        self.batch_window = batch_window
+        self.supports_batch = True
+        self._ids = itertools.count(1)
+        self._pending = []
+        self._lock = threading.Lock()
+        self._timer = None
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mcp")
+
+    @property
+    def url(self):
+        return CONFIG["MCP_GITHUB_SERVER_URL"]
+
+    def _build(self, method, params):
+        return {"jsonrpc": "2.0", "method": method, "params": params if params is not None else {}, "id": next(self._ids)}
+
+    @staticmethod
+    def _unwrap(message):
+        if not isinstance(message, dict):
+            raise MCPError(f"Respuesta JSON-RPC mal formada: {message!r}")
+        if "error" in message:
+            raise MCPError(message["error"])
+        return message.get("result")
+
+    @staticmethod
+    def _decode(response):
+        """Cuerpo JSON de la respuesta; si no es JSON válido se convierte en MCPError."""
+        try:
+            return response.json()
+        except ValueError as e:
+            raise MCPError(f"Respuesta del servidor MCP que no es JSON: {e}")
+
+    def call(self, method, params=None):
+        """Envía una llamada y espera su resultado. Lanza MCPError o RequestException."""
+        response = self.client.post(self.url, json=self._build(method, params))
         response.raise_for_status()
-        result = response.json()
-        if "error" in result:
-            logging.error(f"Error en la respuesta del servidor MCP: {result['error']}")
-            hablar(ERROR_MESSAGES["mcp_request_failed"])
-            return None
+        return self._unwrap(self._decode(response))
+
+    def submit(self, method, params=None):
+        future = Future()
+        with self._lock:
+            self._pending.append((self._build(method, params), future))
+            if self._timer is None:
+                self._timer = threading.Timer(self.batch_window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+        return future
+
+    def flush(self):
+        """Envía ya las llamadas pendientes como un único lote."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        if not pending:
+            return
+        if len(pending) == 1 or not self.supports_batch:
+            for payload, future in pending:
+                self._executor.submit(self._send_single, payload, future)
+            return
+        try:
+            response = self.client.post(self.url, json=[payload for payload, _ in pending])
+            response.raise_for_status()
+            messages = self._decode(response)
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        if not isinstance(messages, list):
+            logging.warning("El servidor MCP no admite lotes JSON-RPC; se enviarán las llamadas por separado.")
+            self.supports_batch = False
+            for payload, future in pending:
+                self._executor.submit(self._send_single, payload, future)
+            return
+        try:
+            self._resolve_batch(pending, messages)
+        except Exception as e:
+            # Pase lo que pase con el lote, ninguna llamada se queda esperando
+            logging.error(f"Lote de respuestas MCP mal formado: {e}")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(MCPError(f"Lote de respuestas MCP mal formado: {e}"))
+
+    def _resolve_batch(self, pending, messages):
+        """Empareja por id las respuestas de un lote; las que faltan o no son válidas fallan con MCPError."""
+        by_id = {message["id"]: message for message in messages
+                 if isinstance(message, dict) and isinstance(message.get("id"), (int, str))}
+        for payload, future in pending:
+            message = by_id.get(payload["id"])
+            if message is None:
+                future.set_exception(MCPError(f"Sin respuesta para la llamada {payload['id']} ({payload['method']})"))
+                continue
+            try:
+                future.set_result(self._unwrap(message))
+            except MCPError as e:
+                future.set_exception(e)
+
+    def _send_single(self, payload, future):
+        try:
+            response = self.client.post(self.url, json=payload)
+            response.raise_for_status()
+            future.set_result(self._unwrap(self._decode(response)))
+        except Exception as e:
+            future.set_exception(e)
+
+    def call_many(self, calls):
+        """Ejecuta varias llamadas (method, params) en un solo viaje y devuelve sus futures en orden."""
+        futures = [self.submit(method, params) for method, params in calls]
+        self.flush()
+        return futures
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=False)
+
+mcp_client = MCPClient(http_client, CONFIG["MCP_BATCH_WINDOW"])
+
+def _mcp_result(method, get_result):
+    """Devuelve (True, resultado) o (False, None) registrando el error."""
+    try:
+        result = get_result()
         logging.info(f"Solicitud MCP exitosa para método {method}")
-        return result.get("result")
+        return True, result
+    except MCPError as e:
+        logging.error(f"Error en la respuesta del servidor MCP: {e.error}")
     except requests.exceptions.RequestException as e:
         logging.error(f"Error al enviar solicitud al servidor MCP ({CONFIG["MCP_GITHUB_SERVER_URL"]}): {e}")
+    except (ValueError, KeyError, TypeError) as e:
+        logging.error(f"Respuesta no válida del servidor MCP para el método {method}: {e}")
+    return False, None
+
+def send_mcp_request(method, params=None):
+    success, result = _mcp_result(method, lambda: response_cache.get_or_fetch(method, params, lambda: mcp_client.call(method, params)))
+    if not success:
         hablar(ERROR_MESSAGES["mcp_request_failed"])
-        return None
+    return result
+
+def send_mcp_requests(calls):
+    """Envía varias llamadas MCP (lista de (method, params)) en un único lote.
+
+    Devuelve los resultados en el mismo orden; None en las que fallaron.
+    """
+    cached = [response_cache.peek(method, params) for method, params in calls]
+    misses = [call for call, (hit, _) in zip(calls, cached) if not hit]
+    futures = iter(mcp_client.call_many(misses) if misses else [])
+    outcomes = []
+    for (method, params), (hit, value) in zip(calls, cached):
+        if hit:
+            outcomes.append((True, value))
+            continue
+        success, result = _mcp_result(method, next(futures).result)
+        if success:
+            response_cache.store(method, params, result)
+            if not response_cache.is_cacheable(method):
+                response_cache.invalidate_after_write(method)
+        outcomes.append((success, result))
+    if not all(success for success, _ in outcomes):
+        hablar(ERROR_MESSAGES["mcp_request_failed"])
+    return [result for _, result in outcomes]
 # --- End MCP Integration ---
 
-def load_user_data():
-    if os.path.exists(CONFIG["USER_DATA_FILE"]):
-        with open(CONFIG["USER_DATA_FILE"], 'r', encoding='utf-8') as f:
+# --- Almacén de datos de usuario ---
+
+class UserDataStore:
+    """Almacén clave-valor de los datos de usuario sobre SQLite en modo WAL.
+
+    Cada clave es una fila con su valor en JSON, así que get/set por clave no
+    reescriben el resto y cada escritura es una transacción atómica: un corte
+    a mitad no deja el almacén corrupto. Las lecturas salen de una copia en
+    memoria que se actualiza en cada escritura (el asistente es de instancia
+    única, nadie más escribe en la base de datos). Es seguro usarlo desde
+    varios hilos. Si existe el antiguo user_data.json y la base de datos está
+    vacía, se migra una sola vez y el archivo se renombra a .migrated.
+    """
+
+    def __init__(self, db_path, legacy_json_path=None):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS user_data (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._cache = {key: json.loads(value) for key, value in self._conn.execute("SELECT key, value FROM user_data")}
+        if not self._cache and legacy_json_path and os.path.exists(legacy_json_path):
+            self._migrate_json(legacy_json_path)
+
+    def _migrate_json(self, json_path):
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if not isinstance(data, dict):
+                raise ValueError("el contenido no es un objeto JSON")
+        except (json.JSONDecodeError, ValueError) as e:
+            # Se conserva el archivo dañado para poder recuperarlo a mano
+            logging.warning(f"Archivo de datos de usuario corrupto: {json_path} ({e}). Se guarda como {json_path}.corrupt.")
+            hablar(ERROR_MESSAGES["user_data_corrupt"])
+            os.replace(json_path, f"{json_path}.corrupt")
+            return
+        self.update(data)
+        os.replace(json_path, f"{json_path}.migrated")
+        logging.info(f"Datos de usuario migrados de {json_path} a {self.db_path} ({len(data)} claves).")
+
+    def _write(self, statements):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
             try:
-                return json.load(f)
-            except json.JSONDecodeError:
-                logging.warning(f"Archivo de datos de usuario corrupto: {CONFIG['USER_DATA_FILE']}. Se creará uno nuevo.")
-                hablar(ERROR_MESSAGES["user_data_corrupt"])
-                return {}
-    return {}
+                for sql, params in statements:
+                    self._conn.executemany(sql, params)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._cache:
+                return default
+            return copy.deepcopy(self._cache[key])
+
+    def set(self, key, value):
+        with self._lock:
+            self._write([("INSERT OR REPLACE INTO user_data (key, value) VALUES (?, ?)", [(key, json.dumps(value, ensure_ascii=False))])])
+            self._cache[key] = copy.deepcopy(value)
+
+    def delete(self, key):
+        with self._lock:
+            self._write([("DELETE FROM user_data WHERE key = ?", [(key,)])])
+            self._cache.pop(key, None)
+
+    def update(self, data):
+        """Escribe varias claves en una sola transacción."""
+        with self._lock:
+            rows = [(key, json.dumps(value, ensure_ascii=False)) for key, value in data.items()]
+            self._write([("INSERT OR REPLACE INTO user_data (key, value) VALUES (?, ?)", rows)])
+            self._cache.update(copy.deepcopy(data))
+
+    def replace_all(self, data):
+        """Sustituye todo el contenido de forma atómica."""
+        with self._lock:
+            rows = [(key, json.dumps(value, ensure_ascii=False)) for key, value in data.items()]
+            self._write([("DELETE FROM user_data", [()]), ("INSERT INTO user_data (key, value) VALUES (?, ?)", rows)])
+            self._cache = copy.deepcopy(data)
+
+    def all(self):
+        with self._lock:
+            return copy.deepcopy(self._cache)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_user_data_store = None
+_user_data_store_lock = threading.Lock()
+
+def get_user_data_store():
+    """Devuelve el almacén de datos de usuario, creándolo (y migrando el JSON) la primera vez."""
+    global _user_data_store
+    with _user_data_store_lock:
+        if _user_data_store is None or _user_data_store.db_path != CONFIG["USER_DATA_DB"]:
+            _user_data_store = UserDataStore(CONFIG["USER_DATA_DB"], CONFIG["USER_DATA_FILE"])
+        return _user_data_store
+
+def get_user_data(key, default=None):
+    return get_user_data_store().get(key, default)
+
+def set_user_data(key, value):
+    get_user_data_store().set(key, value)
+
+def load_user_data():
+    """Devuelve una copia de todos los datos de usuario (se mantiene por compatibilidad)."""
+    return get_user_data_store().all()
 
 def save_user_data(data):
-    with open(CONFIG["USER_DATA_FILE"], 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4)
+    """Sustituye todos los datos de usuario (se mantiene por compatibilidad; mejor set_user_data)."""
+    get_user_data_store().replace_all(data)
+# --- Fin Almacén de datos de usuario ---
 
 def load_custom_commands():
     if os.path.exists(CONFIG["CUSTOM_COMMANDS_FILE"]):
         with open(CONFIG["CUSTOM_COMMANDS_FILE"], 'r', encoding='utf-8') as f:
             try:
-                return json.load(f)
+                return CustomCommands(json.load(f))
             except json.JSONDecodeError:
                 logging.warning(f"Archivo de comandos personalizados corrupto: {CONFIG['CUSTOM_COMMANDS_FILE']}. Se ignorará.")
                 hablar(ERROR_MESSAGES["custom_commands_corrupt"])
-                return {}
-    return {}
+                return CustomCommands()
+    return CustomCommands()
 
-class AudioInputHandler:
-    def __init__(self, config):
-        self.recognizer = sr.Recognizer()
-        self.config = config
-        self.recognizer.pause_threshold = config["SPEECH_RECOGNITION_PAUSE_THRESHOLD"]
-        
-        # Ajustar para el ruido ambiental una sola vez al inicio
-        with sr.Microphone() as source:
-            logging.info("Ajustando para ruido ambiental... Por favor, espere.")
-            self.recognizer.adjust_for_ambient_noise(source, duration=2)
-            logging.info(f"Ajuste de ruido ambiental completo. Umbral de energía dinámico: {self.recognizer.energy_threshold:.2f}")
+# --- Enrutador de comandos personalizados ---
 
-    def escuchar(self):
-        with sr.Microphone() as source:
-            logging.info("Escuchando...")
-            try:
-                audio = self.recognizer.listen(
-                    source,
-                    phrase_time_limit=self.config["SPEECH_RECOGNITION_PHRASE_TIME_LIMIT"],
-                    timeout=self.config["SPEECH_RECOGNITION_TIMEOUT"]
-                )
-                logging.info("Audio capturado, procesando con Google Speech Recognition...")
-                texto = self.recognizer.recognize_google(audio, language=self.config["SPEECH_RECOGNITION_LANGUAGE"])
-                logging.info(f"Texto reconocido: '{texto}'")
-                return texto
-            except sr.WaitTimeoutError:
-                logging.warning("Tiempo de espera agotado. No se detectó voz.")
-                return ""
-            except sr.UnknownValueError:
-                logging.warning("Google Speech Recognition no pudo entender el audio.")
-                hablar(ERROR_MESSAGES["speech_recognition_unknown"])
-                return ""
-            except sr.RequestError as e:
-                logging.error(f"Error en la solicitud a Google Speech Recognition; {e}")
-                if not check_internet_connection():
-                    hablar("No pude conectarme a los servicios de voz. Por favor, revisa tu conexión a internet.")
-                else:
-                    hablar(ERROR_MESSAGES["speech_recognition_service"])
-                return ""
-            except Exception as e:
-                logging.error(f"Ocurrió un error inesperado durante la escucha: {e}", exc_info=True)
-                hablar(ERROR_MESSAGES["speech_recognition_unexpected"])
-                return ""
+_TEMPLATE_PARAM_RE = re.compile(r'{(\w+)}')
+_REGEX_GROUP_RE = re.compile(r'\(\?P<(\w+)>')
+_REGEX_BACKREF_RE = re.compile(r'\(\?P=(\w+)\)')
 
-def _format_structured_data(data):
-    if isinstance(data, list):
-        if not data:
-            return "No hay elementos para mostrar."
-        
-        formatted_items = []
-        for i, item in enumerate(data):
-            if isinstance(item, dict):
-                display_text = item.get('title') or item.get('name') or item.get('description') or str(item)
-                formatted_items.append(f"{i+1}. {display_text}")
+class CommandRouter:
+    """Enrutador precompilado para las frases de custom_commands.json.
+
+    Las frases literales van a una tabla hash (búsqueda O(1)) y las frases con
+    parámetros (plantillas "{nombre}" o grupos "(?P<nombre>...)") se combinan en
+    una única alternancia precompilada, de modo que cada entrada se resuelve con
+    una sola pasada de la expresión regular en lugar de recorrer todos los comandos.
+    Se respeta el orden del archivo: si varias frases coinciden, gana la primera.
+
+    Las frases con expresiones regulares solo se enrutan si el comando lo pide
+    con "regex": true; si no, se ignoran (como hacía el bucle original) y la
+    entrada sigue hacia los plugins.
+    """
+
+    def __init__(self, custom_commands):
+        self.literals = {}
+        self._patterns = []
+        alternatives = []
+
+        for index, (command_phrase, command_details) in enumerate(custom_commands.items()):
+            phrase_lower = command_phrase.lower()
+            if _TEMPLATE_PARAM_RE.search(phrase_lower):
+                source = _TEMPLATE_PARAM_RE.sub(r'(?P<\1>.*)', phrase_lower)
+            elif _REGEX_GROUP_RE.search(command_phrase):
+                if not command_details.get("regex"):
+                    logging.debug(f"Frase con expresión regular sin \"regex\": true, no se enruta: '{command_phrase}'")
+                    continue
+                source = command_phrase
             else:
-                formatted_items.append(f"{i+1}. {str(item)}")
-        return "Aquí tienes los elementos: " + ", ".join(formatted_items)
-    elif isinstance(data, dict):
-        formatted_pairs = []
-        for key, value in data.items():
-            formatted_pairs.append(f"{key}: {value}")
-        return "Aquí está la información: " + ", ".join(formatted_pairs)
-    else:
-        return str(data)
+                self.literals.setdefault(phrase_lower, (index, command_phrase, command_details))
+                continue
 
-def hablar(texto=None, structured_data=None):
-    if structured_data:
-        text_to_speak = _format_structured_data(structured_data)
-    elif texto:
-        text_to_speak = texto
-    else:
-        logging.warning("Llamada a hablar() sin texto ni datos estructurados.")
-        return
+            # Los nombres de grupo no pueden repetirse dentro de una misma
+            # expresión, así que se prefijan con el índice de la alternativa.
+            prefix = f"c{len(self._patterns)}_"
+            group_names = _REGEX_GROUP_RE.findall(source)
+            source = _REGEX_GROUP_RE.sub(lambda m: f"(?P<{prefix}{m.group(1)}>", source)
+            source = _REGEX_BACKREF_RE.sub(lambda m: f"(?P={prefix}{m.group(1)})", source)
+            try:
+                re.compile(source, re.IGNORECASE)
+            except re.error as e:
+                logging.warning(f"Patrón de comando personalizado inválido '{command_phrase}': {e}")
+                continue
+            marker = f"c{len(self._patterns)}"
+            alternatives.append(f"(?P<{marker}>{source})")
+            self._patterns.append((marker, index, command_phrase, command_details,
+                                   [(f"{prefix}{name}", name) for name in group_names]))
 
-    logging.info(f"Intentando decir: '{text_to_speak}'")
-    nombre_archivo = "respuesta_gemini.mp3"
-    
-    try:
-        logging.debug("Generando audio TTS con gTTS...")
-        tts = gTTS(text=text_to_speak, lang=CONFIG["TTS_LANGUAGE"])
-        tts.save(nombre_archivo)
-        logging.debug(f"Audio TTS guardado en {nombre_archivo}")
+        self._markers = {marker: entry for marker, *entry in self._patterns}
+        self._combined = re.compile("|".join(alternatives), re.IGNORECASE) if alternatives else None
 
-        try:
-            logging.debug(f"Cargando audio desde {nombre_archivo} con pydub...")
-            sound = AudioSegment.from_mp3(nombre_archivo)
-            logging.debug("Audio cargado. Reproduciendo...")
-            play(sound)
-            logging.info("Reproducción de audio completada.")
-        except Exception as e:
-            logging.error(f"Error al cargar o reproducir audio con pydub: {e}", exc_info=True)
-        finally:
-            if os.path.exists(nombre_archivo):
-                try:
-                    os.remove(nombre_archivo)
-                    logging.debug(f"Archivo de audio temporal eliminado: {nombre_archivo}")
-                except OSError as e:
-                    logging.error(f"Error al eliminar el archivo de audio temporal {nombre_archivo}: {e}")
+    def with_details(self, custom_commands):
+        """Copia del enrutador con los detalles de custom_commands sin recompilar nada.
 
-    except Exception as e:
-        logging.critical(f"Fallo crítico en gTTS al guardar el audio: {e}", exc_info=True)
+        custom_commands debe tener las mismas frases y en el mismo orden que los
+        comandos con los que se compiló el enrutador.
+        """
+        router = copy.copy(self)
+        router.literals = {key: (index, phrase, custom_commands[phrase]) for key, (index, phrase, _) in self.literals.items()}
+        router._patterns = [(marker, index, phrase, custom_commands[phrase], groups) for marker, index, phrase, _, groups in self._patterns]
+        router._markers = {marker: entry for marker, *entry in router._patterns}
+        return router
 
-# --- Gestión de Plugins ---
+    def __len__(self):
+        return len(self.literals) + len(self._patterns)
 
-def load_plugins():
-    regular_plugins = []
-    command_plugins = []
-    plugins_dir = CONFIG["PLUGINS_DIR"]
-    if not os.path.exists(plugins_dir):
-        os.makedirs(plugins_dir)
-        logging.info(f"Directorio de plugins creado: {plugins_dir}")
-        return regular_plugins, command_plugins
+    def match(self, entrada_usuario):
+        """Devuelve (frase, detalles, parámetros, es_patrón) o None si no hay coincidencia."""
+        literal = self.literals.get(entrada_usuario.lower())
 
-    sys.path.insert(0, plugins_dir)
+        # Los patrones se compilan con IGNORECASE, así que se comparan con la entrada
+        # original para que los parámetros conserven las mayúsculas (nombres propios).
+        pattern_match = self._combined.match(entrada_usuario) if self._combined else None
+        if pattern_match:
+            index, command_phrase, command_details, groups = self._markers[pattern_match.lastgroup]
+            if literal is None or index < literal[0]:
+                params = {name: pattern_match.group(group) for group, name in groups}
+                return command_phrase, command_details, params, True
 
-    for filename in os.listdir(plugins_dir):
-        if filename.endswith(".py") and not filename.startswith("__"):
-            plugin_name = filename[:-3]
-            filepath = os.path.join(plugins_dir, filename)
-            spec = importlib.util.spec_from_file_location(plugin_name, filepath)
-            if spec and spec.loader:
-                module = importlib.util.module_from_spec(spec)
-                sys.modules[plugin_name] = module
-                try:
-                    spec.loader.exec_module(module)
-                    logging.info(f"Plugin cargado: {plugin_name}")
-                    module.load_user_data = load_user_data
-                    module.save_user_data = save_user_data
-                    module.hablar = hablar
-                    module.ERROR_MESSAGES = ERROR_MESSAGES
-                    module.call_ha_service = call_ha_service
-                    module.get_ha_state = get_ha_state
-                    module.send_mcp_request = send_mcp_request
-                    module.CONFIG = CONFIG
-
-                    if hasattr(module, 'handle_input') or hasattr(module, 'process_response'):
-                        regular_plugins.append(module)
-                    if hasattr(module, 'handle_command'):
-                        command_plugins.append(module)
-                except Exception as e:
-                    logging.error(f"Error al cargar el plugin {plugin_name}: {e}")
-    return regular_plugins, command_plugins
+        if literal is not None:
+            _, command_phrase, command_details = literal
+            return command_phrase, command_details, {}, False
+        return None
 
-# --- Hilo para comandos activados por tiempo ---
-stop_timed_commands_thread = threading.Event()
+class CustomCommands(dict):
+    """Diccionario de comandos personalizados con su enrutador compilado una sola vez."""
 
-def timed_command_executor(custom_commands):
-    last_executed_date = {}
-    while not stop_timed_commands_thread.is_set():
-        now = datetime.datetime.now()
-        current_time_str = now.strftime("%H:%M")
-        current_date_str = now.strftime("%Y-%m-%d")
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.router = CommandRouter(self)
+        logging.info(f"Enrutador de comandos compilado: {len(self.router.literals)} literales, {len(self.router) - len(self.router.literals)} con parámetros.")
 
-        for command_phrase, command_details in custom_commands.items():
-            trigger_time = command_details.get("trigger_time")
-            if trigger_time and trigger_time == current_time_str:
-                if command_phrase not in last_executed_date or last_executed_date[command_phrase] != current_date_str:
-                    logging.info(f"Activando comando por tiempo: {command_phrase} a las {trigger_time}")
-                    action_type = command_details.get("action")
-                    if action_type == "home_assistant_service":
-                        domain = command_details.get("domain")
-                        service = command_details.get("service")
-                        entity_id = command_details.get("entity_id")
-                        data = command_details.get("data")
-                        if call_ha_service(domain, service, entity_id, data):
-                            hablar(f"Comando programado ejecutado: {command_phrase}")
-                        else:
-                            hablar(f"Fallo al ejecutar comando programado: {command_phrase}")
-                    elif action_type == "user_data_lookup":
-                        key = command_details.get("key")
-                        user_data = load_user_data()
-                        value = user_data.get(key, "no tengo esa información")
-                        hablar(f"Tu {key} es {value}.")
-                    elif action_type == "user_data_set":
-                        key = command_details.get("key")
-                        value = command_details.get("value")
-                        user_data = load_user_data()
-                        user_data[key] = value
-                        save_user_data(user_data)
-                        hablar(f"He recordado que tu {key} es {value}.")
-                    elif action_type == "log_reminder":
-                        que = command_details.get("que")
-                        cuando = command_details.get("cuando")
-                        logging.info(f"RECORDATORIO PROGRAMADO: {que} para {cuando}")
-                        hablar(f"Recordatorio programado: {que} para {cuando}")
-                    elif action_type == "morning_summary":
-                        hablar("Buenos días. Aquí está tu resumen matutino.")
-                        try:
-                            from plugins import calendar_plugin
-                            eventos = calendar_plugin.list_upcoming_events()
-                            hablar(eventos)
-                        except Exception as e:
-                            logging.error(f"Error al obtener eventos del calendario para el resumen: {e}")
-                            hablar("No pude obtener los eventos del calendario.")
-                        try:
-                            from plugins import todo_plugin
-                            tareas = todo_plugin.list_tasks()
-                            hablar(tareas)
-                        except Exception as e:
-                            logging.error(f"Error al obtener tareas para el resumen: {e}")
-                            hablar("No pude obtener la lista de tareas.")
-                    elif action_type == "mcp_request":
-                        method = command_details.get("method")
-                        params = command_details.get("params")
-                        result = send_mcp_request(method, params)
-                        if result:
-                            hablar(f"Comando MCP programado ejecutado: {method}")
-                        else:
-                            hablar(f"Fallo al ejecutar comando MCP programado: {method}")
-
-                    last_executed_date[command_phrase] = current_date_str
-        time.sleep(60)
+    @classmethod
+    def reloaded(cls, data, previous):
+        """Comandos recargados; si las frases no han cambiado se reutiliza el enrutador de previous."""
+        if previous is None or list(data) != list(previous):
+            return cls(data)
+        commands = dict.__new__(cls)
+        dict.update(commands, data)
+        commands.router = previous.router.with_details(commands)
+        return commands
 
-# --- Interacción con Gemini CLI ---
+def get_command_router(custom_commands):
+    """Devuelve el enrutador compilado de custom_commands (lo compila si es un dict simple)."""
+    router = getattr(custom_commands, "router", None)
+    if router is None:
+        router = CommandRouter(custom_commands)
+    return router
 
-def _handle_custom_commands(entrada_usuario, custom_commands, last_executed_command_info):
-    command_handled = False
-    extracted_params = {}
-
-    for command_phrase, command_details in custom_commands.items():
-        if "{" in command_phrase and "}" in command_phrase:
-            pattern = re.sub(r'{(\w+)}', r'(?P<\1>.*)', command_phrase.lower())
-            match = re.match(pattern, entrada_usuario.lower())
-            if match:
-                extracted_params = match.groupdict()
-                action_type = command_details.get("action")
-
-                if action_type == "home_assistant_service":
-                    domain = command_details.get("domain")
-                    service = command_details.get("service")
-                    entity_id = extracted_params.get(command_details.get("entity_id_param", "entity_id"), command_details.get("entity_id"))
-                    data = command_details.get("data")
-                    if call_ha_service(domain, service, entity_id, data):
-                        hablar(f"Comando personalizado ejecutado: {command_phrase}")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params, "success": True}
-                        break
-                elif action_type == "user_data_lookup":
-                    key = command_details.get("key")
-                    user_data = load_user_data()
-                    value = user_data.get(key, "no tengo esa información")
-                    hablar(f"Tu {key} es {value}.")
-                    command_handled = True
-                    last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params, "success": True}
-                    break
-                elif action_type == "user_data_set":
-                    key = command_details.get("key")
-                    value_from_input_key = command_details.get("value_from_input")
-                    value = extracted_params.get(value_from_input_key)
-                    if value:
-                        user_data = load_user_data()
-                        user_data[key] = value
-                        save_user_data(user_data)
-                        hablar(f"He recordado que tu {key} es {value}.")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params, "success": True}
-                        break
-                    else:
-                        logging.warning(f"No se pudo extraer el valor para {key} del comando: {entrada_usuario}")
-                        hablar("Lo siento, no pude entender el valor que quieres que recuerde.")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params, "success": False, "error": "Value extraction failed"}
-                        break
-                elif action_type == "log_reminder":
-                    que = extracted_params.get("que")
-                    cuando = extracted_params.get("cuando")
-                    logging.info(f"RECORDATORIO: {que} para {cuando}")
-                    hablar(f"Recordatorio creado: {que} para {cuando}")
-                    command_handled = True
-                    last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params, "success": True}
-                    break
-                elif action_type == "mcp_request":
-                    method = command_details.get("method")
-                    params = command_details.get("params")
-                    resolved_params = {}
-                    if params:
-                        for p_key, p_value in params.items():
-                            if isinstance(p_value, str) and p_value.startswith("{") and p_value.endswith("}"):
-                                param_name = p_value[1:-1]
-                                resolved_params[p_key] = extracted_params.get(param_name, p_value)
-                            else:
-                                resolved_params[p_key] = p_value
-                    
-                    result = send_mcp_request(method, resolved_params)
-                    if result:
-                        hablar(f"Comando MCP ejecutado: {method}")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params, "success": True, "result_data": result}
-                        break
-                    else:
-                        hablar(f"Fallo al ejecutar comando MCP: {method}")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params, "success": False, "error": "MCP request failed"}
-                        break
-        else:
-            if command_phrase.lower() == entrada_usuario.lower():
-                action_type = command_details.get("action")
-                if action_type == "home_assistant_service":
-                    domain = command_details.get("domain")
-                    service = command_details.get("service")
-                    entity_id = command_details.get("entity_id")
-                    data = command_details.get("data")
-                    if call_ha_service(domain, service, entity_id, data):
-                        hablar(f"Comando personalizado ejecutado: {command_phrase}")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": {}, "success": True}
-                        break
-                elif action_type == "user_data_lookup":
-                    key = command_details.get("key")
-                    user_data = load_user_data()
-                    value = user_data.get(key, "no tengo esa información")
-                    hablar(f"Tu {key} es {value}.")
-                    command_handled = True
-                    last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": {}, "success": True}
-                    break
-                elif action_type == "user_data_set":
-                    key = command_details.get("key")
-                    value = command_details.get("value")
-                    user_data = load_user_data()
-                    user_data[key] = value
-                    save_user_data(user_data)
-                    hablar(f"He recordado que tu {key} es {value}.")
-                    command_handled = True
-                    last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": {}, "success": True}
-                    break
-                elif action_type == "log_reminder":
-                    que = command_details.get("que")
-                    cuando = command_details.get("cuando")
-                    logging.info(f"RECORDATORIO: {que} para {cuando}")
-                    hablar(f"Recordatorio creado: {que} para {cuando}")
-                    command_handled = True
-                    last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": {}, "success": True}
-                    break
-                elif action_type == "mcp_request":
-                    method = command_details.get("method")
-                    params = command_details.get("params")
-                    result = send_mcp_request(method, params)
-                    if result:
-                        hablar(f"Comando MCP ejecutado: {method}")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": {}, "success": True, "result_data": result}
-                        break
-                    else:
-                        hablar(f"Fallo al ejecutar comando MCP: {method}")
-                        command_handled = True
-                        last_executed_command_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": {}, "success": False, "error": "MCP request failed"}
-                        break
-    return command_handled, last_executed_command_info
+# --- Motores de reconocimiento de voz ---
 
-def _handle_command_plugins(entrada_usuario, command_plugins):
-    for plugin in command_plugins:
-        if hasattr(plugin, 'handle_command'):
-            try:
-                response = plugin.handle_command(entrada_usuario)
+class SpeechRecognitionEngine:
+    """Interfaz común de los motores STT.
+
+    recognize() devuelve (texto, confianza) y, como speech_recognition, lanza
+    sr.UnknownValueError si no entiende el audio o sr.RequestError si el servicio falla.
+    """
+    name = "base"
+
+    def recognize(self, audio):
+        raise NotImplementedError
+
+class GoogleSpeechEngine(SpeechRecognitionEngine):
+    """Reconocimiento en la nube con la API web de Google (comportamiento original)."""
+    name = "Google Speech Recognition"
+
+    def __init__(self, recognizer, language):
+        self.recognizer = recognizer
+        self.language = language
+
+    def recognize(self, audio):
+        result = self.recognizer.recognize_google(audio, language=self.language, show_all=True)
+        if not isinstance(result, dict) or not result.get("alternative"):
+            raise sr.UnknownValueError()
+        alternatives = result["alternative"]
+        scored = [alternative for alternative in alternatives if "confidence" in alternative]
+        best = max(scored, key=lambda alternative: alternative["confidence"]) if scored else alternatives[0]
+        return best["transcript"], best.get("confidence", 1.0)
+
+class VoskSpeechEngine(SpeechRecognitionEngine):
+    """Reconocimiento local en CPU con Vosk; el modelo se carga una vez y queda residente."""
+    name = "Vosk (local)"
+
+    def __init__(self, model_path, sample_rate=16000):
+        try:
+            from vosk import Model, KaldiRecognizer, SetLogLevel
+        except ImportError as e:
+            raise RuntimeError(f"El paquete 'vosk' no está instalado: {e}") from e
+        if not os.path.isdir(model_path):
+            raise RuntimeError(f"No se encontró el modelo de Vosk en {model_path}")
+        SetLogLevel(-1)
+        started = time.monotonic()
+        self.model = Model(model_path)
+        self._recognizer_class = KaldiRecognizer
+        self.sample_rate = sample_rate
+        logging.info(f"Modelo Vosk cargado desde {model_path} en {time.monotonic() - started:.2f} s.")
+
+    def recognize(self, audio):
+        recognizer = self._recognizer_class(self.model, self.sample_rate)
+        recognizer.SetWords(True)
+        recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=self.sample_rate, convert_width=2))
+        result = json.loads(recognizer.FinalResult())
+        text = result.get("text", "").strip()
+        if not text:
+            raise sr.UnknownValueError()
+        words = result.get("result") or []
+        confidence = sum(word.get("conf", 1.0) for word in words) / len(words) if words else 1.0
+        return text, confidence
+
+class FallbackSpeechEngine(SpeechRecognitionEngine):
+    """Usa el motor principal y recurre al secundario si falla o la confianza es baja.
+
+    Si el secundario tampoco da resultado se devuelve lo que reconoció el principal.
+    """
+
+    def __init__(self, primary, fallback, min_confidence):
+        self.primary = primary
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.name = f"{primary.name} con respaldo de {fallback.name}"
+
+    def recognize(self, audio):
+        primary_result = None
+        primary_error = None
+        try:
+            primary_result = self.primary.recognize(audio)
+            if primary_result[1] >= self.min_confidence:
+                return primary_result
+            logging.info(f"Confianza baja ({primary_result[1]:.2f}) en {self.primary.name}; probando {self.fallback.name}.")
+        except (sr.UnknownValueError, sr.RequestError) as e:
+            logging.info(f"{self.primary.name} no dio resultado ({type(e).__name__}); probando {self.fallback.name}.")
+            primary_error = e
+        try:
+            return self.fallback.recognize(audio)
+        except (sr.UnknownValueError, sr.RequestError):
+            if primary_result is not None:
+                return primary_result
+            raise primary_error
+
+def create_stt_engine(config, recognizer):
+    """Crea el motor indicado por STT_ENGINE: google, vosk, vosk+google o google+vosk.
+
+    Con "a+b" se usa "a" primero y "b" como respaldo. Si el modelo local no está
+    disponible se avisa y se usa Google.
+    """
+    google = GoogleSpeechEngine(recognizer, config["SPEECH_RECOGNITION_LANGUAGE"])
+    names = [name.strip() for name in config["STT_ENGINE"].split("+") if name.strip()]
+    engines = []
+    for name in names:
+        if name == "google":
+            engines.append(google)
+        elif name == "vosk":
+            try:
+                engines.append(VoskSpeechEngine(config["VOSK_MODEL_PATH"]))
+            except RuntimeError as e:
+                logging.error(f"No se pudo iniciar el reconocimiento local: {e}")
+        else:
+            logging.warning(f"Motor de reconocimiento de voz desconocido: {name}")
+    if not engines:
+        logging.warning("Se usará Google Speech Recognition como motor de voz.")
+        return google
+    engine = engines[0]
+    for fallback in engines[1:]:
+        engine = FallbackSpeechEngine(engine, fallback, config["STT_MIN_CONFIDENCE"])
+    return engine
+
+def stt_engine_requires_network(config):
+    return "google" in config["STT_ENGINE"].split("+")
+
+# --- Palabra de activación ---
+
+def _normalize_phrase(text):
+    return " ".join(re.findall(r'[\w\[\]]+', text.lower()))
+
+class VoskKeywordSpotter:
+    """Detector local de frases de activación con Vosk restringido a una gramática.
+
+    Con la gramática limitada a las frases de activación y "[unk]" el decodificador
+    solo elige entre ellas, lo que cuesta mucho menos CPU que el reconocimiento
+    libre y no usa la red. Si el motor STT ya es Vosk se reutiliza su modelo.
+    """
+
+    def __init__(self, model_path, phrases, sample_rate=16000, model=None):
+        try:
+            from vosk import Model, KaldiRecognizer, SetLogLevel
+        except ImportError as e:
+            raise RuntimeError(f"El paquete 'vosk' no está instalado: {e}") from e
+        if model is None:
+            if not os.path.isdir(model_path):
+                raise RuntimeError(f"No se encontró el modelo de Vosk en {model_path}")
+            SetLogLevel(-1)
+            model = Model(model_path)
+        self.model = model
+        self._recognizer_class = KaldiRecognizer
+        self.sample_rate = sample_rate
+        self.grammar = json.dumps([_normalize_phrase(phrase) for phrase in phrases] + ["[unk]"], ensure_ascii=False)
+
+    def transcribe(self, audio):
+        recognizer = self._recognizer_class(self.model, self.sample_rate, self.grammar)
+        recognizer.AcceptWaveform(audio.get_raw_data(convert_rate=self.sample_rate, convert_width=2))
+        return json.loads(recognizer.FinalResult()).get("text", "")
+
+class WakeWordGate:
+    """Deja pasar al reconocimiento solo la voz dirigida al asistente.
+
+    Cada frase segmentada pasa antes por spotter.transcribe(), local y barato. Si
+    contiene una frase de activación se abre una ventana de window_seconds en la
+    que las frases siguientes van directas al reconocimiento; cada frase
+    reconocida la prolonga. Si la frase de activación viene seguida de más
+    palabras ("oye asistente, enciende la luz") esa misma frase se reconoce. Las
+    demás se descartan sin llamar al STT.
+    """
+
+    PASS = "reconocer"
+    WAKE = "activación"
+    REJECT = "descartar"
+
+    def __init__(self, spotter, phrases, window_seconds=8.0, clock=time.monotonic):
+        self.spotter = spotter
+        self.phrases = [_normalize_phrase(phrase) for phrase in phrases]
+        self.window_seconds = window_seconds
+        self.clock = clock
+        self._open_until = 0
+        self.stats = {"accepted": 0, "rejected": 0, "wakeups": 0}
+
+    def is_open(self):
+        return self.clock() < self._open_until
+
+    def extend(self):
+        self._open_until = self.clock() + self.window_seconds
+
+    def close(self):
+        self._open_until = 0
+
+    def check(self, audio):
+        """Decide qué hacer con una frase: PASS (reconocerla), WAKE (era solo la activación) o REJECT."""
+        if self.is_open():
+            self.stats["accepted"] += 1
+            return self.PASS
+        transcript = _normalize_phrase(self.spotter.transcribe(audio))
+        for phrase in self.phrases:
+            if f" {phrase} " in f" {transcript} ":
+                self.stats["wakeups"] += 1
+                self.extend()
+                rest = f" {transcript} ".replace(f" {phrase} ", " ", 1).strip()
+                if rest:
+                    self.stats["accepted"] += 1
+                    return self.PASS
+                return self.WAKE
+        self.stats["rejected"] += 1
+        return self.REJECT
+
+    def strip_wake_phrase(self, text):
+        """Quita la frase de activación del principio del texto reconocido por el STT."""
+        words = text.split()
+        normalized = [_normalize_phrase(word) for word in words]
+        for phrase in self.phrases:
+            phrase_words = phrase.split()
+            if normalized[:len(phrase_words)] == phrase_words:
+                return " ".join(words[len(phrase_words):]).lstrip(" ,.")
+        return text
+
+def _find_vosk_model(engine):
+    if isinstance(engine, VoskSpeechEngine):
+        return engine.model
+    if isinstance(engine, FallbackSpeechEngine):
+        return _find_vosk_model(engine.primary) or _find_vosk_model(engine.fallback)
+    return None
+
+def create_wake_word_gate(config, stt_engine=None):
+    """Crea la puerta de palabra de activación si WAKE_WORD_ENABLED; None si no se usa o no hay Vosk."""
+    if not config.get("WAKE_WORD_ENABLED"):
+        return None
+    try:
+        spotter = VoskKeywordSpotter(config["VOSK_MODEL_PATH"], config["WAKE_WORD_PHRASES"], model=_find_vosk_model(stt_engine))
+    except RuntimeError as e:
+        logging.error(f"No se pudo iniciar la detección de la palabra de activación; se reconocerá toda la voz: {e}")
+        return None
+    logging.info(f"Palabra de activación: {', '.join(config['WAKE_WORD_PHRASES'])}.")
+    return WakeWordGate(spotter, config["WAKE_WORD_PHRASES"], config["WAKE_WORD_WINDOW_SECONDS"])
+
+def load_wav_audio(path):
+    """Lee un archivo WAV como sr.AudioData, p. ej. para probar la activación con grabaciones."""
+    with sr.AudioFile(path) as source:
+        return sr.Recognizer().record(source)
+
+# --- Captura continua de audio ---
+
+def _frame_rms(frame, sample_width):
+    """Energía RMS de un bloque de audio PCM."""
+    if sample_width != 2:
+        import audioop
+        return audioop.rms(frame, sample_width)
+    samples = array.array("h")
+    samples.frombytes(frame[:len(frame) - len(frame) % 2])
+    if sys.byteorder == "big":
+        samples.byteswap()
+    if not samples:
+        return 0
+    return math.sqrt(sum(sample * sample for sample in samples) / len(samples))
+
+class NoiseFloorTracker:
+    """Sigue el ruido de fondo en el flujo en vivo y ajusta energy_threshold en el sitio.
+
+    Cada window_seconds se toma el RMS mínimo de los bloques de la ventana (entre
+    palabra y palabra siempre hay huecos, así que la voz apenas lo mueve) y se
+    incorpora a una media móvil exponencial con constante de tiempo time_constant
+    segundos: si el fondo sube de forma permanente (un ventilador), el nivel lo
+    sigue. El umbral es el ruido por factor, acotado entre min_threshold y
+    max_threshold, y con histéresis: solo se publica en target.energy_threshold
+    cuando se aleja más de hysteresis (relativo) del valor actual. Los primeros
+    warmup_seconds sustituyen a la calibración bloqueante de adjust_for_ambient_noise.
+    """
+
+    def __init__(self, target, frame_seconds, time_constant=5.0, factor=3.0, hysteresis=0.2,
+                 min_threshold=100, max_threshold=4000, warmup_seconds=0.5, window_seconds=1.0):
+        self.target = target
+        self.window_frames = max(1, math.ceil(window_seconds / frame_seconds))
+        self.alpha = 1 - math.exp(-(self.window_frames * frame_seconds) / time_constant)
+        self.factor = factor
+        self.hysteresis = hysteresis
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.warmup_frames = max(1, math.ceil(warmup_seconds / frame_seconds))
+        self.noise_floor = None
+        self.frames = 0
+        self.speech_frames = 0
+        self.threshold_changes = 0
+        self.last_change = None
+        self._window_min = None
+        self._window_count = 0
+
+    @property
+    def calibrated(self):
+        return self.frames >= self.warmup_frames
+
+    def update(self, rms, is_speech):
+        """Incorpora el RMS de un bloque y devuelve el umbral vigente."""
+        self.frames += 1
+        if not self.calibrated or self.frames == self.warmup_frames:
+            # Durante el calentamiento, media simple de los bloques vistos
+            self.noise_floor = rms if self.noise_floor is None else self.noise_floor + (rms - self.noise_floor) / self.frames
+            if self.calibrated:
+                self._publish(self.target.energy_threshold, self._candidate())
+            return self.target.energy_threshold
+
+        if is_speech:
+            self.speech_frames += 1
+        self._window_min = rms if self._window_min is None else min(self._window_min, rms)
+        self._window_count += 1
+        if self._window_count >= self.window_frames:
+            self.noise_floor += self.alpha * (self._window_min - self.noise_floor)
+            self._window_min = None
+            self._window_count = 0
+            current = self.target.energy_threshold
+            candidate = self._candidate()
+            if abs(candidate - current) > self.hysteresis * current:
+                self._publish(current, candidate)
+        return self.target.energy_threshold
+
+    def _candidate(self):
+        return min(self.max_threshold, max(self.min_threshold, self.noise_floor * self.factor))
+
+    def _publish(self, previous, threshold):
+        self.target.energy_threshold = threshold
+        self.threshold_changes += 1
+        self.last_change = (time.time(), previous, threshold)
+        logging.info(f"Umbral de energía ajustado: {previous:.0f} -> {threshold:.0f} (ruido de fondo {self.noise_floor:.0f}).")
+
+    def metrics(self):
+        """Métricas del seguimiento del ruido para registros o diagnóstico."""
+        return {
+            "energy_threshold": self.target.energy_threshold,
+            "noise_floor": self.noise_floor,
+            "calibrated": self.calibrated,
+            "threshold_changes": self.threshold_changes,
+            "frames": self.frames,
+            "speech_frames": self.speech_frames,
+            "last_change": self.last_change,
+        }
+
+def create_noise_tracker(recognizer, config, frame_seconds):
+    return NoiseFloorTracker(
+        recognizer,
+        frame_seconds,
+        config["NOISE_FLOOR_TIME_CONSTANT"],
+        config["NOISE_THRESHOLD_FACTOR"],
+        config["NOISE_THRESHOLD_HYSTERESIS"],
+        config["NOISE_THRESHOLD_MIN"],
+        config["NOISE_THRESHOLD_MAX"],
+        config["NOISE_WARMUP_SECONDS"]
+    )
+
+class UtteranceSegmenter:
+    """Segmenta un flujo continuo de bloques de audio en frases mediante VAD por energía.
+
+    Un búfer circular guarda los últimos bloques de silencio para no recortar el
+    inicio de la frase. La frase termina tras pause_threshold segundos de silencio
+    o al llegar a phrase_time_limit; las que duran menos de min_phrase_seconds se
+    descartan como ruido. Con noise_tracker cada bloque alimenta también el
+    seguimiento del ruido de fondo, que ajusta el umbral que devuelve energy_threshold.
+    """
+
+    def __init__(self, sample_rate, sample_width, chunk_size, energy_threshold,
+                 pause_threshold, phrase_time_limit, pre_roll_seconds, min_phrase_seconds, noise_tracker=None):
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.frame_seconds = chunk_size / sample_rate
+        self.energy_threshold = energy_threshold
+        self.pause_frames = max(1, math.ceil(pause_threshold / self.frame_seconds))
+        self.max_frames = math.ceil(phrase_time_limit / self.frame_seconds) if phrase_time_limit else None
+        self.min_speech_frames = math.ceil(min_phrase_seconds / self.frame_seconds)
+        self.pre_roll = deque(maxlen=max(1, math.ceil(pre_roll_seconds / self.frame_seconds)))
+        self.noise_tracker = noise_tracker
+        self._frames = None
+        self._speech_frames = 0
+        self._silent_frames = 0
+
+    @property
+    def in_speech(self):
+        return self._frames is not None
+
+    def feed(self, frame):
+        """Procesa un bloque; devuelve un sr.AudioData cuando se completa una frase."""
+        rms = _frame_rms(frame, self.sample_width)
+        is_speech = rms > self.energy_threshold()
+        if self.noise_tracker is not None:
+            self.noise_tracker.update(rms, is_speech)
+            if not self.noise_tracker.calibrated:
+                is_speech = False
+
+        if self._frames is None:
+            if not is_speech:
+                self.pre_roll.append(frame)
+                return None
+            self._frames = list(self.pre_roll)
+            self.pre_roll.clear()
+            self._speech_frames = 0
+            self._silent_frames = 0
+
+        self._frames.append(frame)
+        if is_speech:
+            self._speech_frames += 1
+            self._silent_frames = 0
+        else:
+            self._silent_frames += 1
+
+        if self._silent_frames >= self.pause_frames or (self.max_frames and len(self._frames) >= self.max_frames):
+            return self._finish()
+        return None
+
+    def reset(self):
+        """Descarta la frase en curso y el búfer previo."""
+        self._frames = None
+        self.pre_roll.clear()
+
+    def _finish(self):
+        frames, speech_frames = self._frames, self._speech_frames
+        self._frames = None
+        if speech_frames < self.min_speech_frames:
+            return None
+        return sr.AudioData(b"".join(frames), self.sample_rate, self.sample_width)
+
+class BargeInDetector:
+    """Detecta que el usuario empieza a hablar mientras el asistente reproduce audio.
+
+    Exige una energía bastante mayor que el umbral normal (el altavoz también
+    llega al micrófono) durante un mínimo de bloques seguidos. Guarda esos
+    bloques para que el inicio de la frase del usuario no se pierda.
+    """
+
+    def __init__(self, sample_width, chunk_size, sample_rate, energy_threshold, energy_factor, min_seconds):
+        self.sample_width = sample_width
+        self.energy_threshold = energy_threshold
+        self.energy_factor = energy_factor
+        self.min_frames = max(1, math.ceil(min_seconds / (chunk_size / sample_rate)))
+        self.frames = deque(maxlen=self.min_frames * 2)
+        self._loud_frames = 0
+
+    def feed(self, frame):
+        self.frames.append(frame)
+        if _frame_rms(frame, self.sample_width) > self.energy_threshold() * self.energy_factor:
+            self._loud_frames += 1
+        else:
+            self._loud_frames = 0
+        return self._loud_frames >= self.min_frames
+
+    def reset(self):
+        self.frames.clear()
+        self._loud_frames = 0
+
+class ContinuousAudioCapture:
+    """Mantiene abierto el micrófono y deja cada frase detectada en una cola.
+
+    El dispositivo se abre una sola vez; mientras se reconoce una frase el hilo
+    de captura sigue grabando la siguiente.
+    """
+
+    def __init__(self, recognizer, config, max_pending=4, on_barge_in=None):
+        self.recognizer = recognizer
+        self.config = config
+        self.on_barge_in = on_barge_in
+        self.utterances = queue.Queue(maxsize=max_pending)
+        self.ready = threading.Event()
+        self.noise_tracker = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="captura-audio", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def is_running(self):
+        return self._thread.is_alive()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=2)
+        if self.noise_tracker is not None:
+            logging.info(f"Métricas del umbral de energía: {self.noise_tracker.metrics()}")
+
+    def _run(self):
+        try:
+            with sr.Microphone() as source:
+                if self.config.get("ADAPTIVE_NOISE"):
+                    # El umbral se calibra y se sigue ajustando con el propio flujo, sin esperar
+                    self.noise_tracker = create_noise_tracker(self.recognizer, self.config, source.CHUNK / source.SAMPLE_RATE)
+                else:
+                    logging.info("Ajustando para ruido ambiental... Por favor, espere.")
+                    self.recognizer.adjust_for_ambient_noise(source, duration=self.config.get("AMBIENT_NOISE_SECONDS", 2))
+                    logging.info(f"Ajuste de ruido ambiental completo. Umbral de energía dinámico: {self.recognizer.energy_threshold:.2f}")
+                segmenter = UtteranceSegmenter(
+                    source.SAMPLE_RATE,
+                    source.SAMPLE_WIDTH,
+                    source.CHUNK,
+                    lambda: self.recognizer.energy_threshold,
+                    self.config["SPEECH_RECOGNITION_PAUSE_THRESHOLD"],
+                    self.config["SPEECH_RECOGNITION_PHRASE_TIME_LIMIT"],
+                    self.config["AUDIO_PRE_ROLL_SECONDS"],
+                    self.config["AUDIO_MIN_PHRASE_SECONDS"],
+                    self.noise_tracker
+                )
+                barge_in = BargeInDetector(
+                    source.SAMPLE_WIDTH,
+                    source.CHUNK,
+                    source.SAMPLE_RATE,
+                    lambda: self.recognizer.energy_threshold,
+                    self.config.get("BARGE_IN_ENERGY_FACTOR", 3.0),
+                    self.config.get("BARGE_IN_MIN_SECONDS", 0.3)
+                )
+                self.ready.set()
+                barged_in = False
+                while not self._stop.is_set():
+                    frame = source.stream.read(source.CHUNK)
+                    if not tts_speaking.is_set():
+                        barged_in = False
+                    elif not barged_in:
+                        # Mientras habla el asistente solo se busca un barge-in;
+                        # el resto se descarta para que no se oiga a sí mismo.
+                        segmenter.reset()
+                        if self.on_barge_in is None or not barge_in.feed(frame):
+                            continue
+                        logging.info("Barge-in detectado: el usuario habla durante la respuesta.")
+                        self.on_barge_in()
+                        barged_in = True
+                        pending_frames = list(barge_in.frames)
+                        barge_in.reset()
+                        for pending_frame in pending_frames:
+                            segmenter.feed(pending_frame)
+                        continue
+                    audio = segmenter.feed(frame)
+                    if audio is not None:
+                        self._enqueue(audio)
+        except Exception as e:
+            logging.error(f"Error en la captura continua de audio: {e}", exc_info=True)
+        finally:
+            self.ready.set()
+
+    def _enqueue(self, audio):
+        # Si nadie consume a tiempo se descarta la frase más antigua
+        while True:
+            try:
+                self.utterances.put_nowait(audio)
+                return
+            except queue.Full:
+                try:
+                    dropped = self.utterances.get_nowait()
+                    logging.warning(f"Cola de audio llena; se descarta una frase de {len(dropped.frame_data)} bytes.")
+                except queue.Empty:
+                    pass
+
+class AudioInputHandler:
+    def __init__(self, config):
+        self.recognizer = sr.Recognizer()
+        self.config = config
+        self.recognizer.pause_threshold = config["SPEECH_RECOGNITION_PAUSE_THRESHOLD"]
+        self.stt_engine = create_stt_engine(config, self.recognizer)
+        self.wake_gate = create_wake_word_gate(config, self.stt_engine)
+        self.capture = None
+
+        if config["AUDIO_CAPTURE_MODE"] == "continuous":
+            # El micrófono queda abierto en su propio hilo, que también calibra el ruido
+            self.capture = ContinuousAudioCapture(self.recognizer, config).start()
+            self.capture.ready.wait()
+            return
+
+        if config.get("ADAPTIVE_NOISE"):
+            # Sin captura continua el umbral lo ajusta speech_recognition en cada escucha
+            self.recognizer.dynamic_energy_threshold = True
+            return
+
+        # Ajustar para el ruido ambiental una sola vez al inicio
+        with sr.Microphone() as source:
+            logging.info("Ajustando para ruido ambiental... Por favor, espere.")
+            self.recognizer.adjust_for_ambient_noise(source, duration=config.get("AMBIENT_NOISE_SECONDS", 2))
+            logging.info(f"Ajuste de ruido ambiental completo. Umbral de energía dinámico: {self.recognizer.energy_threshold:.2f}")
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.stop()
+
+    def escuchar(self):
+        if self.capture is not None and not self.capture.is_running():
+            logging.warning("La captura continua se detuvo; se vuelve a abrir el micrófono en cada turno.")
+            self.capture = None
+
+        if self.capture is not None:
+            logging.info("Escuchando...")
+            try:
+                audio = self.capture.utterances.get(timeout=self.config["SPEECH_RECOGNITION_TIMEOUT"])
+            except queue.Empty:
+                logging.warning("Tiempo de espera agotado. No se detectó voz.")
+                return ""
+            return self._recognize_if_addressed(audio)
+
+        with sr.Microphone() as source:
+            logging.info("Escuchando...")
+            try:
+                audio = self.recognizer.listen(
+                    source,
+                    phrase_time_limit=self.config["SPEECH_RECOGNITION_PHRASE_TIME_LIMIT"],
+                    timeout=self.config["SPEECH_RECOGNITION_TIMEOUT"]
+                )
+            except sr.WaitTimeoutError:
+                logging.warning("Tiempo de espera agotado. No se detectó voz.")
+                return ""
+            except Exception as e:
+                logging.error(f"Ocurrió un error inesperado durante la escucha: {e}", exc_info=True)
+                hablar(ERROR_MESSAGES["speech_recognition_unexpected"])
+                return ""
+        return self._recognize_if_addressed(audio)
+
+    def _recognize_if_addressed(self, audio):
+        """Reconoce la frase solo si va dirigida al asistente (sin puerta de activación, siempre)."""
+        if self.wake_gate is None:
+            return self.reconocer(audio)
+        decision = self.wake_gate.check(audio)
+        if decision == WakeWordGate.REJECT:
+            logging.debug("Frase descartada: no va dirigida al asistente.")
+            return ""
+        if decision == WakeWordGate.WAKE:
+            logging.info("Palabra de activación detectada. Escuchando la orden...")
+            return ""
+        texto = self.reconocer(audio)
+        if texto:
+            self.wake_gate.extend()
+            texto = self.wake_gate.strip_wake_phrase(texto)
+        return texto
+
+    def reconocer(self, audio):
+        try:
+            logging.info(f"Audio capturado, procesando con {self.stt_engine.name}...")
+            texto, confianza = self.stt_engine.recognize(audio)
+            logging.info(f"Texto reconocido: '{texto}' (confianza {confianza:.2f})")
+            return texto
+        except sr.UnknownValueError:
+            logging.warning(f"{self.stt_engine.name} no pudo entender el audio.")
+            hablar(ERROR_MESSAGES["speech_recognition_unknown"])
+            return ""
+        except sr.RequestError as e:
+            logging.error(f"Error en la solicitud a {self.stt_engine.name}; {e}")
+            if not check_internet_connection():
+                hablar("No pude conectarme a los servicios de voz. Por favor, revisa tu conexión a internet.")
+            else:
+                hablar(ERROR_MESSAGES["speech_recognition_service"])
+            return ""
+        except Exception as e:
+            logging.error(f"Ocurrió un error inesperado durante la escucha: {e}", exc_info=True)
+            hablar(ERROR_MESSAGES["speech_recognition_unexpected"])
+            return ""
+
+def _format_structured_data(data):
+    if isinstance(data, list):
+        if not data:
+            return "No hay elementos para mostrar."
+        
+        formatted_items = []
+        for i, item in enumerate(data):
+            if isinstance(item, dict):
+                display_text = item.get('title') or item.get('name') or item.get('description') or str(item)
+                formatted_items.append(f"{i+1}. {display_text}")
+            else:
+                formatted_items.append(f"{i+1}. {str(item)}")
+        return "Aquí tienes los elementos: " + ", ".join(formatted_items)
+    elif isinstance(data, dict):
+        formatted_pairs = []
+        for key, value in data.items():
+            formatted_pairs.append(f"{key}: {value}")
+        return "Aquí está la información: " + ", ".join(formatted_pairs)
+    else:
+        return str(data)
+
+class ActivityFlag:
+    """Indicador que sigue activo mientras quede al menos un hilo dentro del bloque."""
+
+    def __init__(self):
+        self._count = 0
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+
+    def __enter__(self):
+        with self._lock:
+            self._count += 1
+            self._event.set()
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self._count -= 1
+            if self._count == 0:
+                self._event.clear()
+
+    def is_set(self):
+        return self._event.is_set()
+
+# Activo mientras el asistente reproduce audio (la captura continua lo usa para no oírse a sí mismo)
+tts_speaking = ActivityFlag()
+
+# No se corta tras números ("1. Tarea") para no romper listas enumeradas
+_SENTENCE_SPLIT_RE = re.compile(r'(?<=[^\d\s][.!?;…])\s+|\n+')
+_CLAUSE_SPLIT_RE = re.compile(r'(?<=,)\s+')
+
+def _split_into_chunks(text):
+    """Divide el texto en frases para sintetizarlas y reproducirlas por partes.
+
+    Los fragmentos muy cortos se unen al siguiente y las frases demasiado largas
+    se cortan por las comas, para que el primer audio llegue cuanto antes.
+    """
+    min_chars = CONFIG["TTS_MIN_CHUNK_CHARS"]
+    max_chars = CONFIG["TTS_MAX_CHUNK_CHARS"]
+
+    pieces = []
+    for sentence in _SENTENCE_SPLIT_RE.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        current = ""
+        for clause in _CLAUSE_SPLIT_RE.split(sentence):
+            if current and len(current) + len(clause) + 1 > max_chars:
+                pieces.append(current)
+                current = clause
+            else:
+                current = f"{current} {clause}" if current else clause
+        if current:
+            pieces.append(current)
+
+    chunks = []
+    pending = ""
+    for piece in pieces:
+        pending = f"{pending} {piece}" if pending else piece
+        if len(pending) >= min_chars:
+            chunks.append(pending)
+            pending = ""
+    if pending:
+        chunks.append(pending)
+    return chunks
+
+class TTSCache:
+    """Caché en disco del audio ya sintetizado, con límite de tamaño y expulsión LRU.
+
+    Cada entrada se guarda como WAV (PCM ya decodificado) bajo una clave derivada
+    de (texto, idioma). El orden de uso se mantiene en memoria y se refleja en el
+    mtime de los archivos para conservarlo entre ejecuciones.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def _key(self, text, lang):
+        return hashlib.sha256(f"{lang}\0{text}".encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.wav")
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        entries = []
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".wav"):
+                    stat = os.stat(os.path.join(self.directory, filename))
+                    entries.append((stat.st_mtime, filename[:-4], stat.st_size))
+        self._index = OrderedDict((key, size) for _, key, size in sorted(entries))
+
+    def get(self, text, lang):
+        if not self.enabled:
+            return None
+        key = self._key(text, lang)
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                return None
+            self._index.move_to_end(key)
+        path = self._path(key)
+        try:
+            os.utime(path)
+            return AudioSegment.from_file(path, format="wav")
+        except Exception as e:
+            logging.warning(f"Entrada de caché TTS ilegible, se descarta: {e}")
+            with self._lock:
+                self._index.pop(key, None)
+            return None
+
+    def contains(self, text, lang):
+        with self._lock:
+            self._load_index()
+            return self._key(text, lang) in self._index
+
+    def put(self, text, lang, sound):
+        if not self.enabled:
+            return
+        buffer = io.BytesIO()
+        sound.export(buffer, format="wav")
+        data = buffer.getvalue()
+        if not data:
+            return
+        key = self._key(text, lang)
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logging.warning(f"No se pudo guardar el audio en la caché TTS: {e}")
+            return
+        with self._lock:
+            self._load_index()
+            self._index[key] = len(data)
+            self._index.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        total = sum(self._index.values())
+        while total > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            total -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+TTS_CACHE = TTSCache(CONFIG["TTS_CACHE_DIR"], int(CONFIG["TTS_CACHE_MAX_MB"] * 1024 * 1024))
+
+def _synthesize_chunk(text):
+    """Sintetiza un fragmento con gTTS y lo decodifica en memoria, sin archivos temporales.
+
+    Si el fragmento ya está en la caché TTS se reproduce desde disco sin ir a la red.
+    """
+    lang = CONFIG["TTS_LANGUAGE"]
+    sound = TTS_CACHE.get(text, lang)
+    if sound is not None:
+        logging.debug(f"Audio TTS servido desde la caché: '{text}'")
+        return sound
+    buffer = io.BytesIO()
+    gTTS(text=text, lang=lang).write_to_fp(buffer)
+    buffer.seek(0)
+    sound = AudioSegment.from_file(buffer, format="mp3")
+    try:
+        TTS_CACHE.put(text, lang, sound)
+    except Exception as e:
+        logging.warning(f"No se pudo guardar el audio en la caché TTS: {e}")
+    return sound
+
+def warm_tts_cache(texts):
+    """Sintetiza por adelantado los textos fijos para que nunca esperen a la red."""
+    lang = CONFIG["TTS_LANGUAGE"]
+    warmed = 0
+    for text in texts:
+        for chunk in _split_into_chunks(text):
+            if TTS_CACHE.contains(chunk, lang):
+                continue
+            try:
+                _synthesize_chunk(chunk)
+                warmed += 1
+            except Exception as e:
+                logging.warning(f"No se pudo precalentar la caché TTS: {e}")
+                return warmed
+    logging.info(f"Caché TTS precalentada: {warmed} fragmentos nuevos.")
+    return warmed
+
+def _play_audio(sound, should_stop=None):
+    """Reproduce un AudioSegment.
+
+    Con should_stop se reproduce por bloques de 50 ms con PyAudio y se corta en
+    cuanto should_stop() devuelve True; sin PyAudio se usa pydub sin corte.
+    """
+    if should_stop is None:
+        play(sound)
+        return
+    try:
+        import pyaudio
+    except ImportError:
+        play(sound)
+        return
+    audio = pyaudio.PyAudio()
+    stream = audio.open(format=audio.get_format_from_width(sound.sample_width),
+                        channels=sound.channels, rate=sound.frame_rate, output=True)
+    try:
+        for chunk in make_chunks(sound, 50):
+            if should_stop():
+                logging.info("Reproducción interrumpida.")
+                break
+            stream.write(chunk.raw_data)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        audio.terminate()
+
+def _speak_chunks(chunks):
+    """Reproduce los fragmentos en orden mientras un hilo sintetiza los siguientes.
+
+    La cola limita cuántos fragmentos se sintetizan por adelantado, así que el
+    tiempo hasta el primer audio depende solo del primer fragmento.
+    """
+    audio_queue = queue.Queue(maxsize=max(1, CONFIG["TTS_PREFETCH_CHUNKS"]))
+    source_errors = []
+
+    def synthesize_worker():
+        synthesis_failed = False
+        try:
+            for chunk in chunks:
+                # Tras un fallo de gTTS se sigue consumiendo la fuente (p. ej. la
+                # respuesta en streaming de Gemini) para no dejarla a medias.
+                if synthesis_failed:
+                    continue
+                logging.debug(f"Generando audio TTS con gTTS para: '{chunk}'")
+                try:
+                    sound = _synthesize_chunk(chunk)
+                except Exception as e:
+                    logging.critical(f"Fallo crítico en gTTS al generar el audio: {e}", exc_info=True)
+                    synthesis_failed = True
+                    continue
+                audio_queue.put(sound)
+        except Exception as e:
+            source_errors.append(e)
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+            audio_queue.put(None)
+
+    threading.Thread(target=synthesize_worker, daemon=True).start()
+
+    played = False
+    while True:
+        sound = audio_queue.get()
+        if sound is None:
+            break
+        try:
+            logging.debug("Audio cargado. Reproduciendo...")
+            with tts_speaking:
+                play(sound)
+            played = True
+        except Exception as e:
+            logging.error(f"Error al cargar o reproducir audio con pydub: {e}", exc_info=True)
+    if played:
+        logging.info("Reproducción de audio completada.")
+    if source_errors:
+        raise source_errors[0]
+
+class SpeechOutputStage:
+    """Etapa de salida del pipeline: sintetiza y reproduce en hilos propios el texto encolado.
+
+    Cada fragmento lleva la época en la que se encoló; interrupt() (barge-in)
+    avanza la época, corta el audio en curso y hace que se descarte todo lo
+    pendiente sin sintetizarlo.
+    """
+
+    def __init__(self, text_queue):
+        self.text_queue = text_queue
+        self.audio_queue = queue.Queue(maxsize=max(1, CONFIG["TTS_PREFETCH_CHUNKS"]))
+        self.epoch = 0
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._threads = [
+            threading.Thread(target=self._synthesize_loop, name="tts-sintesis", daemon=True),
+            threading.Thread(target=self._playback_loop, name="tts-reproduccion", daemon=True),
+        ]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.interrupt()
+        self.text_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=2)
+
+    def say(self, text):
+        for chunk in _split_into_chunks(text):
+            self.say_chunk(chunk)
+
+    def say_chunk(self, chunk, epoch=None):
+        with self._lock:
+            self._pending += 1
+            self._idle.clear()
+            if epoch is None:
+                epoch = self.epoch
+        self.text_queue.put((epoch, chunk))
+
+    def interrupt(self):
+        with self._lock:
+            self.epoch += 1
+
+    def wait_until_idle(self, timeout=None):
+        return self._idle.wait(timeout)
+
+    def _done(self):
+        with self._lock:
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.set()
+
+    def _synthesize_loop(self):
+        while True:
+            item = self.text_queue.get()
+            if item is None:
+                self.audio_queue.put(None)
+                return
+            epoch, chunk = item
+            if epoch != self.epoch:
+                self._done()
+                continue
+            try:
+                sound = _synthesize_chunk(chunk)
+            except Exception as e:
+                logging.critical(f"Fallo crítico en gTTS al generar el audio: {e}", exc_info=True)
+                self._done()
+                continue
+            self.audio_queue.put((epoch, sound))
+
+    def _playback_loop(self):
+        while True:
+            item = self.audio_queue.get()
+            if item is None:
+                return
+            epoch, sound = item
+            try:
+                if epoch == self.epoch:
+                    with tts_speaking:
+                        _play_audio(sound, should_stop=lambda: self.epoch != epoch)
+            except Exception as e:
+                logging.error(f"Error al cargar o reproducir audio con pydub: {e}", exc_info=True)
+            finally:
+                self._done()
+
+# Etapa de salida activa cuando el bucle principal funciona como pipeline
+speech_output = None
+
+def _sentences_from_stream(fragments):
+    """Agrupa un flujo de fragmentos de texto en frases completas a medida que se cierran.
+
+    Devuelve tuplas (frase, es_la_última). Al terminar el flujo siempre se emite
+    una última tupla con lo que quede pendiente (puede ser una cadena vacía).
+    """
+    min_chars = CONFIG["TTS_MIN_CHUNK_CHARS"]
+    max_chars = CONFIG["TTS_MAX_CHUNK_CHARS"]
+    buffer = ""
+
+    for fragment in fragments:
+        buffer += fragment
+        boundaries = list(_SENTENCE_SPLIT_RE.finditer(buffer))
+        if boundaries:
+            cut = boundaries[-1].end()
+        elif len(buffer) > max_chars and ", " in buffer:
+            cut = buffer.rindex(", ") + 2
+        else:
+            continue
+        chunks = _split_into_chunks(buffer[:cut])
+        buffer = buffer[cut:]
+        if chunks and len(chunks[-1]) < min_chars:
+            buffer = f"{chunks.pop()} {buffer}"
+        for chunk in chunks:
+            yield chunk, False
+
+    remaining = _split_into_chunks(buffer)
+    for chunk in remaining[:-1]:
+        yield chunk, False
+    yield (remaining[-1] if remaining else ""), True
+
+def hablar(texto=None, structured_data=None):
+    if structured_data:
+        text_to_speak = _format_structured_data(structured_data)
+    elif texto:
+        text_to_speak = texto
+    else:
+        logging.warning("Llamada a hablar() sin texto ni datos estructurados.")
+        return
+
+    logging.info(f"Intentando decir: '{text_to_speak}'")
+    if speech_output is not None:
+        speech_output.say(text_to_speak)
+        return
+    _speak_chunks(_split_into_chunks(text_to_speak))
+
+# --- Gestión de Plugins ---
+
+_PLUGIN_HOOKS = ("handle_command", "handle_input", "process_response", "process_response_chunk")
+
+# Plugins cargados por load_plugins (módulos o LazyPlugin) por nombre
+loaded_plugins = {}
+# Coste de importar cada plugin: estado, milisegundos y memoria reservada durante la importación
+plugin_load_stats = {}
+
+def read_plugin_manifest(filepath):
+    """Lee el manifiesto de un plugin (nombre, TRIGGERS y funciones gancho) sin importarlo.
+
+    Se analiza el código fuente con ast, así que los TRIGGERS tienen que ser una
+    lista literal de frases. Un plugin puede declarar LAZY_LOAD = False para
+    importarse siempre al arrancar. Devuelve None si el archivo no se puede leer
+    o si sus TRIGGERS no son literales (p. ej. usan re.compile): en ese caso el
+    plugin se importa al arrancar, como antes.
+    """
+    try:
+        with open(filepath, 'r', encoding='utf-8') as f:
+            tree = ast.parse(f.read(), filename=filepath)
+    except (OSError, SyntaxError, ValueError) as e:
+        logging.debug(f"No se pudo leer el manifiesto de {filepath}: {e}")
+        return None
+
+    manifest = {
+        "name": os.path.splitext(os.path.basename(filepath))[0],
+        "path": filepath,
+        "description": (ast.get_docstring(tree) or "").split("\n")[0],
+        "triggers": None,
+        "hooks": set(),
+        "lazy": True,
+    }
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if node.name in _PLUGIN_HOOKS:
+                manifest["hooks"].add(node.name)
+            continue
+        if isinstance(node, ast.Assign):
+            targets, value = node.targets, node.value
+        elif isinstance(node, ast.AnnAssign) and node.value is not None:
+            targets, value = [node.target], node.value
+        else:
+            continue
+        for name in (target.id for target in targets if isinstance(target, ast.Name)):
+            if name in _PLUGIN_HOOKS:
+                manifest["hooks"].add(name)
+            elif name in ("TRIGGERS", "LAZY_LOAD"):
+                try:
+                    literal = ast.literal_eval(value)
+                except ValueError:
+                    return None
+                if name == "TRIGGERS":
+                    manifest["triggers"] = [literal] if isinstance(literal, str) else list(literal)
+                else:
+                    manifest["lazy"] = bool(literal)
+    return manifest
+
+class LazyPlugin:
+    """Plugin cuyo módulo no se importa hasta que se usa por primera vez.
+
+    Expone __name__, TRIGGERS y el manifiesto, de modo que el índice de despacho
+    se construye sin importar nada. Preguntar por un gancho que el manifiesto no
+    declara tampoco importa el módulo; cualquier otro atributo sí lo importa (con
+    las dependencias inyectadas, como al arrancar) y se lee del módulo real. Si
+    la importación falla el plugin queda sin atributos y se ignora.
+    """
+
+    def __init__(self, manifest):
+        self.__name__ = manifest["name"]
+        self.manifest = manifest
+        if manifest["triggers"] is not None:
+            self.TRIGGERS = manifest["triggers"]
+        self._module = None
+        self._failed = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def load(self):
+        """Importa el módulo si aún no se ha importado y lo devuelve (None si falla)."""
+        with self._lock:
+            if self._module is None and not self._failed:
+                self._module = _import_plugin(self.__name__, self.manifest["path"])
+                self._failed = self._module is None
+            return self._module
+
+    def __getattr__(self, name):
+        if name.startswith("_") or (name in _PLUGIN_HOOKS and name not in self.manifest["hooks"]):
+            raise AttributeError(name)
+        module = self.load()
+        if module is None:
+            raise AttributeError(f"El plugin {self.__name__} no se pudo importar")
+        return getattr(module, name)
+
+    def __repr__(self):
+        state = "importado" if self.loaded else "diferido"
+        return f"<LazyPlugin {self.__name__} ({state})>"
+
+def _inject_plugin_dependencies(module):
+    module.load_user_data = load_user_data
+    module.save_user_data = save_user_data
+    module.get_user_data = get_user_data
+    module.set_user_data = set_user_data
+    module.hablar = hablar
+    module.ERROR_MESSAGES = ERROR_MESSAGES
+    module.call_ha_service = call_ha_service
+    module.get_ha_state = get_ha_state
+    module.call_ha_services = call_ha_services
+    module.send_mcp_request = send_mcp_request
+    module.send_mcp_requests = send_mcp_requests
+    module.mcp_client = mcp_client
+    module.response_cache = response_cache
+    module.http_client = http_client
+    module.CONFIG = CONFIG
+
+def _import_plugin(plugin_name, filepath):
+    """Importa un plugin, le inyecta las dependencias y anota cuánto ha costado importarlo."""
+    spec = importlib.util.spec_from_file_location(plugin_name, filepath)
+    if not (spec and spec.loader):
+        return None
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[plugin_name] = module
+    # La memoria se mide con tracemalloc solo durante la importación (si nadie más lo está usando).
+    # tracemalloc es global al proceso: ralentiza todos los hilos mientras está activo, así que
+    # con él el tiempo de importación sale inflado y la memoria incluye lo que asignen otros
+    # hilos a la vez (p. ej. el arranque en paralelo). Por eso está desactivado por defecto y
+    # el informe marca esas cifras como orientativas.
+    profile_memory = CONFIG["PLUGINS_PROFILE_MEMORY"] and not tracemalloc.is_tracing()
+    if profile_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    stats = {"state": "importado", "import_ms": None, "memory_kb": None}
+    try:
+        spec.loader.exec_module(module)
+    except Exception as e:
+        stats["state"] = "error"
+        sys.modules.pop(plugin_name, None)
+        logging.error(f"Error al cargar el plugin {plugin_name}: {e}")
+        return None
+    finally:
+        stats["import_ms"] = (time.perf_counter() - start) * 1000
+        if profile_memory:
+            stats["memory_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+            tracemalloc.stop()
+        plugin_load_stats[plugin_name] = stats
+    logging.info(f"Plugin cargado: {plugin_name}")
+    _inject_plugin_dependencies(module)
+    return module
+
+def load_plugins():
+    """Carga los plugins de PLUGINS_DIR y los separa en regulares y de comando.
+
+    Con PLUGINS_LAZY cada plugin se registra a partir de su manifiesto como un
+    LazyPlugin y se importa la primera vez que se despacha; los que no tienen un
+    manifiesto legible se importan en el momento.
+    """
+    regular_plugins = []
+    command_plugins = []
+    plugins_dir = CONFIG["PLUGINS_DIR"]
+    if not os.path.exists(plugins_dir):
+        os.makedirs(plugins_dir)
+        logging.info(f"Directorio de plugins creado: {plugins_dir}")
+        return regular_plugins, CommandPlugins(command_plugins)
+
+    sys.path.insert(0, plugins_dir)
+
+    for filename in os.listdir(plugins_dir):
+        if filename.endswith(".py") and not filename.startswith("__"):
+            plugin, hooks = _register_plugin(filename[:-3], os.path.join(plugins_dir, filename))
+            if 'handle_input' in hooks or 'process_response' in hooks:
+                regular_plugins.append(plugin)
+            if 'handle_command' in hooks:
+                command_plugins.append(plugin)
+    return regular_plugins, CommandPlugins(command_plugins)
+
+def _register_plugin(plugin_name, filepath):
+    """Registra un plugin (diferido si su manifiesto lo permite) y devuelve (plugin, ganchos)."""
+    manifest = read_plugin_manifest(filepath) if CONFIG["PLUGINS_LAZY"] else None
+    if manifest is not None and manifest["lazy"]:
+        plugin = LazyPlugin(manifest)
+        hooks = manifest["hooks"]
+        plugin_load_stats[plugin_name] = {"state": "diferido", "import_ms": None, "memory_kb": None}
+    else:
+        plugin = _import_plugin(plugin_name, filepath)
+        if plugin is None:
+            return None, set()
+        hooks = {hook for hook in _PLUGIN_HOOKS if hasattr(plugin, hook)}
+    loaded_plugins[plugin_name] = plugin
+    return plugin, hooks
+
+def plugin_load_report():
+    """Informe de carga de plugins: una línea por plugin, de la importación más lenta a la más rápida."""
+    lines = []
+    for name, stats in sorted(plugin_load_stats.items(), key=lambda item: -(item[1]["import_ms"] or 0)):
+        line = f"{name}: {stats['state']}"
+        if stats["import_ms"] is not None:
+            line += f", {stats['import_ms']:.1f} ms"
+        if stats["memory_kb"] is not None:
+            line += f", {stats['memory_kb']:.0f} KB (con tracemalloc: tiempo inflado y memoria aproximada)"
+        lines.append(line)
+    return lines
+
+def log_plugin_load_report():
+    lines = plugin_load_report()
+    if lines:
+        logging.info("Informe de carga de plugins:\n  " + "\n  ".join(lines))
+
+# --- Despacho indexado de plugins de comando ---
+
+_WORD_RE = re.compile(r'\w+')
+
+def _get_plugin_triggers(plugin):
+    """Devuelve los TRIGGERS declarados por un plugin, o None si no declara ninguno."""
+    triggers = getattr(plugin, 'TRIGGERS', None)
+    if isinstance(triggers, (str, re.Pattern)):
+        return [triggers]
+    if isinstance(triggers, (list, tuple, set, frozenset)):
+        return list(triggers)
+    return None
+
+class PluginDispatchIndex:
+    """Índice invertido palabra -> plugins construido a partir de sus TRIGGERS.
+
+    Un plugin puede declarar TRIGGERS como frases (se buscan como subcadena en la
+    entrada en minúsculas) o expresiones regulares compiladas. Cada frase se indexa
+    por su palabra más larga, de modo que solo se evalúan los plugins cuya palabra
+    clave aparece en la entrada. Los plugins sin TRIGGERS son siempre candidatos,
+    como antes. El orden de carga se conserva entre los candidatos.
+    """
+
+    def __init__(self, plugins):
+        self.plugins = list(plugins)
+        self.keyword_index = {}
+        self._phrases = {}
+        self._regexes = {}
+        self._always = []
+
+        for position, plugin in enumerate(self.plugins):
+            triggers = _get_plugin_triggers(plugin)
+            if triggers is None:
+                self._always.append(position)
+                continue
+            for trigger in triggers:
+                if isinstance(trigger, re.Pattern):
+                    self._regexes.setdefault(position, []).append(trigger)
+                    continue
+                phrase = str(trigger).lower()
+                words = _WORD_RE.findall(phrase)
+                if not words:
+                    continue
+                keyword = max(words, key=len)
+                self.keyword_index.setdefault(keyword, set()).add(position)
+                self._phrases.setdefault(position, []).append(phrase)
+
+    def candidates(self, entrada_usuario):
+        """Devuelve, en orden de carga, los plugins que podrían manejar la entrada."""
+        entrada_lower = entrada_usuario.lower()
+        positions = set(self._always)
+
+        for word in set(_WORD_RE.findall(entrada_lower)):
+            for position in self.keyword_index.get(word, ()):
+                if position not in positions and any(phrase in entrada_lower for phrase in self._phrases[position]):
+                    positions.add(position)
+        for position, regexes in self._regexes.items():
+            if position not in positions and any(regex.search(entrada_lower) for regex in regexes):
+                positions.add(position)
+
+        return [self.plugins[position] for position in sorted(positions)]
+
+class CommandPlugins(list):
+    """Lista de plugins de comando con su índice de despacho precalculado."""
+
+    def __init__(self, plugins=()):
+        super().__init__(plugins)
+        self.dispatch_index = PluginDispatchIndex(self)
+
+def get_plugin_dispatch_index(command_plugins):
+    """Devuelve el índice de despacho de command_plugins (lo construye si es una lista simple)."""
+    index = getattr(command_plugins, "dispatch_index", None)
+    if index is None:
+        index = PluginDispatchIndex(command_plugins)
+    return index
+
+# --- Planificador de comandos programados ---
+stop_timed_commands_thread = threading.Event()
+
+_WEEKDAY_NAMES = {
+    "lunes": 0, "martes": 1, "miércoles": 2, "miercoles": 2, "jueves": 3,
+    "viernes": 4, "sábado": 5, "sabado": 5, "domingo": 6,
+}
+_WEEKDAY_GROUPS = {
+    "laborables": [0, 1, 2, 3, 4],
+    "fin de semana": [5, 6],
+    "fines de semana": [5, 6],
+    "todos": [0, 1, 2, 3, 4, 5, 6],
+}
+
+class CronSchedule:
+    """Expresión cron de cinco campos: minuto hora día-del-mes mes día-de-la-semana.
+
+    Cada campo admite *, valores, rangos a-b, listas a,b y pasos */n o a-b/n.
+    El día de la semana va de 0 (domingo) a 6; 7 también es domingo. Como en
+    cron, si se restringen el día del mes y el de la semana basta con que
+    coincida uno de los dos.
+    """
+
+    _FIELDS = (("minuto", 0, 59), ("hora", 0, 23), ("día", 1, 31), ("mes", 1, 12), ("día de la semana", 0, 7))
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"La expresión cron '{expression}' debe tener 5 campos.")
+        parsed = [self._parse_field(field, *spec) for field, spec in zip(fields, self._FIELDS)]
+        self.minutes, self.hours, self.days, self.months, weekdays = [values for values, _ in parsed]
+        # cron: 0 y 7 son domingo; se pasa a la numeración de Python (lunes = 0)
+        self.weekdays = {(day - 1) % 7 for day in weekdays}
+        self.days_restricted = parsed[2][1]
+        self.weekdays_restricted = parsed[4][1]
+
+    @staticmethod
+    def _parse_field(field, name, low, high):
+        values = set()
+        for part in field.split(","):
+            value_range, _, step = part.partition("/")
+            if value_range == "*":
+                start, end = low, high
+            elif "-" in value_range:
+                start, end = (int(v) for v in value_range.split("-", 1))
+            else:
+                # Como en cron, "a/n" significa desde a hasta el final del campo
+                start = int(value_range)
+                end = high if step else start
+            if not (low <= start <= end <= high):
+                raise ValueError(f"Valor fuera de rango en el campo {name} de cron: '{part}'")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values, field != "*"
+
+    def _day_matches(self, day):
+        day_ok = day.day in self.days
+        weekday_ok = day.weekday() in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def next_after(self, after):
+        """Primer instante estrictamente posterior a after que cumple la expresión."""
+        start = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        day = start.date()
+        # Cinco años cubren cualquier expresión válida (incluido el 29 de febrero)
+        for _ in range(366 * 5):
+            if day.month in self.months and self._day_matches(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = datetime.datetime.combine(day, datetime.time(hour, minute))
+                        if candidate >= start:
+                            return candidate
+            day += datetime.timedelta(days=1)
+        return None
+
+class OneShotSchedule:
+    """Recordatorio que se dispara una sola vez en una fecha y hora concretas."""
+
+    def __init__(self, when):
+        self.when = datetime.datetime.fromisoformat(when) if isinstance(when, str) else when
+
+    def next_after(self, after):
+        return self.when if self.when > after else None
+
+def _parse_weekdays(trigger_days):
+    if isinstance(trigger_days, (str, int)):
+        trigger_days = [trigger_days]
+    weekdays = set()
+    for day in trigger_days:
+        if isinstance(day, int):
+            weekdays.add(day % 7)
+            continue
+        day = day.strip().lower()
+        if day in _WEEKDAY_GROUPS:
+            weekdays.update(_WEEKDAY_GROUPS[day])
+        elif day in _WEEKDAY_NAMES:
+            weekdays.add(_WEEKDAY_NAMES[day])
+        else:
+            raise ValueError(f"Día de la semana desconocido: '{day}'")
+    return weekdays
+
+def parse_command_schedule(command_details):
+    """Devuelve la planificación de un comando (cron, trigger_time/trigger_days o trigger_at) o None."""
+    if command_details.get("cron"):
+        return CronSchedule(command_details["cron"])
+    if command_details.get("trigger_at"):
+        return OneShotSchedule(command_details["trigger_at"])
+    trigger_time = command_details.get("trigger_time")
+    if trigger_time:
+        hour, minute = (int(v) for v in trigger_time.split(":"))
+        weekdays = "*"
+        if command_details.get("trigger_days"):
+            # Numeración de cron: domingo = 0
+            weekdays = ",".join(str((day + 1) % 7) for day in sorted(_parse_weekdays(command_details["trigger_days"])))
+        return CronSchedule(f"{minute} {hour} * * {weekdays}")
+    return None
+
+class CommandScheduler:
+    """Ejecuta los comandos programados a su hora sin sondear.
+
+    Guarda en un montículo el próximo disparo de cada comando y duerme en un
+    Event hasta el más cercano, así que sin comandos pendientes no hay
+    despertares y stop() es inmediato. La última ejecución de cada comando se
+    guarda en state_file: al arrancar se recupera una sola vez lo que se
+    perdió mientras el asistente estaba apagado (si no hace más de
+    catch_up_hours horas).
+    """
+
+    def __init__(self, custom_commands, run_due, state_file=None, catch_up_hours=12, clock=datetime.datetime.now):
+        self.run_due = run_due
+        self.state_file = state_file
+        self.catch_up = datetime.timedelta(hours=catch_up_hours)
+        self.clock = clock
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._heap = []
+        self._seq = itertools.count()
+        self._state = self._load_state()
+        self.reload(custom_commands)
+
+    def _load_state(self):
+        if self.state_file and os.path.exists(self.state_file):
+            try:
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                logging.warning(f"No se pudo leer el estado del planificador ({self.state_file}): {e}")
+        return {}
+
+    def _save_state(self):
+        if not self.state_file:
+            return
+        tmp_path = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._state, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, self.state_file)
+        except OSError as e:
+            logging.error(f"No se pudo guardar el estado del planificador ({self.state_file}): {e}")
+
+    def reload(self, custom_commands):
+        """Recalcula el montículo a partir de un nuevo conjunto de comandos."""
+        now = self.clock()
+        heap = []
+        for command_phrase, command_details in custom_commands.items():
+            try:
+                schedule = parse_command_schedule(command_details)
+            except ValueError as e:
+                logging.error(f"Programación inválida en el comando '{command_phrase}': {e}")
+                continue
+            if schedule is None:
+                continue
+            fire_at = self._first_fire(command_phrase, schedule, now)
+            if fire_at is not None:
+                heap.append((fire_at, next(self._seq), command_phrase, command_details, schedule))
+        with self._lock:
+            # Los plazos registrados con call_at() se conservan
+            heap.extend(entry for entry in self._heap if entry[4] is None)
+            heapq.heapify(heap)
+            self._heap = heap
+        self._wakeup.set()
+
+    def call_at(self, when, callback):
+        """Ejecuta callback() en el hilo del planificador cuando llegue when."""
+        with self._lock:
+            heapq.heappush(self._heap, (when, next(self._seq), None, callback, None))
+        self._wakeup.set()
+
+    def _first_fire(self, command_phrase, schedule, now):
+        last_run = self._state.get(command_phrase)
+        if last_run:
+            # Solo se recupera una ejecución, y solo si cae dentro de la ventana de recuperación
+            since = max(datetime.datetime.fromisoformat(last_run), now - self.catch_up - datetime.timedelta(minutes=1))
+            missed = schedule.next_after(since)
+            if missed is not None and now - self.catch_up <= missed <= now:
+                logging.info(f"Recuperando comando programado perdido: {command_phrase} ({missed:%Y-%m-%d %H:%M})")
+                return missed
+        elif isinstance(schedule, OneShotSchedule) and schedule.when <= now and now - schedule.when <= self.catch_up:
+            return schedule.when
+        return schedule.next_after(now)
+
+    def next_fire_time(self):
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def _pop_due(self, now):
+        due = []
+        callbacks = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, _, command_phrase, command_details, schedule = heapq.heappop(self._heap)
+                if schedule is None:
+                    callbacks.append(command_details)
+                    continue
+                due.append((fire_at, command_phrase, command_details))
+                next_fire = schedule.next_after(max(fire_at, now))
+                if next_fire is not None:
+                    heapq.heappush(self._heap, (next_fire, next(self._seq), command_phrase, command_details, schedule))
+        return due, callbacks
+
+    def run(self):
+        while not self._stopped:
+            self._wakeup.clear()
+            now = self.clock()
+            due, callbacks = self._pop_due(now)
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Error en una tarea del planificador: {e}")
+            if due:
+                for fire_at, command_phrase, _ in due:
+                    logging.info(f"Activando comando por tiempo: {command_phrase} ({fire_at:%Y-%m-%d %H:%M})")
+                    self._state[command_phrase] = fire_at.isoformat()
+                self._save_state()
+                try:
+                    self.run_due([(command_phrase, command_details) for _, command_phrase, command_details in due])
+                except Exception as e:
+                    logging.error(f"Error al ejecutar comandos programados: {e}")
+                continue
+            if callbacks:
+                continue
+            next_fire = self.next_fire_time()
+            timeout = None if next_fire is None else max(0.0, (next_fire - self.clock()).total_seconds())
+            self._wakeup.wait(timeout)
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+# Planificador en marcha (lo crea timed_command_executor)
+command_scheduler = None
+
+def _execute_timed_command(command_phrase, command_details, pending_ha_commands):
+    action_type = command_details.get("action")
+    if action_type == "home_assistant_service":
+        # Los comandos de HA que coinciden en el mismo instante se envían en lote
+        if command_details.get("calls"):
+            futures = [ha_service_batcher.submit(c.get("domain"), c.get("service"), c.get("entity_id"), c.get("data"), c.get("area_id")) for c in command_details["calls"]]
+        else:
+            futures = [ha_service_batcher.submit(command_details.get("domain"), command_details.get("service"), command_details.get("entity_id"), command_details.get("data"), command_details.get("area_id"))]
+        pending_ha_commands.append((command_phrase, futures))
+    elif action_type == "user_data_lookup":
+        key = command_details.get("key")
+        value = get_user_data(key, "no tengo esa información")
+        hablar(f"Tu {key} es {value}.")
+    elif action_type == "user_data_set":
+        key = command_details.get("key")
+        value = command_details.get("value")
+        set_user_data(key, value)
+        hablar(f"He recordado que tu {key} es {value}.")
+    elif action_type == "log_reminder":
+        que = command_details.get("que")
+        cuando = command_details.get("cuando")
+        logging.info(f"RECORDATORIO PROGRAMADO: {que} para {cuando}")
+        hablar(f"Recordatorio programado: {que} para {cuando}")
+    elif action_type == "morning_summary":
+        _morning_summary(command_details.get("timeout", CONFIG["TIMED_ACTION_TIMEOUT"]))
+    elif action_type == "mcp_request":
+        method = command_details.get("method")
+        params = command_details.get("params")
+        result = send_mcp_request(method, params)
+        if result:
+            hablar(f"Comando MCP programado ejecutado: {method}")
+        else:
+            hablar(f"Fallo al ejecutar comando MCP programado: {method}")
+
+def _get_plugin_module(plugin_name):
+    """Devuelve el plugin ya cargado por load_plugins (con sus dependencias inyectadas) o lo importa."""
+    plugin = loaded_plugins.get(plugin_name)
+    if isinstance(plugin, LazyPlugin):
+        plugin = plugin.load()
+    module = plugin or sys.modules.get(plugin_name)
+    if module is None:
+        module = importlib.import_module(f"plugins.{plugin_name}")
+    return module
+
+def _summary_weather():
+    city = get_user_data("default_city")
+    if not city:
+        return None
+    return _get_plugin_module("time_plugin").get_weather(city)
+
+# Partes del resumen matutino: (nombre, función que obtiene el texto, mensaje si falla)
+MORNING_SUMMARY_SOURCES = [
+    ("calendario", lambda: _get_plugin_module("calendar_plugin").list_upcoming_events(), "No pude obtener los eventos del calendario."),
+    ("tareas", lambda: _get_plugin_module("todo_plugin").list_tasks(), "No pude obtener la lista de tareas."),
+    ("tiempo", _summary_weather, "No pude obtener el pronóstico del tiempo."),
+]
+
+def _morning_summary(timeout):
+    """Obtiene a la vez calendario, tareas y tiempo, y los dice en ese orden."""
+    fetcher = ThreadPoolExecutor(max_workers=len(MORNING_SUMMARY_SOURCES), thread_name_prefix="resumen")
+    futures = [(name, fetcher.submit(fetch), error_message) for name, fetch, error_message in MORNING_SUMMARY_SOURCES]
+    fetcher.shutdown(wait=False)
+    deadline = time.monotonic() + timeout
+    hablar("Buenos días. Aquí está tu resumen matutino.")
+    for name, future, error_message in futures:
+        try:
+            text = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except TimeoutError:
+            logging.error(f"El {name} no respondió a tiempo para el resumen ({timeout} s).")
+            hablar(error_message)
+            continue
+        except Exception as e:
+            logging.error(f"Error al obtener {name} para el resumen: {e}")
+            hablar(error_message)
+            continue
+        if text:
+            hablar(text)
+
+# Pool acotado en el que se ejecutan las acciones programadas
+timed_action_executor = ThreadPoolExecutor(max_workers=CONFIG["TIMED_ACTION_WORKERS"], thread_name_prefix="programado")
+
+def _run_ha_timed_commands(pending_ha_commands):
+    ha_service_batcher.flush()
+    for command_phrase, futures in pending_ha_commands:
+        if all(future.result() for future in futures):
+            hablar(f"Comando programado ejecutado: {command_phrase}")
+        else:
+            hablar(f"Fallo al ejecutar comando programado: {command_phrase}")
+
+def _watch_timed_action(command_phrase, future, timeout):
+    """Registra en el planificador el plazo máximo de una acción programada.
+
+    Si al vencer el plazo la acción sigue en la cola se cancela y se avisa del
+    fallo. Si ya se está ejecutando no se puede cancelar, así que se avisa de
+    que sigue en curso y ella misma anunciará su resultado al terminar.
+    """
+    scheduler = command_scheduler
+    if scheduler is None:
+        return
+
+    def check():
+        if future.done():
+            return
+        if future.cancel():
+            logging.error(f"Comando programado '{command_phrase}' cancelado: esperó más de {timeout} s en la cola.")
+            hablar(f"Fallo al ejecutar comando programado: {command_phrase}")
+        else:
+            logging.warning(f"El comando programado '{command_phrase}' superó el tiempo máximo de {timeout} s y sigue en curso.")
+            hablar(f"El comando programado {command_phrase} sigue en curso.")
+
+    scheduler.call_at(scheduler.clock() + datetime.timedelta(seconds=timeout), check)
+
+def _run_due_commands(due_commands):
+    """Reparte las acciones que tocan en el pool sin bloquear al planificador.
+
+    Las de Home Assistant se agrupan en un único lote. Cada acción tiene un
+    plazo (su "timeout" o TIMED_ACTION_TIMEOUT) que vigila el planificador.
+    """
+    pending_ha_commands = []
+    futures = []
+    for command_phrase, command_details in due_commands:
+        if command_details.get("action") == "home_assistant_service":
+            _execute_timed_command(command_phrase, command_details, pending_ha_commands)
+            continue
+        future = timed_action_executor.submit(_execute_timed_command, command_phrase, command_details, [])
+        futures.append(future)
+        _watch_timed_action(command_phrase, future, command_details.get("timeout", CONFIG["TIMED_ACTION_TIMEOUT"]))
+
+    if pending_ha_commands:
+        future = timed_action_executor.submit(_run_ha_timed_commands, pending_ha_commands)
+        futures.append(future)
+        _watch_timed_action(", ".join(phrase for phrase, _ in pending_ha_commands), future, CONFIG["TIMED_ACTION_TIMEOUT"])
+    for future in futures:
+        future.add_done_callback(_log_timed_action_error)
+    return futures
+
+def _log_timed_action_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logging.error(f"Error en un comando programado: {future.exception()}")
+
+def timed_command_executor(custom_commands):
+    global command_scheduler
+    command_scheduler = CommandScheduler(
+        custom_commands,
+        _run_due_commands,
+        CONFIG["SCHEDULER_STATE_FILE"],
+        CONFIG["SCHEDULER_CATCH_UP_HOURS"]
+    )
+    if stop_timed_commands_thread.is_set():
+        return
+    command_scheduler.run()
+
+def stop_timed_commands():
+    """Detiene el planificador al instante, sin esperar al próximo disparo."""
+    stop_timed_commands_thread.set()
+    if command_scheduler is not None:
+        command_scheduler.stop()
+
+# --- Recarga en caliente ---
+
+class FileWatcher:
+    """Vigila archivos y directorios de plugins y avisa de los que cambian.
+
+    Con inotify_simple instalado el hilo duerme hasta que el núcleo notifica un
+    cambio en los directorios vigilados; si no, se despierta cada interval
+    segundos. En ambos casos los cambios se detectan comparando el mtime y el
+    tamaño de los archivos, y se espera debounce segundos sin cambios antes de
+    avisar para no leer un archivo a medio escribir.
+    """
+
+    def __init__(self, paths, on_change, interval=1.0, debounce=0.3, use_inotify=True):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.on_change = on_change
+        self.interval = interval
+        self.debounce = debounce
+        self.use_inotify = use_inotify
+        self._stop = threading.Event()
+        self._inotify = None
+        self._thread = None
+        self._snapshot = self.snapshot()
+
+    def _files(self):
+        for path in self.paths:
+            if os.path.isdir(path):
+                for filename in os.listdir(path):
+                    if filename.endswith(".py") and not filename.startswith("__"):
+                        yield os.path.join(path, filename)
+            else:
+                yield path
+
+    def snapshot(self):
+        snapshot = {}
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+        return snapshot
+
+    def check(self):
+        """Devuelve los archivos creados, modificados o borrados desde la última comprobación."""
+        snapshot = self.snapshot()
+        changed = {path for path in snapshot.keys() | self._snapshot.keys() if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed
+
+    def _open_inotify(self):
+        if not self.use_inotify:
+            return None
+        try:
+            from inotify_simple import INotify, flags
+        except ImportError:
+            logging.info("inotify_simple no está instalado; los cambios se detectarán consultando los archivos periódicamente.")
+            return None
+        inotify = INotify()
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.MOVED_FROM | flags.CREATE | flags.DELETE
+        for directory in {path if os.path.isdir(path) else os.path.dirname(path) for path in self.paths}:
+            try:
+                inotify.add_watch(directory, mask)
+            except OSError as e:
+                logging.warning(f"No se puede vigilar {directory} con inotify ({e}); se consultará periódicamente.")
+                inotify.close()
+                return None
+        return inotify
+
+    def _wait(self):
+        if self._inotify is not None:
+            self._inotify.read(timeout=int(self.interval * 1000))
+        else:
+            self._stop.wait(self.interval)
+
+    def run(self):
+        while not self._stop.is_set():
+            self._wait()
+            changed = self.check()
+            if not changed:
+                continue
+            while not self._stop.wait(self.debounce):
+                more = self.check()
+                if not more:
+                    break
+                changed |= more
+            if self._stop.is_set():
+                return
+            try:
+                self.on_change(changed)
+            except Exception as e:
+                logging.error(f"Error al aplicar los cambios en {', '.join(sorted(changed))}: {e}")
+
+    def start(self):
+        self._inotify = self._open_inotify()
+        self._thread = threading.Thread(target=self.run, name="recarga", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+        if self._inotify is not None:
+            self._inotify.close()
+
+class HotReloader:
+    """Aplica en caliente los cambios de custom_commands.json y de los plugins.
+
+    Cada recarga construye listas y diccionarios nuevos y después sustituye las
+    referencias de la sesión y del planificador: quien esté procesando una
+    entrada termina con los que ya tenía. Solo se vuelven a importar los plugins
+    cuyo archivo ha cambiado. Si el JSON es inválido (p. ej. a medio guardar) se
+    conservan los comandos actuales.
+    """
+
+    def __init__(self, session, commands_file, plugins_dir):
+        self.session = session
+        self.commands_file = os.path.abspath(commands_file)
+        self.plugins_dir = os.path.abspath(plugins_dir)
+        self._lock = threading.Lock()
+
+    def handle_changes(self, paths):
+        paths = {os.path.abspath(path) for path in paths}
+        plugin_names = sorted(
+            os.path.basename(path)[:-3] for path in paths
+            if os.path.dirname(path) == self.plugins_dir and path.endswith(".py")
+        )
+        with self._lock:
+            if self.commands_file in paths:
+                self.reload_custom_commands()
+            if plugin_names:
+                self.reload_plugins(plugin_names)
+
+    def reload_custom_commands(self):
+        try:
+            with open(self.commands_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"No se recargan los comandos personalizados, se mantienen los actuales: {e}")
+            return False
+        if not isinstance(data, dict):
+            logging.warning(f"{self.commands_file} no contiene un objeto JSON; se mantienen los comandos actuales.")
+            return False
+        previous = self.session.custom_commands
+        commands = CustomCommands.reloaded(data, previous if isinstance(previous, CustomCommands) else None)
+        self.session.custom_commands = commands
+        if command_scheduler is not None:
+            command_scheduler.reload(commands)
+        logging.info(f"Comandos personalizados recargados: {len(commands)} comandos.")
+        return True
+
+    def reload_plugins(self, plugin_names):
+        reloaded = {}
+        for name in plugin_names:
+            loaded_plugins.pop(name, None)
+            sys.modules.pop(name, None)
+            filepath = os.path.join(self.plugins_dir, f"{name}.py")
+            if not os.path.exists(filepath):
+                plugin_load_stats.pop(name, None)
+                reloaded[name] = (None, set())
+                logging.info(f"Plugin eliminado: {name}")
+                continue
+            reloaded[name] = _register_plugin(name, filepath)
+            logging.info(f"Plugin recargado: {name}")
+
+        self.session.regular_plugins = self._replace(self.session.regular_plugins, reloaded, {"handle_input", "process_response"})
+        self.session.command_plugins = CommandPlugins(self._replace(self.session.command_plugins, reloaded, {"handle_command"}))
+
+    @staticmethod
+    def _replace(plugins, reloaded, hook_names):
+        """Nueva lista con los plugins recargados en su sitio y los nuevos al final."""
+        result = []
+        for plugin in plugins:
+            name = plugin.__name__
+            if name not in reloaded:
+                result.append(plugin)
+                continue
+            new_plugin, hooks = reloaded[name]
+            if new_plugin is not None and hooks & hook_names:
+                result.append(new_plugin)
+        present = {plugin.__name__ for plugin in plugins}
+        for name, (new_plugin, hooks) in reloaded.items():
+            if name not in present and new_plugin is not None and hooks & hook_names:
+                result.append(new_plugin)
+        return result
+
+# --- Interacción con Gemini CLI ---
+
+def _handle_custom_commands(entrada_usuario, custom_commands, last_executed_command_info):
+    command_handled = False
+
+    match = get_command_router(custom_commands).match(entrada_usuario)
+    if not match:
+        return command_handled, last_executed_command_info
+    command_phrase, command_details, extracted_params, is_pattern = match
+    action_type = command_details.get("action")
+    executed_info = {"type": "custom_command", "phrase": command_phrase, "details": command_details, "params": extracted_params}
+
+    if action_type == "home_assistant_service":
+        if _run_ha_command(command_details, extracted_params if is_pattern else None):
+            hablar(f"Comando personalizado ejecutado: {entrada_usuario if is_pattern else command_phrase}")
+            command_handled = True
+            last_executed_command_info = {**executed_info, "success": True}
+    elif action_type == "user_data_lookup":
+        key = command_details.get("key")
+        value = get_user_data(key, "no tengo esa información")
+        hablar(f"Tu {key} es {value}.")
+        command_handled = True
+        last_executed_command_info = {**executed_info, "success": True}
+    elif action_type == "user_data_set":
+        key = command_details.get("key")
+        if is_pattern:
+            value = extracted_params.get(command_details.get("value_from_input"))
+        else:
+            value = command_details.get("value")
+        if value:
+            set_user_data(key, value)
+            hablar(f"He recordado que tu {key} es {value}.")
+            last_executed_command_info = {**executed_info, "success": True}
+        else:
+            logging.warning(f"No se pudo extraer el valor para {key} del comando: {entrada_usuario}")
+            hablar("Lo siento, no pude entender el valor que quieres que recuerde.")
+            last_executed_command_info = {**executed_info, "success": False, "error": "Value extraction failed"}
+        command_handled = True
+    elif action_type == "log_reminder":
+        source = extracted_params if is_pattern else command_details
+        que = source.get("que")
+        cuando = source.get("cuando")
+        logging.info(f"RECORDATORIO: {que} para {cuando}")
+        hablar(f"Recordatorio creado: {que} para {cuando}")
+        command_handled = True
+        last_executed_command_info = {**executed_info, "success": True}
+    elif action_type == "mcp_request":
+        method = command_details.get("method")
+        params = command_details.get("params")
+        if is_pattern:
+            method = _resolve_command_param(method, extracted_params)
+            if params:
+                params = {p_key: _resolve_command_param(p_value, extracted_params) for p_key, p_value in params.items()}
+            else:
+                params = {}
+        result = send_mcp_request(method, params)
+        if result:
+            hablar(f"Comando MCP ejecutado: {method}")
+            last_executed_command_info = {**executed_info, "success": True, "result_data": result}
+        else:
+            hablar(f"Fallo al ejecutar comando MCP: {method}")
+            last_executed_command_info = {**executed_info, "success": False, "error": "MCP request failed"}
+        command_handled = True
+    return command_handled, last_executed_command_info
+
+_LIST_SEPARATOR_RE = re.compile(r'\s*(?:,|\by\b)\s*', re.IGNORECASE)
+
+def _resolve_ha_targets(value, extracted_params):
+    """Resuelve entity_id/area_id de un comando: valor fijo, lista o plantilla con {parámetro}.
+
+    Si el parámetro dicho por el usuario enumera varios elementos ("cocina y
+    salón", "cocina, baño") la plantilla se aplica a cada uno.
+    """
+    if not value or not extracted_params:
+        return value
+    if isinstance(value, (list, tuple)):
+        resolved = []
+        for item in value:
+            _extend_targets(resolved, _resolve_ha_targets(item, extracted_params))
+        return resolved
+    if not isinstance(value, str):
+        return value
+    names = [name for name in re.findall(r'\{(\w+)\}', value) if extracted_params.get(name)]
+    if not names:
+        return value
+    name = names[0]
+    items = [item for item in _LIST_SEPARATOR_RE.split(extracted_params[name].strip()) if item]
+    # Los identificadores de Home Assistant van en minúsculas y sin espacios
+    resolved = [value.replace("{" + name + "}", item.lower().replace(" ", "_")) for item in items]
+    return resolved[0] if len(resolved) == 1 else resolved
+
+def _run_ha_command(command_details, extracted_params=None):
+    """Ejecuta la acción home_assistant_service de un comando personalizado o programado.
+
+    Admite un único servicio (domain/service con entity_id y/o area_id, que
+    pueden ser listas o "all") o varios en "calls", que se agrupan en una
+    petición por (domain, service).
+    """
+    calls = command_details.get("calls")
+    if calls:
+        calls = [
+            {**call,
+             "entity_id": _resolve_ha_targets(call.get("entity_id"), extracted_params),
+             "area_id": _resolve_ha_targets(call.get("area_id"), extracted_params)}
+            for call in calls
+        ]
+        return call_ha_services(calls)
+
+    entity_id = command_details.get("entity_id")
+    if extracted_params:
+        entity_id = extracted_params.get(command_details.get("entity_id_param", "entity_id"), entity_id)
+    entity_id = _resolve_ha_targets(entity_id, extracted_params)
+    area_id = _resolve_ha_targets(command_details.get("area_id"), extracted_params)
+    if area_id:
+        return call_ha_service(command_details.get("domain"), command_details.get("service"), entity_id, command_details.get("data"), area_id)
+    return call_ha_service(command_details.get("domain"), command_details.get("service"), entity_id, command_details.get("data"))
+
+def _resolve_command_param(value, extracted_params):
+    """Sustituye un valor "{nombre}" por el parámetro extraído de la entrada del usuario."""
+    if isinstance(value, str) and value.startswith("{") and value.endswith("}"):
+        return extracted_params.get(value[1:-1], value)
+    return value
+
+def _handle_command_plugins(entrada_usuario, command_plugins):
+    for plugin in get_plugin_dispatch_index(command_plugins).candidates(entrada_usuario):
+        if hasattr(plugin, 'handle_command'):
+            try:
+                response = plugin.handle_command(entrada_usuario)
                 if response:
                     hablar(response)
                     return True
@@ -597,97 +3292,681 @@ def _handle_regular_plugins_response(respuesta_gemini, regular_plugins):
                 hablar(ERROR_MESSAGES["plugin_error"])
     return respuesta_gemini
 
+def _handle_regular_plugins_response_chunk(chunk, final, regular_plugins):
+    for plugin in regular_plugins:
+        if hasattr(plugin, 'process_response_chunk'):
+            try:
+                chunk = plugin.process_response_chunk(chunk, final)
+            except Exception as e:
+                logging.error(f"Error en plugin {plugin.__name__}.process_response_chunk: {e}")
+                hablar(ERROR_MESSAGES["plugin_error"])
+    return chunk
+
+def _supports_streaming_response(regular_plugins):
+    """Solo se puede hablar en streaming si ningún plugin necesita la respuesta completa."""
+    return all(
+        hasattr(plugin, 'process_response_chunk') or not hasattr(plugin, 'process_response')
+        for plugin in regular_plugins
+    )
+
+def _speak_gemini_stream(gemini_backend, contents, regular_plugins):
+    """Habla la respuesta de Gemini frase a frase mientras se sigue generando.
+
+    Cada frase completa pasa por los hooks process_response_chunk de los plugins
+    y entra en el pipeline TTS en cuanto se cierra. Devuelve (texto, interrumpida):
+    el texto generado (sin procesar por los plugins) y si el usuario cortó la
+    respuesta, en cuyo caso el texto está incompleto.
+    """
+    generated = []
+
+    def fragments():
+        for fragment in gemini_backend.stream(contents):
+            generated.append(fragment)
+            yield fragment
+
+    def chunks():
+        for sentence, final in _sentences_from_stream(fragments()):
+            chunk = _handle_regular_plugins_response_chunk(sentence, final, regular_plugins)
+            if chunk and chunk.strip():
+                yield chunk.strip()
+
+    output = speech_output
+    if output is None:
+        _speak_chunks(chunks())
+        return "".join(generated).strip(), False
+
+    # En el pipeline las frases se encolan y se sigue generando mientras suenan.
+    # Si hay barge-in (cambia la época) se deja de generar.
+    turn_epoch = output.epoch
+    interrupted = False
+    stream = chunks()
+    try:
+        for chunk in stream:
+            if output.epoch != turn_epoch:
+                logging.info("Respuesta de Gemini interrumpida por el usuario.")
+                interrupted = True
+                break
+            output.say_chunk(chunk, turn_epoch)
+    finally:
+        stream.close()
+    return "".join(generated).strip(), interrupted
+
+# --- Historial de conversación ---
+
+def estimate_tokens(text):
+    """Estimación barata de tokens: unos 4 caracteres por token, más un pequeño coste fijo por mensaje."""
+    return math.ceil(len(text) / 4) + 4
+
+def _message_text(message):
+    return " ".join(part.get("text", "") for part in message.get("parts", []))
+
+def _truncate_to_tokens(text, max_tokens):
+    max_chars = max(0, (max_tokens - 4) * 4)
+    return text if len(text) <= max_chars else text[:max_chars].rsplit(" ", 1)[0]
+
+class ConversationHistory(list):
+    """Historial de la conversación (mensajes de Gemini) con un presupuesto de tokens estimados.
+
+    trim() saca los turnos más antiguos, siempre enteros (la pregunta del usuario
+    con su respuesta), hasta que el historial y el resumen caben en max_tokens;
+    el último turno se conserva siempre. Los turnos sacados se resumen con
+    summarize(resumen_anterior, mensajes) en un hilo aparte, fuera del camino de
+    la respuesta, y contents() antepone ese resumen a los turnos recientes. Sin
+    summarize los turnos antiguos simplemente se descartan.
+    """
+
+    def __init__(self, max_tokens=2000, summary_max_tokens=300, summarize=None, background=True):
+        super().__init__()
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.summarize = summarize
+        self.background = background
+        self.summary = ""
+        self._folded = []
+        self._summary_thread = None
+        self._lock = threading.Lock()
+
+    def tokens(self):
+        with self._lock:
+            summary_tokens = estimate_tokens(self.summary) if self.summary else 0
+        return summary_tokens + sum(estimate_tokens(_message_text(message)) for message in self)
+
+    def contents(self):
+        """Mensajes para Gemini: el resumen de los turnos antiguos, si lo hay, y los recientes."""
+        with self._lock:
+            summary = self.summary
+        if not summary:
+            return list(self)
+        return [
+            {"role": "user", "parts": [{"text": f"Resumen de la conversación anterior: {summary}"}]},
+            {"role": "model", "parts": [{"text": "Entendido."}]},
+        ] + list(self)
+
+    def _first_turn_end(self):
+        for index in range(1, len(self)):
+            if self[index]["role"] == "user":
+                return index
+        return None
+
+    def trim(self):
+        """Ajusta el historial al presupuesto y devuelve cuántos mensajes se han sacado."""
+        folded = []
+        while self.tokens() > self.max_tokens:
+            end = self._first_turn_end()
+            if end is None:
+                break
+            folded.extend(self[:end])
+            del self[:end]
+        if folded:
+            logging.info(f"Historial de conversación ajustado a {self.tokens()} tokens estimados; {len(folded)} mensajes pasan al resumen.")
+            self._fold(folded)
+        return len(folded)
+
+    def _fold(self, messages):
+        if self.summarize is None:
+            return
+        with self._lock:
+            self._folded.extend(messages)
+            if self._summary_thread is not None:
+                return
+            if self.background:
+                self._summary_thread = threading.Thread(target=self._summarize_pending, name="resumen-historial", daemon=True)
+                self._summary_thread.start()
+                return
+            self._summary_thread = threading.current_thread()
+        self._summarize_pending()
+
+    def _summarize_pending(self):
+        while True:
+            with self._lock:
+                folded, self._folded = self._folded, []
+                previous = self.summary
+                if not folded:
+                    self._summary_thread = None
+                    return
+            try:
+                summary = self.summarize(previous, folded)
+            except Exception as e:
+                logging.warning(f"No se pudo resumir el historial de conversación: {e}")
+                continue
+            with self._lock:
+                self.summary = _truncate_to_tokens(summary.strip(), self.summary_max_tokens)
+            logging.debug(f"Resumen del historial actualizado: {self.summary}")
+
+    def wait_for_summary(self, timeout=None):
+        thread = self._summary_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+def gemini_history_summarizer(gemini_backend, max_tokens):
+    """Función de resumen para ConversationHistory que usa el propio backend de Gemini."""
+    max_words = max(20, int(max_tokens * 0.6))
+
+    def summarize(previous_summary, messages):
+        lines = [f"Resumen anterior: {previous_summary}"] if previous_summary else []
+        for message in messages:
+            speaker = "Usuario" if message["role"] == "user" else "Asistente"
+            lines.append(f"{speaker}: {_message_text(message)}")
+        prompt = (
+            f"Resume en español, en como máximo {max_words} palabras, esta conversación entre un usuario "
+            "y su asistente de voz. Conserva nombres, datos y peticiones pendientes; responde solo con el resumen.\n\n"
+            + "\n".join(lines)
+        )
+        return gemini_backend.generate([{"role": "user", "parts": [{"text": prompt}]}])
+
+    return summarize
+
+# --- Caché semántica de respuestas de Gemini ---
+
+# Palabras vacías que no cambian el sentido de una pregunta general
+_QUESTION_STOPWORDS = frozenset("""
+    a al algo algun alguna algunos ante bajo con contra de del desde dime el en entre es esta estan este esto
+    explica explicame favor fue fueron ha han hay la las le les lo los me mucho muy o oye para pero podrias
+    por puedes que sabes se ser si sobre son su sus tan te tiene tienen un una unas uno unos y ya cual cuales
+""".split())
+
+# Preguntas cuya respuesta cambia con el tiempo, depende del usuario o de lo hablado antes
+DEFAULT_GEMINI_CACHE_EXCLUDE = (
+    "hoy", "manana", "ayer", "ahora", "hora", "fecha", "dia", "semana", "mes", "tiempo", "clima",
+    "temperatura", "llueve", "noticias", "ultimo", "ultima", "ultimos", "ultimas", "actual", "actualmente",
+    "precio", "cotizacion", "resultado", "partido", "me", "mi", "mis", "yo", "conmigo", "eso", "esto", "ese",
+    "esa", "ella", "ellos", "anterior", "otro", "otra", "no", "vale", "claro", "bueno",
+)
+
+def _strip_accents(text):
+    return "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+
+def normalize_question(text):
+    """Palabras de la pregunta en minúsculas, sin acentos ni signos de puntuación."""
+    return re.findall(r'\w+', _strip_accents(text.lower()))
+
+class GeminiAnswerCache:
+    """Caché local de respuestas de Gemini a preguntas generales que se repiten.
+
+    La pregunta se normaliza (minúsculas, sin acentos, sin palabras vacías) y se
+    busca primero por coincidencia exacta y, si no, por similitud coseno entre
+    vectores TF-IDF de palabras y trigramas de caracteres, comparando solo con
+    las entradas que comparten alguna palabra (índice invertido). Se devuelve la
+    respuesta guardada si la similitud llega a threshold. Las entradas caducan
+    a los ttl segundos y, con db_path, se guardan en SQLite para sobrevivir a
+    los reinicios. No se cachean preguntas que contienen palabras de exclude
+    (dependen de la fecha, del usuario o de la conversación) ni las de menos de tres palabras.
+    """
+
+    def __init__(self, db_path=None, ttl=7 * 24 * 3600, threshold=0.85, max_entries=500,
+                 exclude=DEFAULT_GEMINI_CACHE_EXCLUDE, clock=time.time):
+        self.ttl = ttl
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.exclude = frozenset(_strip_accents(word.lower()) for word in exclude)
+        self.clock = clock
+        self.stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0}
+        self._entries = OrderedDict()
+        self._postings = {}
+        self._document_frequency = Counter()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, question TEXT, answer TEXT, created REAL)")
+            for key, question, answer, created in self._db.execute("SELECT key, question, answer, created FROM answers ORDER BY created"):
+                self._add(key, question, answer, created)
+            self._purge_expired()
+
+    def cacheable(self, question):
+        words = normalize_question(question)
+        return len(words) >= 3 and self._content_words(words) and not any(word in self.exclude for word in words)
+
+    @staticmethod
+    def _content_words(words):
+        return [word for word in words if word not in _QUESTION_STOPWORDS]
+
+    @staticmethod
+    def _features(words):
+        features = Counter(words)
+        for word in words:
+            padded = f"#{word}#"
+            features.update(f"~{padded[i:i + 3]}" for i in range(len(padded) - 2))
+        return features
+
+    def _vector(self, features):
+        total = len(self._entries) + 1
+        vector = {}
+        for feature, count in features.items():
+            idf = math.log(total / (self._document_frequency[feature] + 1)) + 1
+            vector[feature] = (1 + math.log(count)) * idf
+        norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+        return {feature: weight / norm for feature, weight in vector.items()}
+
+    def _add(self, key, question, answer, created):
+        if key in self._entries:
+            self._remove(key)
+        words = key.split()
+        features = self._features(words)
+        self._entries[key] = {"question": question, "answer": answer, "created": created, "features": features}
+        self._document_frequency.update(features.keys())
+        for word in set(words):
+            self._postings.setdefault(word, set()).add(key)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._document_frequency.subtract(entry["features"].keys())
+        for word in set(key.split()):
+            keys = self._postings.get(word)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[word]
+        if self._db is not None:
+            with self._db:
+                self._db.execute("DELETE FROM answers WHERE key = ?", (key,))
+
+    def _purge_expired(self):
+        limit = self.clock() - self.ttl
+        for key in [key for key, entry in self._entries.items() if entry["created"] < limit]:
+            self._remove(key)
+
+    def lookup(self, question):
+        """Devuelve la respuesta guardada para una pregunta igual o parecida, o None."""
+        if not self.cacheable(question):
+            return None
+        key = " ".join(self._content_words(normalize_question(question)))
+        with self._lock:
+            self._purge_expired()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.stats["exact_hits"] += 1
+                return entry["answer"]
+            candidates = set()
+            for word in set(key.split()):
+                candidates.update(self._postings.get(word, ()))
+            best_key, best_score = None, 0.0
+            if candidates:
+                query = self._vector(self._features(key.split()))
+                for candidate in candidates:
+                    vector = self._vector(self._entries[candidate]["features"])
+                    score = sum(weight * vector.get(feature, 0.0) for feature, weight in query.items())
+                    if score > best_score:
+                        best_key, best_score = candidate, score
+            if best_key is not None and best_score >= self.threshold:
+                self.stats["similar_hits"] += 1
+                logging.debug(f"Respuesta en caché para '{question}' (parecida a '{self._entries[best_key]['question']}', similitud {best_score:.2f}).")
+                return self._entries[best_key]["answer"]
+            self.stats["misses"] += 1
+            return None
+
+    def store(self, question, answer):
+        """Guarda la respuesta si la pregunta es cacheable; devuelve si se ha guardado."""
+        if not answer or not self.cacheable(question):
+            return False
+        key = " ".join(self._content_words(normalize_question(question)))
+        created = self.clock()
+        with self._lock:
+            self._add(key, question, answer, created)
+            if self._db is not None:
+                with self._db:
+                    self._db.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)", (key, question, answer, created))
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+        return True
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+def create_gemini_answer_cache(config):
+    if not config["GEMINI_CACHE_ENABLED"]:
+        return None
+    return GeminiAnswerCache(
+        config["GEMINI_CACHE_DB"],
+        config["GEMINI_CACHE_TTL"],
+        config["GEMINI_CACHE_THRESHOLD"],
+        config["GEMINI_CACHE_MAX_ENTRIES"],
+        DEFAULT_GEMINI_CACHE_EXCLUDE + tuple(config["GEMINI_CACHE_EXCLUDE"])
+    )
+
+class AssistantSession:
+    """Estado de la conversación que comparten las etapas del bucle principal."""
+
+    def __init__(self, regular_plugins, command_plugins, custom_commands, gemini_backend, answer_cache=None):
+        self.regular_plugins = regular_plugins
+        self.command_plugins = command_plugins
+        self.custom_commands = custom_commands
+        self.gemini_backend = gemini_backend
+        self.answer_cache = answer_cache
+        # El resumen en segundo plano usa su propio backend para no bloquear el
+        # siguiente turno (p. ej. el trabajador de Gemini atiende una petición cada vez)
+        self.summary_backend = None
+        summarize = None
+        if gemini_backend is not None and CONFIG["HISTORY_SUMMARIZE"]:
+            self.summary_backend = gemini_backend.background_backend()
+            summarize = gemini_history_summarizer(self.summary_backend, CONFIG["HISTORY_SUMMARY_MAX_TOKENS"])
+        self.conversation_history = ConversationHistory(CONFIG["HISTORY_MAX_TOKENS"], CONFIG["HISTORY_SUMMARY_MAX_TOKENS"], summarize)
+        self.last_executed_command_info = {}
+
+    def close(self):
+        if self.summary_backend is not None and self.summary_backend is not self.gemini_backend:
+            self.summary_backend.close()
+
+def _process_utterance(session, entrada_usuario):
+    """Enruta una entrada reconocida: comandos, plugins y, si nadie la maneja, Gemini."""
+    command_handled, session.last_executed_command_info = _handle_custom_commands(entrada_usuario, session.custom_commands, session.last_executed_command_info)
+    if command_handled:
+        return
+
+    command_handled = _handle_command_plugins(entrada_usuario, session.command_plugins)
+    if command_handled:
+        return
+
+    regular_plugins = session.regular_plugins
+    entrada_usuario = _handle_regular_plugins_input(entrada_usuario, regular_plugins)
+    if entrada_usuario is None:
+        return
+
+    conversation_history = session.conversation_history
+    conversation_history.append({"role": "user", "parts": [{"text": entrada_usuario}]})
+
+    streaming = CONFIG["GEMINI_STREAMING"] and _supports_streaming_response(regular_plugins)
+    answer_cache = session.answer_cache
+    cached = answer_cache.lookup(entrada_usuario) if answer_cache is not None else None
+    if cached is not None:
+        logging.info(f"Respuesta de la caché local para: '{entrada_usuario}'")
+        conversation_history.append({"role": "model", "parts": [{"text": cached}]})
+        if streaming:
+            hablar(_handle_regular_plugins_response_chunk(cached, True, regular_plugins))
+        else:
+            hablar(_handle_regular_plugins_response(cached, regular_plugins))
+        conversation_history.trim()
+        return
+
+    logging.debug(f"Enviando a Gemini ({CONFIG['GEMINI_BACKEND']}): '{entrada_usuario}' (con historial)")
+    try:
+        contents = conversation_history.contents()
+        interrupted = False
+        if streaming:
+            respuesta_gemini, interrupted = _speak_gemini_stream(session.gemini_backend, contents, regular_plugins)
+        else:
+            respuesta_gemini = session.gemini_backend.generate(contents)
+        logging.debug(f"Respuesta de Gemini: {respuesta_gemini}")
+
+        if interrupted:
+            # La respuesta está a medias: no se guarda en la caché ni en el
+            # historial, y se quita la pregunta para no dejar un turno cojo.
+            if conversation_history and conversation_history[-1]["role"] == "user":
+                conversation_history.pop()
+            return
+
+        conversation_history.append({"role": "model", "parts": [{"text": respuesta_gemini}]})
+        if answer_cache is not None:
+            answer_cache.store(entrada_usuario, respuesta_gemini)
+        if not streaming:
+            respuesta_gemini = _handle_regular_plugins_response(respuesta_gemini, regular_plugins)
+            hablar(respuesta_gemini)
+        # El resumen de los turnos antiguos se calcula en segundo plano
+        conversation_history.trim()
+
+    except subprocess.CalledProcessError as e:
+        logging.error(f"Error al interactuar con Gemini CLI: {e}")
+        logging.error(f"Salida de error: {e.stderr}")
+        hablar(ERROR_MESSAGES["gemini_cli_error"])
+        if conversation_history and conversation_history[-1]["role"] == "user":
+            conversation_history.pop()
+    except GeminiBackendError as e:
+        logging.error(f"Error en el backend de Gemini: {e}")
+        hablar(ERROR_MESSAGES["gemini_cli_error"])
+        if conversation_history and conversation_history[-1]["role"] == "user":
+            conversation_history.pop()
+    except FileNotFoundError:
+        logging.error(ERROR_MESSAGES["gemini_cli_not_found"])
+        hablar(ERROR_MESSAGES["gemini_cli_not_found"])
+        if conversation_history and conversation_history[-1]["role"] == "user":
+            conversation_history.pop()
+    except Exception as e:
+        logging.error(f"Ocurrió un error inesperado: {e}")
+        hablar(ERROR_MESSAGES["general_unexpected_error"])
+        if conversation_history and conversation_history[-1]["role"] == "user":
+            conversation_history.pop()
+
+def _run_serial_loop(session, audio_handler):
+    """Bucle original: escuchar, reconocer, enrutar, responder y volver a escuchar."""
+    while True:
+        entrada_usuario = audio_handler.escuchar()
+
+        if entrada_usuario.lower() == "salir":
+            hablar("Adiós.")
+            return
+
+        if entrada_usuario:
+            _process_utterance(session, entrada_usuario)
+
+def _run_pipeline(session, audio_handler):
+    """Bucle principal en etapas concurrentes unidas por colas acotadas.
+
+    captura (hilo de ContinuousAudioCapture) -> reconocimiento (hilo propio) ->
+    q_input -> enrutado y generación (este hilo) -> q_output -> síntesis y
+    reproducción (hilos de SpeechOutputStage). El micrófono sigue escuchando
+    mientras se habla y, con BARGE_IN_ENABLED, la voz del usuario corta la respuesta.
+    """
+    global speech_output
+    output = SpeechOutputStage(q_output).start()
+    speech_output = output
+    if CONFIG["BARGE_IN_ENABLED"]:
+        audio_handler.capture.on_barge_in = output.interrupt
+
+    stop_recognition = threading.Event()
+
+    def recognition_stage():
+        while not stop_recognition.is_set():
+            texto = audio_handler.escuchar()
+            if texto:
+                q_input.put(texto)
+
+    threading.Thread(target=recognition_stage, name="reconocimiento", daemon=True).start()
+    try:
+        while True:
+            entrada_usuario = q_input.get()
+            if entrada_usuario.lower() == "salir":
+                hablar("Adiós.")
+                output.wait_until_idle(timeout=10)
+                return
+            _process_utterance(session, entrada_usuario)
+    finally:
+        stop_recognition.set()
+        audio_handler.capture.on_barge_in = None
+        speech_output = None
+        output.stop()
+
+# --- Orquestador de arranque ---
+
+class StartupOrchestrator:
+    """Ejecuta en paralelo las fases independientes del arranque y anota su cronología.
+
+    submit() lanza una fase en el pool y devuelve su Future; mark() anota un hito
+    (p. ej. cuando el asistente empieza a escuchar). timeline() devuelve cuándo
+    empezó y terminó cada fase, en milisegundos desde que se creó el orquestador.
+    """
+
+    def __init__(self, max_workers=6, clock=time.perf_counter):
+        self.clock = clock
+        self._start = clock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="arranque")
+        self._phases = {}
+        self._lock = threading.Lock()
+
+    def elapsed_ms(self):
+        return (self.clock() - self._start) * 1000
+
+    def _record(self, name, **fields):
+        with self._lock:
+            self._phases[name].update(fields)
+
+    def submit(self, name, func, *args, **kwargs):
+        with self._lock:
+            self._phases[name] = {"start": None, "end": None, "status": "pendiente"}
+
+        def run_phase():
+            self._record(name, start=self.elapsed_ms(), status="en curso")
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                self._record(name, end=self.elapsed_ms(), status="error")
+                raise
+            self._record(name, end=self.elapsed_ms(), status="ok")
+            return result
+
+        return self._executor.submit(run_phase)
+
+    def mark(self, name):
+        """Anota un hito y devuelve los milisegundos transcurridos."""
+        now = self.elapsed_ms()
+        with self._lock:
+            self._phases[name] = {"start": now, "end": now, "status": "hito"}
+        return now
+
+    def timeline(self):
+        """Lista de (fase, inicio, fin, estado) ordenada por inicio."""
+        with self._lock:
+            entries = [(name, phase["start"], phase["end"], phase["status"]) for name, phase in self._phases.items()]
+        return sorted(entries, key=lambda entry: math.inf if entry[1] is None else entry[1])
+
+    def format_timeline(self):
+        lines = []
+        for name, start, end, status in self.timeline():
+            if status == "hito":
+                lines.append(f"{start:7.0f} ms  {name}")
+            elif end is not None:
+                lines.append(f"{start:7.0f} ms  {name}: {end - start:.0f} ms" + (" (error)" if status == "error" else ""))
+            else:
+                lines.append(f"{start or 0:7.0f} ms  {name}: {status}")
+        return lines
+
+    def log_timeline(self):
+        logging.info("Cronología de arranque:\n" + "\n".join(self.format_timeline()))
+
+    def shutdown(self):
+        """Deja terminar las fases en segundo plano sin esperarlas."""
+        self._executor.shutdown(wait=False)
+
+def _warm_http_pools():
+    """Abre por adelantado las conexiones con Home Assistant y el servidor MCP configurados."""
+    urls = []
+    if CONFIG["HA_TOKEN"]:
+        urls.append(CONFIG["HA_URL"])
+    if CONFIG["GITHUB_PAT"]:
+        urls.append(CONFIG["MCP_GITHUB_SERVER_URL"])
+    return sum(http_client.warm(url) for url in urls)
+
 def main():
+    global ha_state_cache
     if is_already_running():
         logging.error("El asistente de voz ya se está ejecutando en otra instancia.")
         return
 
     create_lock_file()
-    
+    audio_handler = None
+    gemini_backend = None
+    answer_cache = None
+    file_watcher = None
+    session = None
+    startup = StartupOrchestrator(CONFIG["STARTUP_WORKERS"])
+
     try:
-        if not check_internet_connection():
-            logging.error("No hay conexión a internet. El asistente de voz no puede funcionar.")
+        logging.info("Iniciando asistente de voz. Di 'salir' para terminar.")
+        # Fases necesarias para la primera escucha, en paralelo
+        internet_phase = startup.submit("conectividad", check_internet_connection)
+        audio_phase = startup.submit("micrófono y calibración", AudioInputHandler, CONFIG)
+        plugins_phase = startup.submit("plugins", load_plugins)
+        commands_phase = startup.submit("comandos personalizados", load_custom_commands)
+        gemini_phase = startup.submit("backend de Gemini", create_gemini_backend, CONFIG)
+        answer_cache_phase = startup.submit("caché de respuestas", create_gemini_answer_cache, CONFIG)
+        # Fases en segundo plano: no retrasan la primera escucha
+        startup.submit("importaciones diferidas", preload_deferred_imports)
+        startup.submit("caché TTS", warm_tts_cache, list(ERROR_MESSAGES.values()) + ["Adiós."])
+        startup.submit("conexiones HTTP", _warm_http_pools)
+        if CONFIG["HA_STATE_CACHE"] and CONFIG["HA_TOKEN"]:
+            ha_state_cache = HAStateCache(CONFIG["HA_URL"], CONFIG["HA_TOKEN"], http_client, CONFIG["HA_STATE_MAX_AGE"])
+            startup.submit("estados de Home Assistant", ha_state_cache.start)
+
+        audio_handler = audio_phase.result()
+        if not internet_phase.result():
+            if stt_engine_requires_network(CONFIG):
+                logging.error("No hay conexión a internet. El asistente de voz no puede funcionar.")
+                return
+            logging.warning("No hay conexión a internet. Se continúa con el reconocimiento de voz local.")
+        try:
+            gemini_backend = gemini_phase.result()
+        except GeminiBackendError as e:
+            logging.error(f"No se pudo iniciar el backend de Gemini '{CONFIG['GEMINI_BACKEND']}': {e}")
             return
+        regular_plugins, command_plugins = plugins_phase.result()
+        log_plugin_load_report()
+        custom_commands = commands_phase.result()
+        answer_cache = answer_cache_phase.result()
+        session = AssistantSession(regular_plugins, command_plugins, custom_commands, gemini_backend, answer_cache)
 
-        logging.info("Iniciando asistente de voz. Di 'salir' para terminar.")
-        
-        audio_handler = AudioInputHandler(CONFIG)
-        conversation_history = []
-        regular_plugins, command_plugins = load_plugins()
-        custom_commands = load_custom_commands()
-        last_executed_command_info = {}
-        
         timed_thread = threading.Thread(target=timed_command_executor, args=(custom_commands,))
         timed_thread.daemon = True
         timed_thread.start()
 
-        while True:
-            entrada_usuario = audio_handler.escuchar()
-
-            if entrada_usuario.lower() == "salir":
-                hablar("Adiós.")
-                stop_timed_commands_thread.set()
-                timed_thread.join()
-                break
-
-            if entrada_usuario:
-                command_handled, last_executed_command_info = _handle_custom_commands(entrada_usuario, custom_commands, last_executed_command_info)
-                if command_handled:
-                    continue
-
-                command_handled = _handle_command_plugins(entrada_usuario, command_plugins)
-                if command_handled:
-                    continue
+        if CONFIG["HOT_RELOAD"]:
+            reloader = HotReloader(session, CONFIG["CUSTOM_COMMANDS_FILE"], CONFIG["PLUGINS_DIR"])
+            file_watcher = FileWatcher([CONFIG["CUSTOM_COMMANDS_FILE"], CONFIG["PLUGINS_DIR"]], reloader.handle_changes, CONFIG["HOT_RELOAD_INTERVAL"]).start()
 
-                entrada_usuario = _handle_regular_plugins_input(entrada_usuario, regular_plugins)
-                if entrada_usuario is None:
-                    continue
+        ready_ms = startup.mark("escuchando")
+        logging.info(f"Asistente listo para escuchar en {ready_ms:.0f} ms.")
+        startup.log_timeline()
 
-                conversation_history.append({"role": "user", "parts": [{"text": entrada_usuario}]})
-                
-                payload = {"contents": conversation_history}
-                json_payload = json.dumps(payload)
+        if audio_handler.capture is not None:
+            _run_pipeline(session, audio_handler)
+        else:
+            _run_serial_loop(session, audio_handler)
 
-                logging.debug(f"Enviando a Gemini CLI: '{entrada_usuario}' (con historial)")
-                try:
-                    comando_gemini = ["gemini", "generate-content", "--stdin"]
-                    resultado = subprocess.run(
-                        comando_gemini,
-                        input=json_payload,
-                        capture_output=True,
-                        text=True,
-                        check=True
-                    )
-                    respuesta_gemini = resultado.stdout.strip()
-                    logging.debug(f"Respuesta de Gemini: {respuesta_gemini}")
-
-                    conversation_history.append({"role": "model", "parts": [{"text": respuesta_gemini}]})
-
-                    if len(conversation_history) > CONFIG["MAX_HISTORY_LENGTH"]:
-                        conversation_history = conversation_history[-CONFIG["MAX_HISTORY_LENGTH"]:]
-                        logging.info(f"Historial de conversación truncado a {CONFIG["MAX_HISTORY_LENGTH"]} mensajes.")
-
-                    respuesta_gemini = _handle_regular_plugins_response(respuesta_gemini, regular_plugins)
-                    hablar(respuesta_gemini)
-                    
-                except subprocess.CalledProcessError as e:
-                    logging.error(f"Error al interactuar con Gemini CLI: {e}")
-                    logging.error(f"Salida de error: {e.stderr}")
-                    hablar(ERROR_MESSAGES["gemini_cli_error"])
-                    if conversation_history and conversation_history[-1]["role"] == "user":
-                        conversation_history.pop()
-                except FileNotFoundError:
-                    logging.error(ERROR_MESSAGES["gemini_cli_not_found"])
-                    hablar(ERROR_MESSAGES["gemini_cli_not_found"])
-                    if conversation_history and conversation_history[-1]["role"] == "user":
-                        conversation_history.pop()
-                except Exception as e:
-                    logging.error(f"Ocurrió un error inesperado: {e}")
-                    hablar(ERROR_MESSAGES["general_unexpected_error"])
-                    if conversation_history and conversation_history[-1]["role"] == "user":
-                        conversation_history.pop()
+        stop_timed_commands()
+        timed_thread.join()
     finally:
+        startup.shutdown()
+        if file_watcher is not None:
+            file_watcher.stop()
+        if audio_handler is not None:
+            audio_handler.close()
+        if session is not None:
+            session.close()
+        if gemini_backend is not None:
+            gemini_backend.close()
+        if answer_cache is not None:
+            answer_cache.close()
+        if ha_state_cache is not None:
+            ha_state_cache.stop()
+        timed_action_executor.shutdown(wait=False, cancel_futures=True)
+        if _user_data_store is not None:
+            _user_data_store.close()
+        mcp_client.close()
+        http_client.close()
         remove_lock_file()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # Los plugins que hacen "from asistente_voz import ..." deben usar este mismo
+    # módulo en vez de importar (e inicializar) una segunda copia
+    sys.modules.setdefault("asistente_voz", sys.modules[__name__])
+    main()
@@ -0,0 +1,303 @@
+"""Backends para generar respuestas con Gemini.
+
+Todos los backends reciben la lista de mensajes ("contents") en el formato de la
+API de Gemini y devuelven la respuesta como un iterador de fragmentos de texto:
+
+* CliGeminiBackend: un proceso `gemini generate-content --stdin` por turno (comportamiento original).
+* SubprocessGeminiBackend: un único proceso trabajador de larga duración con el que se habla
+  mediante un protocolo de líneas JSON; evita pagar el arranque del CLI en cada turno.
+* DirectGeminiBackend: llama a la API en el mismo proceso con `google-generativeai`.
+* StubGeminiBackend: respuestas locales deterministas para probar sin red.
+
+Este módulo también es el proceso trabajador: `python gemini_backend.py --worker [--stub]`.
+Protocolo (una línea JSON por mensaje):
+    petición:  {"id": 1, "contents": [...]}
+    respuesta: {"id": 1, "chunk": "..."} ... {"id": 1, "done": true}  o  {"id": 1, "error": "..."}
+"""
+
+import itertools
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+
+
+class GeminiBackendError(Exception):
+    """Error al obtener una respuesta de Gemini."""
+
+
+class GeminiBackend:
+    """Interfaz común de los backends de Gemini."""
+
+    def stream(self, contents):
+        """Devuelve un iterador con los fragmentos de la respuesta a medida que llegan."""
+        raise NotImplementedError
+
+    def generate(self, contents):
+        """Devuelve la respuesta completa."""
+        return "".join(self.stream(contents)).strip()
+
+    def background_backend(self):
+        """Backend para tareas en segundo plano (resúmenes) que no debe hacer esperar a los turnos del usuario.
+
+        Por defecto es el mismo: los backends sin estado compartido atienden varias peticiones a la vez.
+        """
+        return self
+
+    def close(self):
+        pass
+
+
+class CliGeminiBackend(GeminiBackend):
+    """Lanza el CLI de Gemini una vez por turno, como hacía el bucle principal."""
+
+    def __init__(self, command=None):
+        self.command = command or ["gemini", "generate-content", "--stdin"]
+
+    def stream(self, contents):
+        resultado = subprocess.run(
+            self.command,
+            input=json.dumps({"contents": contents}),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        yield resultado.stdout
+
+
+class StubGeminiBackend(GeminiBackend):
+    """Backend local sin red: responde con un texto fijo o con un eco de la última pregunta."""
+
+    def __init__(self, responses=None):
+        self.responses = list(responses) if responses else []
+
+    def stream(self, contents):
+        if self.responses:
+            reply = self.responses.pop(0)
+        else:
+            last_text = ""
+            for message in reversed(contents):
+                if message.get("role") == "user":
+                    last_text = " ".join(part.get("text", "") for part in message.get("parts", []))
+                    break
+            reply = f"Respuesta de prueba a: {last_text}"
+        words = reply.split(" ")
+        for i, word in enumerate(words):
+            yield word if i == len(words) - 1 else word + " "
+
+
+class DirectGeminiBackend(GeminiBackend):
+    """Usa google-generativeai en el mismo proceso; el modelo se crea una sola vez."""
+
+    def __init__(self, model_name, api_key=None):
+        try:
+            import google.generativeai as genai
+        except ImportError as e:
+            raise GeminiBackendError(f"google-generativeai no está instalado: {e}") from e
+        if api_key:
+            genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+
+    def stream(self, contents):
+        try:
+            response = self.model.generate_content(contents, stream=True)
+            for chunk in response:
+                text = getattr(chunk, "text", "")
+                if text:
+                    yield text
+        except Exception as e:
+            raise GeminiBackendError(f"Error en la API de Gemini: {e}") from e
+
+
+class SubprocessGeminiBackend(GeminiBackend):
+    """Mantiene vivo un proceso trabajador y le envía cada turno por stdin.
+
+    Las peticiones se serializan con un lock: el trabajador atiende una cada vez.
+    Si el proceso muere se vuelve a lanzar en la siguiente petición. Un hilo lector
+    pasa su salida a una cola para poder esperar cada mensaje con un plazo
+    (timeout segundos): si el trabajador se cuelga se mata, en vez de bloquear al
+    asistente, y se lanza uno nuevo en la siguiente petición.
+    """
+
+    def __init__(self, command, timeout=60):
+        self.command = command
+        self.timeout = timeout
+        self._process = None
+        self._lines = None
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _ensure_process(self):
+        if self._process is None or self._process.poll() is not None:
+            logging.info(f"Iniciando proceso trabajador de Gemini: {' '.join(self.command)}")
+            self._process = subprocess.Popen(
+                self.command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                encoding="utf-8",
+                bufsize=1
+            )
+            self._lines = queue.Queue()
+            threading.Thread(target=self._read_stdout, args=(self._process, self._lines),
+                             name="gemini-worker-stdout", daemon=True).start()
+        return self._process
+
+    @staticmethod
+    def _read_stdout(process, lines):
+        """Hilo lector: pasa cada línea del trabajador a la cola y None cuando se cierra su salida."""
+        try:
+            for line in process.stdout:
+                lines.put(line)
+        except (OSError, ValueError):
+            pass
+        finally:
+            lines.put(None)
+
+    def _read_message(self, process, lines):
+        """Siguiente mensaje del trabajador, o None si ha terminado.
+
+        Si no llega nada en self.timeout segundos se mata el proceso y se lanza GeminiBackendError.
+        Las líneas que no son mensajes del protocolo (p. ej. algo que imprima una
+        biblioteca en stdout) se registran y se saltan.
+        """
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                line = lines.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                self._kill(process)
+                raise GeminiBackendError(f"El proceso trabajador de Gemini no respondió en {self.timeout} s; se reiniciará.")
+            if line is None:
+                if self._process is process:
+                    self._process = None
+                return None
+            try:
+                message = json.loads(line)
+            except json.JSONDecodeError:
+                message = None
+            if isinstance(message, dict):
+                return message
+            logging.warning(f"Línea inesperada del proceso trabajador de Gemini, se ignora: {line.strip()}")
+
+    def _kill(self, process):
+        if self._process is process:
+            self._process = None
+        if process.poll() is None:
+            logging.warning("Matando el proceso trabajador de Gemini.")
+            process.kill()
+
+    def stream(self, contents):
+        with self._lock:
+            process = self._ensure_process()
+            lines = self._lines
+            request_id = next(self._ids)
+            try:
+                process.stdin.write(json.dumps({"id": request_id, "contents": contents}) + "\n")
+                process.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                self._process = None
+                raise GeminiBackendError(f"El proceso trabajador de Gemini no acepta peticiones: {e}") from e
+
+            finished = False
+            try:
+                while True:
+                    message = self._read_message(process, lines)
+                    if message is None:
+                        raise GeminiBackendError("El proceso trabajador de Gemini terminó inesperadamente.")
+                    if message.get("id") != request_id:
+                        continue
+                    if "error" in message:
+                        finished = True
+                        raise GeminiBackendError(message["error"])
+                    if message.get("done"):
+                        finished = True
+                        return
+                    yield message.get("chunk", "")
+            finally:
+                # Si quien consume abandona el iterador a mitad, se descarta el
+                # resto de la respuesta para dejar el protocolo sincronizado.
+                if not finished and self._process is process:
+                    self._drain(process, lines, request_id)
+
+    def _drain(self, process, lines, request_id):
+        while True:
+            try:
+                message = self._read_message(process, lines)
+            except GeminiBackendError as e:
+                # Se está cerrando un stream abandonado: basta con haber matado al trabajador
+                logging.warning(f"No se pudo descartar el resto de la respuesta de Gemini: {e}")
+                return
+            if message is None:
+                return
+            if message.get("id") == request_id and ("done" in message or "error" in message):
+                return
+
+    def background_backend(self):
+        """Un trabajador aparte (se lanza al primer uso): este atiende una petición cada vez."""
+        return SubprocessGeminiBackend(self.command, self.timeout)
+
+    def close(self):
+        process = self._process
+        self._process = None
+        if process and process.poll() is None:
+            try:
+                process.stdin.close()
+                process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+
+
+def create_gemini_backend(config):
+    """Crea el backend indicado por config["GEMINI_BACKEND"]: cli, worker, direct o stub."""
+    backend_name = config.get("GEMINI_BACKEND", "cli")
+    if backend_name == "cli":
+        return CliGeminiBackend()
+    if backend_name == "worker":
+        command = config.get("GEMINI_WORKER_COMMAND") or [sys.executable, os.path.abspath(__file__), "--worker"]
+        return SubprocessGeminiBackend(command, config.get("GEMINI_WORKER_TIMEOUT", 60))
+    if backend_name == "direct":
+        return DirectGeminiBackend(config.get("GEMINI_MODEL", "gemini-1.5-flash"), config.get("GEMINI_API_KEY"))
+    if backend_name == "stub":
+        return StubGeminiBackend()
+    raise GeminiBackendError(f"Backend de Gemini desconocido: {backend_name}")
+
+
+def run_worker(backend, stdin=sys.stdin, stdout=sys.stdout):
+    """Atiende peticiones del protocolo de líneas JSON hasta que se cierre stdin."""
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            stdout.write(json.dumps({"id": None, "error": f"Petición inválida: {e}"}) + "\n")
+            stdout.flush()
+            continue
+        request_id = request.get("id")
+        try:
+            for chunk in backend.stream(request.get("contents", [])):
+                stdout.write(json.dumps({"id": request_id, "chunk": chunk}) + "\n")
+                stdout.flush()
+            stdout.write(json.dumps({"id": request_id, "done": True}) + "\n")
+        except Exception as e:
+            stdout.write(json.dumps({"id": request_id, "error": str(e)}) + "\n")
+        stdout.flush()
+
+
+if __name__ == "__main__":
+    if "--worker" not in sys.argv:
+        sys.exit("Uso: python gemini_backend.py --worker [--stub]")
+    if "--stub" in sys.argv:
+        worker_backend = StubGeminiBackend()
+    else:
+        worker_backend = DirectGeminiBackend(
+            os.getenv("GEMINI_MODEL", "gemini-1.5-flash"),
+            os.getenv("GEMINI_API_KEY") or os.getenv("GOOGLE_API_KEY")
+        )
+    run_worker(worker_backend)
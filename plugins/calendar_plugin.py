@@ -17,8 +17,12 @@ SCOPES = ["https://www.googleapis.com/auth/calendar.readonly", "https://www.goog
 CREDENTIALS_FILE = os.getenv("GOOGLE_CREDENTIALS_FILE", "/data/data/com.termux/files/home/agp/credentials.json")
 TOKEN_FILE = os.getenv("GOOGLE_TOKEN_FILE", "/data/data/com.termux/files/home/agp/token.json")
 
+# Frases que activan handle_command (usadas por el índice de despacho)
+TRIGGERS = ["cuáles son mis próximos eventos", "qué tengo en mi calendario"]
+
 # Injected by the main script
 hablar = print
+response_cache = None
 logging.basicConfig(level=logging.INFO)
 
 
@@ -74,9 +78,9 @@ def list_upcoming_events():
     if not service:
         return "El servicio de calendario no está disponible."
 
-    now = datetime.datetime.utcnow().isoformat() + "Z"  # 'Z' indica UTC
-    try:
-        events_result = (
+    def fetch():
+        now = datetime.datetime.utcnow().isoformat() + "Z"  # 'Z' indica UTC
+        return (
             service.events()
             .list(
                 calendarId="primary",
@@ -87,6 +91,12 @@ def list_upcoming_events():
             )
             .execute()
         )
+
+    try:
+        if response_cache is not None:
+            events_result = response_cache.get_or_fetch("calendar.events.list", {"calendarId": "primary", "maxResults": 10}, fetch)
+        else:
+            events_result = fetch()
         events = events_result.get("items", [])
 
         if not events:
@@ -132,6 +142,8 @@ def create_event(summary, start_time_str, end_time_str=None):
         }
 
         created_event = service.events().insert(calendarId='primary', body=event).execute()
+        if response_cache is not None:
+            response_cache.invalidate_after_write("calendar.events.insert")
         return f"Evento creado: {created_event.get('htmlLink')}"
 
     except (HttpError, ValueError) as error:
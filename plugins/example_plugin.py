@@ -1,6 +1,8 @@
 """Plugin de ejemplo para demostrar la funcionalidad de los plugins.
 
-Este plugin intercepta la entrada del usuario y procesa la respuesta de Gemini.
+Este plugin intercepta la entrada del usuario y procesa la respuesta de Gemini,
+tanto completa (process_response) como frase a frase en modo streaming
+(process_response_chunk).
 """
 
 import logging
@@ -21,4 +23,14 @@ def process_response(text):
     Añade un sufijo a la respuesta para indicar que ha sido procesada por el plugin.
     """
     logging.info("Plugin de ejemplo: Procesando respuesta de Gemini.")
-    return f"{text} (procesado por plugin)"
\ No newline at end of file
+    return f"{text} (procesado por plugin)"
+
+def process_response_chunk(text, final):
+    """Procesa la respuesta de Gemini frase a frase cuando se habla en streaming.
+
+    Se llama con cada frase completa y una última vez con final=True; el sufijo
+    solo se añade al final para que el resultado sea el mismo que con process_response.
+    """
+    if final:
+        return f"{text} (procesado por plugin)"
+    return text
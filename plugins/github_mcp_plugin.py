@@ -4,7 +4,10 @@ Permite al asistente realizar acciones como listar Pull Requests, Issues y crear
 """
 
 import logging
-from asistente_voz import hablar, ERROR_MESSAGES, send_mcp_request
+from asistente_voz import hablar, ERROR_MESSAGES, send_mcp_request, send_mcp_requests
+
+# Frases que activan handle_command (usadas por el índice de despacho)
+TRIGGERS = ["resumen de github", "lista mis pull requests abiertos", "lista mis issues abiertos", "crea un issue en", "comenta en el issue"]
 
 def handle_command(text):
     """Maneja comandos relacionados con GitHub.
@@ -17,6 +20,31 @@ def handle_command(text):
     """
     text_lower = text.lower()
 
+    # Resumen: pull requests e issues abiertos en un único lote JSON-RPC
+    if "resumen de github" in text_lower:
+        logging.info("Comando 'resumen de github' detectado. Consultando PRs e issues en paralelo...")
+        try:
+            pull_requests, issues = send_mcp_requests([
+                ("github.pull_requests.list", {"state": "open"}),
+                ("github.issues.list", {"state": "open"}),
+            ])
+            if pull_requests is None and issues is None:
+                return True
+            if pull_requests is not None:
+                pull_requests = pull_requests.get("pull_requests") or []
+                hablar(f"Tienes {len(pull_requests)} pull requests abiertos.")
+                if pull_requests:
+                    hablar(structured_data=pull_requests)
+            if issues is not None:
+                issues = issues.get("issues") or []
+                hablar(f"Tienes {len(issues)} issues abiertos.")
+                if issues:
+                    hablar(structured_data=issues)
+        except Exception as e:
+            logging.error(f"Error al procesar el resumen de GitHub: {e}. Mensaje: {ERROR_MESSAGES["plugin_error"]}")
+            hablar(ERROR_MESSAGES["plugin_error"])
+        return True
+
     # Ejemplo: Listar Pull Requests abiertos
     if "lista mis pull requests abiertos" in text_lower:
         logging.info("Comando 'lista mis pull requests abiertos' detectado. Consultando MCP de GitHub...")
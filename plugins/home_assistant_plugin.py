@@ -6,6 +6,9 @@ Permite al asistente controlar dispositivos y obtener estados de Home Assistant.
 import logging
 from asistente_voz import hablar, ERROR_MESSAGES, call_ha_service, get_ha_state # Importar funciones de HA
 
+# Frases que activan handle_command (usadas por el índice de despacho)
+TRIGGERS = ["enciende la luz de la sala", "apaga la luz de la sala", "cuál es la temperatura de la sala"]
+
 def handle_command(text):
     """Maneja comandos relacionados con Home Assistant.
 
@@ -8,10 +8,16 @@ import logging
 import os
 from asistente_voz import hablar, ERROR_MESSAGES
 
+# Cliente HTTP con conexiones reutilizables (inyectado por el script principal)
+http_client = requests
+
 # Configura tu URL de Webhook de n8n aquí
 # Puedes obtenerla al crear un nodo 'Webhook' en n8n y configurarlo en modo 'POST'
 N8N_WEBHOOK_URL = os.getenv("N8N_WEBHOOK_URL", "TU_URL_DE_WEBHOOK_N8N_AQUI")
 
+# Frases que activan handle_command (usadas por el índice de despacho)
+TRIGGERS = ["activar automatización de prueba"]
+
 def handle_command(text):
     """Maneja comandos relacionados con la activación de webhooks de n8n.
 
@@ -26,7 +32,7 @@ def handle_command(text):
     if "activar automatización de prueba" in text_lower:
         logging.info("Comando 'activar automatización de prueba' detectado. Enviando a n8n...")
         try:
-            response = requests.post(N8N_WEBHOOK_URL, json={"command": "activar_automatizacion_prueba", "original_text": text})
+            response = http_client.post(N8N_WEBHOOK_URL, json={"command": "activar_automatizacion_prueba", "original_text": text})
             response.raise_for_status() # Lanza una excepción para códigos de estado HTTP erróneos
             hablar("Automatización de prueba activada en n8n.")
             logging.info(f"Respuesta de n8n: {response.status_code} - {response.text}")
@@ -18,10 +18,15 @@ load_dotenv()
 hablar = print
 load_user_data = lambda: {}
 save_user_data = lambda data: None
+http_client = requests
+response_cache = None
 # ----------------------------------------------------------------------
 
 OPENWEATHERMAP_API_KEY = os.getenv("OPENWEATHERMAP_API_KEY")
 
+# Frases que activan handle_command (usadas por el índice de despacho)
+TRIGGERS = ["dime la hora", "qué tiempo hace"]
+
 def get_weather(city):
     """Obtiene el pronóstico del tiempo para una ciudad usando OpenWeatherMap."""
     if not OPENWEATHERMAP_API_KEY or OPENWEATHERMAP_API_KEY == "TU_API_KEY_DE_OPENWEATHERMAP_AQUI":
@@ -34,10 +39,17 @@ def get_weather(city):
         "units": "metric", # Usar grados Celsius
         "lang": "es"
     }
-    try:
-        response = requests.get(base_url, params=params)
+    def fetch():
+        response = http_client.get(base_url, params=params)
         response.raise_for_status() # Lanza un error para respuestas 4xx/5xx
-        data = response.json()
+        return response.json()
+
+    try:
+        # El pronóstico se reutiliza unos minutos para no agotar el límite de la API
+        if response_cache is not None:
+            data = response_cache.get_or_fetch("weather.current", {"city": city.lower()}, fetch)
+        else:
+            data = fetch()
 
         description = data['weather'][0]['description']
         temp = data['main']['temp']
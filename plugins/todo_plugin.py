@@ -1,65 +1,327 @@
+import bisect
+import datetime
 import json
+import logging
 import os
+import re
+import threading
 from dotenv import load_dotenv
 
 load_dotenv()
 
 TASKS_FILE = os.getenv("TASKS_FILE", "/data/data/com.termux/files/home/agp/tareas.json")
+# Registro de eventos (una línea JSON por alta o completado); por defecto junto a TASKS_FILE
+TASKS_LOG_FILE = os.getenv("TASKS_LOG_FILE", "")
+
+# Frases que activan handle_command (usadas por el índice de despacho)
+TRIGGERS = ["agrega a mi lista de tareas", "cuáles son mis tareas", "lista de tareas", "completa la tarea número"]
+
+PRIORITIES = {"alta": 0, "media": 1, "baja": 2}
+_PRIORITY_NAMES = {value: name for name, value in PRIORITIES.items()}
+DEFAULT_PRIORITY = PRIORITIES["media"]
+
+_MONTHS = {
+    "enero": 1, "febrero": 2, "marzo": 3, "abril": 4, "mayo": 5, "junio": 6, "julio": 7,
+    "agosto": 8, "septiembre": 9, "setiembre": 9, "octubre": 10, "noviembre": 11, "diciembre": 12,
+}
+_PRIORITY_RE = re.compile(r'\s+con prioridad (alta|media|baja)\b', re.IGNORECASE)
+_DUE_RE = re.compile(r'\s+para (hoy|mañana|pasado mañana|el \d{1,2} de \w+|\d{4}-\d{2}-\d{2})$', re.IGNORECASE)
+
+
+class TaskStore:
+    """Tareas guardadas como registro de eventos JSONL con índices en memoria.
+
+    Cada alta o completado añade una línea al registro en vez de reescribir el
+    archivo. En memoria se mantiene un índice por id y una lista ordenada de
+    pendientes (por prioridad, fecha límite y antigüedad) que se actualiza con
+    búsqueda binaria, así que ni completar ni buscar la tarea n-ésima obliga a
+    ordenar ni copiar la lista. Si otro proceso modifica el archivo (cambia
+    su mtime o su tamaño) se leen solo las líneas nuevas, o todo si se ha
+    reescrito. Cuando el registro acumula demasiadas líneas se compacta a una
+    línea por tarea. Un tareas.json antiguo se migra la primera vez.
+    """
+
+    COMPACT_MIN_LINES = 100
+
+    def __init__(self, log_path, legacy_json_path=None):
+        self.log_path = log_path
+        self._lock = threading.RLock()
+        self._tasks = {}
+        self._pending = {}
+        self._pending_order = []
+        self._next_id = 1
+        self._lines = 0
+        self._offset = 0
+        self._stat = None
+        if not os.path.exists(log_path) and legacy_json_path and os.path.exists(legacy_json_path):
+            self._migrate_json(legacy_json_path)
+        self._refresh()
+
+    def _migrate_json(self, json_path):
+        try:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                legacy_tasks = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"No se pudo migrar {json_path}: {e}")
+            return
+        if not isinstance(legacy_tasks, list):
+            logging.warning(f"No se pudo migrar {json_path}: no contiene una lista de tareas.")
+            return
+        migrated = 0
+        with open(self.log_path, 'w', encoding='utf-8') as f:
+            for position, task in enumerate(legacy_tasks, 1):
+                if not isinstance(task, dict) or not isinstance(task.get("description"), str) or not task["description"].strip():
+                    logging.warning(f"Tarea {position} de {json_path} sin descripción válida, no se migra: {task!r}")
+                    continue
+                migrated += 1
+                f.write(json.dumps(self._task_record(migrated, task["description"], completed=bool(task.get("completed", False))), ensure_ascii=False) + "\n")
+        os.replace(json_path, f"{json_path}.migrated")
+        logging.info(f"Tareas migradas de {json_path} a {self.log_path} ({migrated} de {len(legacy_tasks)} tareas).")
+
+    @staticmethod
+    def _sort_key(task):
+        return (task["priority"], task["due"] or "9999-12-31", task["id"])
+
+    def _add_pending(self, task):
+        bisect.insort(self._pending_order, self._sort_key(task))
+        self._pending[task["id"]] = task
+
+    def _remove_pending(self, task_id):
+        task = self._pending.pop(task_id, None)
+        if task is None:
+            return
+        key = self._sort_key(task)
+        index = bisect.bisect_left(self._pending_order, key)
+        if index < len(self._pending_order) and self._pending_order[index] == key:
+            del self._pending_order[index]
+
+    @staticmethod
+    def _task_record(task_id, description, due=None, priority=DEFAULT_PRIORITY, completed=False):
+        return {"op": "add", "id": task_id, "description": description, "due": due, "priority": priority, "completed": completed}
+
+    def _file_stat(self):
+        try:
+            stat = os.stat(self.log_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _reset(self):
+        self._tasks = {}
+        self._pending = {}
+        self._pending_order = []
+        self._next_id = 1
+        self._lines = 0
+        self._offset = 0
+
+    def _refresh(self):
+        """Relee el registro si ha cambiado en disco desde la última vez."""
+        stat = self._file_stat()
+        if stat == self._stat:
+            return
+        if stat is None:
+            self._reset()
+            self._stat = None
+            return
+        if self._stat is None or stat[0] != self._stat[0] or stat[1] < self._offset:
+            self._reset()
+        with open(self.log_path, 'r', encoding='utf-8') as f:
+            f.seek(self._offset)
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # línea a medio escribir: se leerá en la próxima actualización
+                self._offset += len(line.encode('utf-8'))
+                if line.strip():
+                    try:
+                        self._apply(json.loads(line))
+                    except (ValueError, KeyError, TypeError) as e:
+                        logging.warning(f"Línea inválida en {self.log_path}, se ignora ({e}): {line.strip()}")
+        self._stat = self._file_stat()
+
+    def _apply(self, event):
+        task_id = event["id"]
+        if event["op"] == "add":
+            task = {key: event.get(key) for key in ("id", "description", "due", "priority", "completed")}
+            task["priority"] = DEFAULT_PRIORITY if task["priority"] is None else task["priority"]
+            next_id = max(self._next_id, task_id + 1)
+            self._remove_pending(task_id)
+            self._tasks[task_id] = task
+            if not task["completed"]:
+                self._add_pending(task)
+            self._next_id = next_id
+        elif event["op"] == "complete" and task_id in self._tasks:
+            self._tasks[task_id]["completed"] = True
+            self._remove_pending(task_id)
+        self._lines += 1
+
+    def _append(self, event):
+        with open(self.log_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self._apply(event)
+        self._offset = os.path.getsize(self.log_path)
+        self._stat = self._file_stat()
+        # Cada línea de más respecto al número de tareas es un completado ya aplicado
+        if self._lines - len(self._tasks) >= max(self.COMPACT_MIN_LINES, len(self._tasks) // 2):
+            self.compact()
+
+    def add(self, description, due=None, priority=DEFAULT_PRIORITY):
+        with self._lock:
+            self._refresh()
+            event = self._task_record(self._next_id, description, due, priority)
+            self._append(event)
+            return dict(self._tasks[event["id"]])
+
+    def complete(self, task_id):
+        """Marca como completada la tarea con ese id. Devuelve la tarea o None si no está pendiente."""
+        with self._lock:
+            self._refresh()
+            task = self._pending.get(task_id)
+            if task is None:
+                return None
+            self._append({"op": "complete", "id": task_id})
+            return dict(task)
+
+    def pending(self):
+        """Tareas pendientes ordenadas por prioridad, fecha límite y antigüedad."""
+        with self._lock:
+            self._refresh()
+            return [dict(self._pending[key[-1]]) for key in self._pending_order]
+
+    def pending_at(self, position):
+        """Tarea pendiente en la posición (empezando en 1) que se le dijo al usuario."""
+        with self._lock:
+            self._refresh()
+            if 1 <= position <= len(self._pending_order):
+                return dict(self._pending[self._pending_order[position - 1][-1]])
+            return None
+
+    def all(self):
+        with self._lock:
+            self._refresh()
+            return [dict(task) for task in self._tasks.values()]
+
+    def replace_all(self, tasks):
+        """Sustituye todas las tareas (lista de dicts con description y completed)."""
+        with self._lock:
+            records = [
+                self._task_record(task.get("id") or index, task["description"], task.get("due"), task.get("priority", DEFAULT_PRIORITY), task.get("completed", False))
+                for index, task in enumerate(tasks, 1)
+            ]
+            self._rewrite(records)
+
+    def compact(self):
+        """Reescribe el registro con una sola línea por tarea."""
+        with self._lock:
+            self._refresh()
+            self._rewrite([self._task_record(task["id"], task["description"], task["due"], task["priority"], task["completed"]) for task in self._tasks.values()])
+            logging.info(f"Registro de tareas compactado: {len(self._tasks)} tareas.")
+
+    def _rewrite(self, records):
+        tmp_path = f"{self.log_path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.log_path)
+        self._stat = None
+        self._refresh()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """Devuelve el almacén de tareas para TASKS_FILE/TASKS_LOG_FILE, creándolo la primera vez."""
+    global _store
+    log_path = TASKS_LOG_FILE or os.path.splitext(TASKS_FILE)[0] + ".jsonl"
+    with _store_lock:
+        if _store is None or _store.log_path != log_path:
+            _store = TaskStore(log_path, TASKS_FILE)
+        return _store
 
 def get_tasks():
-    """Carga las tareas desde el archivo JSON."""
-    if not os.path.exists(TASKS_FILE):
-        return []
-    try:
-        with open(TASKS_FILE, 'r') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return []
+    """Devuelve todas las tareas (pendientes y completadas)."""
+    return get_store().all()
 
 def save_tasks(tasks):
-    """Guarda las tareas en el archivo JSON."""
-    with open(TASKS_FILE, 'w') as f:
-        json.dump(tasks, f, indent=4)
+    """Sustituye todas las tareas."""
+    get_store().replace_all(tasks)
+
+def _parse_due(text, today=None):
+    today = today or datetime.date.today()
+    text = text.lower()
+    if text == "hoy":
+        return today.isoformat()
+    if text == "mañana":
+        return (today + datetime.timedelta(days=1)).isoformat()
+    if text == "pasado mañana":
+        return (today + datetime.timedelta(days=2)).isoformat()
+    match = re.match(r'el (\d{1,2}) de (\w+)', text)
+    if match and match.group(2) in _MONTHS:
+        try:
+            due = datetime.date(today.year, _MONTHS[match.group(2)], int(match.group(1)))
+            if due < today:
+                due = due.replace(year=today.year + 1)
+        except ValueError:
+            return None
+        return due.isoformat()
+    try:
+        return datetime.date.fromisoformat(text).isoformat()
+    except ValueError:
+        return None
+
+def _parse_task(text, today=None):
+    """Separa de la descripción la prioridad ("con prioridad alta") y la fecha ("para mañana")."""
+    priority = DEFAULT_PRIORITY
+    match = _PRIORITY_RE.search(text)
+    if match:
+        priority = PRIORITIES[match.group(1).lower()]
+        text = text[:match.start()] + text[match.end():]
+    due = None
+    match = _DUE_RE.search(text.strip())
+    if match:
+        due = _parse_due(match.group(1), today)
+        if due:
+            text = text.strip()[:match.start()]
+    return text.strip(), due, priority
 
 def add_task(task_description):
     """Añade una nueva tarea a la lista."""
     if not task_description:
         return "No puedes agregar una tarea vacía."
-    tasks = get_tasks()
-    tasks.append({"description": task_description, "completed": False})
-    save_tasks(tasks)
-    return f"Tarea añadida: '{task_description}'"
+    description, due, priority = _parse_task(task_description)
+    if not description:
+        return "No puedes agregar una tarea vacía."
+    get_store().add(description, due, priority)
+    return f"Tarea añadida: '{description}'"
+
+def _describe(task):
+    details = []
+    if task["due"]:
+        details.append(f"para el {task['due']}")
+    if task["priority"] != DEFAULT_PRIORITY:
+        details.append(f"prioridad {_PRIORITY_NAMES[task['priority']]}")
+    return f"{task['description']} ({', '.join(details)})" if details else task["description"]
 
 def list_tasks():
     """Muestra la lista de tareas pendientes."""
-    tasks = get_tasks()
-    pending_tasks = [task for task in tasks if not task["completed"]]
+    pending_tasks = get_store().pending()
     if not pending_tasks:
         return "No tienes tareas pendientes."
-    
+
     response = "Tus tareas pendientes son:\n"
     for i, task in enumerate(pending_tasks, 1):
-        response += f"{i}. {task['description']}\n"
+        response += f"{i}. {_describe(task)}\n"
     return response
 
 def complete_task(task_number):
     """Marca una tarea como completada."""
     try:
-        task_index = int(task_number) - 1
-        tasks = get_tasks()
-        pending_tasks = [task for task in tasks if not task["completed"]]
-        
-        if 0 <= task_index < len(pending_tasks):
-            # Find the actual index in the main tasks list
-            task_to_complete = pending_tasks[task_index]
-            for task in tasks:
-                if task["description"] == task_to_complete["description"] and not task["completed"]:
-                    task["completed"] = True
-                    break
-            save_tasks(tasks)
-            return f"Tarea '{task_to_complete['description']}' marcada como completada."
-        else:
+        store = get_store()
+        task = store.pending_at(int(task_number))
+        if task is None:
             return "Número de tarea inválido."
+        store.complete(task["id"])
+        return f"Tarea '{task['description']}' marcada como completada."
     except ValueError:
         return "Por favor, di un número de tarea válido."
 
@@ -74,4 +336,3 @@ def handle_command(command):
         task_num = command.split("completa la tarea número")[-1].strip()
         return complete_task(task_num)
     return None
-
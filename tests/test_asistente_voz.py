@@ -1,8 +1,25 @@
 import unittest
-from unittest.mock import patch, mock_open, MagicMock
+from unittest.mock import patch, mock_open, MagicMock, call
 import os
 import json
 import sys
+import re
+import types
+import io
+import tempfile
+import array
+import queue
+import importlib.util
+import time
+import subprocess
+import math
+import wave
+import datetime
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pydub import AudioSegment
+import speech_recognition as sr
 import requests # Added for mocking requests
 
 # Añadir el directorio padre al path para poder importar asistente_voz
@@ -23,27 +40,91 @@ from asistente_voz import (
     _handle_command_plugins,
     _handle_regular_plugins_input,
     _handle_regular_plugins_response,
-    ERROR_MESSAGES
+    ERROR_MESSAGES,
+    CommandRouter,
+    CustomCommands,
+    get_command_router,
+    PluginDispatchIndex,
+    CommandPlugins,
+    _split_into_chunks,
+    _speak_chunks,
+    _synthesize_chunk,
+    TTSCache,
+    warm_tts_cache,
+    GeminiBackendError,
+    CliGeminiBackend,
+    SubprocessGeminiBackend,
+    StubGeminiBackend,
+    create_gemini_backend,
+    _sentences_from_stream,
+    _supports_streaming_response,
+    _speak_gemini_stream,
+    GoogleSpeechEngine,
+    VoskSpeechEngine,
+    FallbackSpeechEngine,
+    create_stt_engine,
+    UtteranceSegmenter,
+    ContinuousAudioCapture,
+    ActivityFlag,
+    BargeInDetector,
+    SpeechOutputStage,
+    AssistantSession,
+    _process_utterance,
+    HttpClient,
+    HAStateCache,
+    HAServiceBatcher,
+    call_ha_services,
+    MCPClient,
+    MCPError,
+    send_mcp_requests,
+    ResponseCache,
+    CronSchedule,
+    CommandScheduler,
+    parse_command_schedule,
+    _morning_summary,
+    _run_due_commands,
+    _watch_timed_action,
+    UserDataStore,
+    get_user_data_store,
+    read_plugin_manifest,
+    LazyPlugin,
+    plugin_load_report,
+    FileWatcher,
+    HotReloader,
+    StartupOrchestrator,
+    _DeferredImport,
+    NoiseFloorTracker,
+    VoskKeywordSpotter,
+    WakeWordGate,
+    create_wake_word_gate,
+    load_wav_audio,
+    AudioInputHandler,
+    ConversationHistory,
+    gemini_history_summarizer,
+    estimate_tokens,
+    GeminiAnswerCache,
+    _frame_rms
 )
+from gemini_backend import run_worker
 
 class TestAsistenteVoz(unittest.TestCase):
 
     def setUp(self):
-        # Configurar un entorno de prueba limpio para cada test
-        self.user_data_file = 'test_user_data.json'
-        self.custom_commands_file = 'test_custom_commands.json'
-        # Asegurarse de que los archivos de prueba no existan antes de cada test
-        if os.path.exists(self.user_data_file):
-            os.remove(self.user_data_file)
-        if os.path.exists(self.custom_commands_file):
-            os.remove(self.custom_commands_file)
-
-        # Parchear las rutas de los archivos en el módulo asistente_voz
-        # para que apunten a nuestros archivos de prueba
-        self.patcher_user_data_file = patch('asistente_voz.USER_DATA_FILE', self.user_data_file)
-        self.patcher_custom_commands_file = patch('asistente_voz.CUSTOM_COMMANDS_FILE', self.custom_commands_file)
-        self.mock_user_data_file = self.patcher_user_data_file.start()
-        self.mock_custom_commands_file = self.patcher_custom_commands_file.start()
+        # Configurar un entorno de prueba limpio para cada test: los archivos de
+        # datos viven en un directorio temporal y CONFIG apunta a ellos
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.user_data_file = os.path.join(self.tmpdir.name, 'test_user_data.json')
+        self.user_data_db = os.path.join(self.tmpdir.name, 'test_user_data.db')
+        self.custom_commands_file = os.path.join(self.tmpdir.name, 'test_custom_commands.json')
+
+        self.patcher_config = patch.dict('asistente_voz.CONFIG', {
+            "USER_DATA_FILE": self.user_data_file,
+            "USER_DATA_DB": self.user_data_db,
+            "CUSTOM_COMMANDS_FILE": self.custom_commands_file,
+        })
+        self.patcher_config.start()
+        self.patcher_user_data_store = patch('asistente_voz._user_data_store', None)
+        self.patcher_user_data_store.start()
 
         # Mockear la función hablar para evitar la salida de voz durante los tests
         self.patcher_hablar = patch('asistente_voz.hablar')
@@ -59,16 +140,16 @@ class TestAsistenteVoz(unittest.TestCase):
 
     def tearDown(self):
         # Limpiar después de cada test
-        if os.path.exists(self.user_data_file):
-            os.remove(self.user_data_file)
-        if os.path.exists(self.custom_commands_file):
-            os.remove(self.custom_commands_file)
-        self.patcher_user_data_file.stop()
-        self.patcher_custom_commands_file.stop()
+        import asistente_voz
+        if asistente_voz._user_data_store is not None:
+            asistente_voz._user_data_store.close()
+        self.patcher_user_data_store.stop()
+        self.patcher_config.stop()
         self.patcher_hablar.stop()
         self.patcher_logging_warning.stop()
         self.patcher_logging_error.stop()
         self.patcher_logging_info.stop()
+        self.tmpdir.cleanup()
 
     # --- Tests para load_user_data y save_user_data ---
     def test_load_user_data_file_not_exists(self):
@@ -77,21 +158,25 @@ class TestAsistenteVoz(unittest.TestCase):
     def test_save_user_data(self):
         data = {"name": "Test", "age": 30}
         save_user_data(data)
-        with open(self.user_data_file, 'r') as f:
-            self.assertEqual(json.load(f), data)
+        get_user_data_store().close()
+        store = UserDataStore(self.user_data_db)
+        self.addCleanup(store.close)
+        self.assertEqual(store.all(), data)
 
     def test_load_user_data_file_exists(self):
         data = {"name": "Test", "city": "Example"}
         with open(self.user_data_file, 'w') as f:
             json.dump(data, f)
         self.assertEqual(load_user_data(), data)
+        self.assertTrue(os.path.exists(self.user_data_file + ".migrated"))
 
     def test_load_user_data_corrupt_file(self):
         with open(self.user_data_file, 'w') as f:
             f.write("{\"name\": \"Test\",}") # JSON inválido
         self.assertEqual(load_user_data(), {})
-        self.mock_logging_warning.assert_called_with(ERROR_MESSAGES["user_data_corrupt"].format(USER_DATA_FILE=self.user_data_file))
+        self.assertIn(f"Archivo de datos de usuario corrupto: {self.user_data_file}", self.mock_logging_warning.call_args[0][0])
         self.mock_hablar.assert_called_with(ERROR_MESSAGES["user_data_corrupt"])
+        self.assertTrue(os.path.exists(self.user_data_file + ".corrupt"))
 
     # --- Tests para load_custom_commands ---
     def test_load_custom_commands_file_not_exists(self):
@@ -107,7 +192,7 @@ class TestAsistenteVoz(unittest.TestCase):
         with open(self.custom_commands_file, 'w') as f:
             f.write("{\"command\": \"invalid\",}") # JSON inválido
         self.assertEqual(load_custom_commands(), {})
-        self.mock_logging_warning.assert_called_with(ERROR_MESSAGES["custom_commands_corrupt"])
+        self.mock_logging_warning.assert_called_with(f"Archivo de comandos personalizados corrupto: {self.custom_commands_file}. Se ignorará.")
         self.mock_hablar.assert_called_with(ERROR_MESSAGES["custom_commands_corrupt"])
 
     # --- Tests para _format_structured_data ---
@@ -138,74 +223,67 @@ class TestAsistenteVoz(unittest.TestCase):
 
     # --- Tests para hablar ---
     @patch('asistente_voz.gTTS')
-    @patch('asistente_voz.AudioSegment.from_mp3')
+    @patch('asistente_voz.AudioSegment.from_file')
     @patch('asistente_voz.play')
-    @patch('os.remove')
-    def test_hablar_text(self, mock_os_remove, mock_play, mock_from_mp3, mock_gTTS):
+    def test_hablar_text(self, mock_play, mock_from_file, mock_gTTS):
         mock_tts_instance = MagicMock()
         mock_gTTS.return_value = mock_tts_instance
-        mock_from_mp3.return_value = MagicMock() # Mock the sound object
+        mock_from_file.return_value = MagicMock() # Mock the sound object
 
         hablar("Hola mundo")
 
         mock_gTTS.assert_called_once_with(text="Hola mundo", lang='es')
-        mock_tts_instance.save.assert_called_once_with("respuesta_gemini.mp3")
-        mock_from_mp3.assert_called_once_with("respuesta_gemini.mp3")
+        mock_tts_instance.write_to_fp.assert_called_once()
+        mock_from_file.assert_called_once()
         mock_play.assert_called_once()
-        mock_os_remove.assert_called_once_with("respuesta_gemini.mp3")
-        self.mock_logging_info.assert_called_with("Gemini dice: Hola mundo")
+        self.mock_logging_info.assert_called_with("Reproducción de audio completada.")
 
     @patch('asistente_voz.gTTS')
-    @patch('asistente_voz.AudioSegment.from_mp3')
+    @patch('asistente_voz.AudioSegment.from_file')
     @patch('asistente_voz.play')
-    @patch('os.remove')
-    def test_hablar_structured_data(self, mock_os_remove, mock_play, mock_from_mp3, mock_gTTS):
+    def test_hablar_structured_data(self, mock_play, mock_from_file, mock_gTTS):
         mock_tts_instance = MagicMock()
         mock_gTTS.return_value = mock_tts_instance
-        mock_from_mp3.return_value = MagicMock()
+        mock_from_file.return_value = MagicMock()
 
         data = [{"title": "Tarea 1"}]
         hablar(structured_data=data)
 
         mock_gTTS.assert_called_once_with(text="Aquí tienes los elementos: 1. Tarea 1", lang='es')
-        mock_tts_instance.save.assert_called_once_with("respuesta_gemini.mp3")
-        mock_from_mp3.assert_called_once_with("respuesta_gemini.mp3")
+        mock_tts_instance.write_to_fp.assert_called_once()
+        mock_from_file.assert_called_once()
         mock_play.assert_called_once()
-        mock_os_remove.assert_called_once_with("respuesta_gemini.mp3")
-        self.mock_logging_info.assert_called_with("Gemini dice: Aquí tienes los elementos: 1. Tarea 1")
+        self.mock_logging_info.assert_any_call("Intentando decir: 'Aquí tienes los elementos: 1. Tarea 1'")
 
     @patch('asistente_voz.gTTS')
-    @patch('asistente_voz.AudioSegment.from_mp3')
+    @patch('asistente_voz.AudioSegment.from_file')
     @patch('asistente_voz.play')
-    @patch('os.remove')
-    def test_hablar_tts_save_error(self, mock_os_remove, mock_play, mock_from_mp3, mock_gTTS):
+    @patch('logging.critical')
+    def test_hablar_tts_save_error(self, mock_logging_critical, mock_play, mock_from_file, mock_gTTS):
         mock_gTTS.side_effect = Exception("Save error")
 
         hablar("Hola")
 
-        self.mock_logging_error.assert_called_with("Error al reproducir o guardar el audio: Save error")
-        self.mock_hablar.assert_called_with(ERROR_MESSAGES["tts_save_error"])
-        mock_os_remove.assert_not_called()
+        mock_logging_critical.assert_called_once()
+        mock_from_file.assert_not_called()
         mock_play.assert_not_called()
 
     @patch('asistente_voz.gTTS')
-    @patch('asistente_voz.AudioSegment.from_mp3')
+    @patch('asistente_voz.AudioSegment.from_file')
     @patch('asistente_voz.play')
-    @patch('os.remove')
-    def test_hablar_playback_error(self, mock_os_remove, mock_play, mock_from_mp3, mock_gTTS):
+    def test_hablar_playback_error(self, mock_play, mock_from_file, mock_gTTS):
         mock_tts_instance = MagicMock()
         mock_gTTS.return_value = mock_tts_instance
-        mock_from_mp3.side_effect = Exception("Playback error")
+        mock_from_file.return_value = MagicMock()
+        mock_play.side_effect = Exception("Playback error")
 
         hablar("Hola")
 
-        self.mock_logging_error.assert_called_with("Error al intentar reproducir audio con pydub: Playback error")
-        self.mock_hablar.assert_called_with(ERROR_MESSAGES["tts_playback_error"])
-        mock_os_remove.assert_called_once_with("respuesta_gemini.mp3") # Should still try to remove
-        mock_play.assert_not_called()
+        self.mock_logging_error.assert_called_once()
+        self.assertIn("Playback error", self.mock_logging_error.call_args[0][0])
 
     # --- Tests para call_ha_service ---
-    @patch('requests.post')
+    @patch('asistente_voz.http_client.post')
     def test_call_ha_service_success(self, mock_post):
         mock_response = MagicMock()
         mock_response.raise_for_status.return_value = None
@@ -216,7 +294,7 @@ class TestAsistenteVoz(unittest.TestCase):
         mock_post.assert_called_once()
         self.mock_logging_info.assert_called_with("Llamada a HA exitosa: light.turn_on para light.test_light")
 
-    @patch('requests.post')
+    @patch('asistente_voz.http_client.post')
     def test_call_ha_service_failure(self, mock_post):
         mock_post.side_effect = requests.exceptions.RequestException("HA error")
 
@@ -226,7 +304,7 @@ class TestAsistenteVoz(unittest.TestCase):
         self.mock_hablar.assert_called_with(ERROR_MESSAGES["ha_service_failed"])
 
     # --- Tests para get_ha_state ---
-    @patch('requests.get')
+    @patch('asistente_voz.http_client.get')
     def test_get_ha_state_success(self, mock_get):
         mock_response = MagicMock()
         mock_response.raise_for_status.return_value = None
@@ -238,7 +316,7 @@ class TestAsistenteVoz(unittest.TestCase):
         mock_get.assert_called_once()
         self.mock_logging_info.assert_called_with("Estado de HA obtenido para sensor.test: 25")
 
-    @patch('requests.get')
+    @patch('asistente_voz.http_client.get')
     def test_get_ha_state_failure(self, mock_get):
         mock_get.side_effect = requests.exceptions.RequestException("State error")
 
@@ -248,7 +326,7 @@ class TestAsistenteVoz(unittest.TestCase):
         self.mock_hablar.assert_called_with(ERROR_MESSAGES["ha_state_failed"])
 
     # --- Tests para send_mcp_request ---
-    @patch('requests.post')
+    @patch('asistente_voz.http_client.post')
     def test_send_mcp_request_success(self, mock_post):
         mock_response = MagicMock()
         mock_response.raise_for_status.return_value = None
@@ -260,7 +338,7 @@ class TestAsistenteVoz(unittest.TestCase):
         mock_post.assert_called_once()
         self.mock_logging_info.assert_called_with("Solicitud MCP exitosa para método test.method")
 
-    @patch('requests.post')
+    @patch('asistente_voz.http_client.post')
     def test_send_mcp_request_mcp_error_response(self, mock_post):
         mock_response = MagicMock()
         mock_response.raise_for_status.return_value = None
@@ -272,7 +350,7 @@ class TestAsistenteVoz(unittest.TestCase):
         self.mock_logging_error.assert_called_with("Error en la respuesta del servidor MCP: {'code': -32601, 'message': 'Method not found'}")
         self.mock_hablar.assert_called_with(ERROR_MESSAGES["mcp_request_failed"])
 
-    @patch('requests.post')
+    @patch('asistente_voz.http_client.post')
     def test_send_mcp_request_network_error(self, mock_post):
         mock_post.side_effect = requests.exceptions.RequestException("Network error")
 
@@ -344,7 +422,7 @@ class TestAsistenteVoz(unittest.TestCase):
         command_handled, info = _handle_custom_commands(entrada, custom_commands, {})
         self.assertTrue(command_handled)
         mock_call_ha_service.assert_called_with("light", "turn_on", "la cocina", None)
-        self.mock_hablar.assert_called_with("Comando personalizado ejecutado: enciende la luz de {entidad}")
+        self.mock_hablar.assert_called_with("Comando personalizado ejecutado: enciende la luz de la cocina")
         self.assertTrue(info["success"])
 
     def test_handle_custom_commands_user_data_lookup(self):
@@ -354,7 +432,7 @@ class TestAsistenteVoz(unittest.TestCase):
                 "key": "nombre_usuario"
             }
         }
-        with patch('asistente_voz.load_user_data', return_value={'nombre_usuario': 'Juan'}):
+        with patch('asistente_voz.get_user_data', side_effect=lambda key, default=None: {'nombre_usuario': 'Juan'}.get(key, default)):
             command_handled, info = _handle_custom_commands("cual es mi nombre", custom_commands, {})
             self.assertTrue(command_handled)
             self.mock_hablar.assert_called_with("Tu nombre_usuario es Juan.")
@@ -368,11 +446,10 @@ class TestAsistenteVoz(unittest.TestCase):
                 "value_from_input": "nombre"
             }
         }
-        with patch('asistente_voz.load_user_data', return_value={}), \
-             patch('asistente_voz.save_user_data') as mock_save_user_data:
+        with patch('asistente_voz.set_user_data') as mock_set_user_data:
             command_handled, info = _handle_custom_commands("recuerda que mi nombre es Pedro", custom_commands, {})
             self.assertTrue(command_handled)
-            mock_save_user_data.assert_called_once_with({'nombre_usuario': 'Pedro'})
+            mock_set_user_data.assert_called_once_with('nombre_usuario', 'Pedro')
             self.mock_hablar.assert_called_with("He recordado que tu nombre_usuario es Pedro.")
             self.assertTrue(info["success"])
 
@@ -428,6 +505,7 @@ class TestAsistenteVoz(unittest.TestCase):
 
     def test_handle_command_plugins_error(self):
         mock_plugin = MagicMock()
+        mock_plugin.__name__ = "MagicMock"
         mock_plugin.handle_command.side_effect = Exception("Plugin error")
         command_plugins = [mock_plugin]
         self.assertFalse(_handle_command_plugins("test command", command_plugins))
@@ -437,6 +515,7 @@ class TestAsistenteVoz(unittest.TestCase):
     # --- Tests para _handle_regular_plugins_input ---
     def test_handle_regular_plugins_input_consumed(self):
         mock_plugin = MagicMock()
+        mock_plugin.__name__ = "MagicMock"
         mock_plugin.handle_input.return_value = None
         regular_plugins = [mock_plugin]
         self.assertIsNone(_handle_regular_plugins_input("test input", regular_plugins))
@@ -452,6 +531,7 @@ class TestAsistenteVoz(unittest.TestCase):
 
     def test_handle_regular_plugins_input_error(self):
         mock_plugin = MagicMock()
+        mock_plugin.__name__ = "MagicMock"
         mock_plugin.handle_input.side_effect = Exception("Input plugin error")
         regular_plugins = [mock_plugin]
         self.assertEqual(_handle_regular_plugins_input("test input", regular_plugins), "test input")
@@ -468,11 +548,1958 @@ class TestAsistenteVoz(unittest.TestCase):
 
     def test_handle_regular_plugins_response_error(self):
         mock_plugin = MagicMock()
+        mock_plugin.__name__ = "MagicMock"
         mock_plugin.process_response.side_effect = Exception("Response plugin error")
         regular_plugins = [mock_plugin]
         self.assertEqual(_handle_regular_plugins_response("test response", regular_plugins), "test response")
         self.mock_logging_error.assert_called_with("Error en plugin MagicMock.process_response: Response plugin error")
         self.mock_hablar.assert_called_with(ERROR_MESSAGES["plugin_error"])
 
+class TestCommandRouter(unittest.TestCase):
+
+    def setUp(self):
+        self.patcher_hablar = patch('asistente_voz.hablar')
+        self.mock_hablar = self.patcher_hablar.start()
+
+    def tearDown(self):
+        self.patcher_hablar.stop()
+
+    def test_literal_match_is_case_insensitive(self):
+        router = CommandRouter({"Enciende mis luces": {"action": "home_assistant_service"}})
+        phrase, details, params, is_pattern = router.match("enciende MIS luces")
+        self.assertEqual(phrase, "Enciende mis luces")
+        self.assertEqual(params, {})
+        self.assertFalse(is_pattern)
+
+    def test_template_and_regex_phrases_share_group_names(self):
+        router = CommandRouter({
+            "enciende la luz de {entidad}": {"action": "a"},
+            "apaga la luz de (?P<entidad>.*)": {"action": "b", "regex": True},
+        })
+        self.assertEqual(router.match("enciende la luz de la cocina")[2], {"entidad": "la cocina"})
+        phrase, details, params, is_pattern = router.match("apaga la luz de la sala")
+        self.assertEqual(details, {"action": "b", "regex": True})
+        self.assertEqual(params, {"entidad": "la sala"})
+        self.assertTrue(is_pattern)
+
+    def test_file_order_decides_between_literal_and_pattern(self):
+        router = CommandRouter({
+            "recuerda {algo}": {"action": "pattern"},
+            "recuerda esto": {"action": "literal"},
+        })
+        self.assertEqual(router.match("recuerda esto")[1], {"action": "pattern"})
+
+    def test_params_keep_original_case(self):
+        router = CommandRouter({"Recuerda que mi nombre es {nombre}": {"action": "user_data_set"}})
+        self.assertEqual(router.match("recuerda que mi nombre es Pedro")[2], {"nombre": "Pedro"})
+
+    def test_regex_phrases_need_explicit_opt_in(self):
+        router = CommandRouter({"enciende la luz de (?P<entidad>.*)": {"action": "home_assistant_service"}})
+        self.assertIsNone(router.match("enciende la luz de la sala"))
+        self.assertEqual(len(router), 0)
+
+    @patch('asistente_voz.call_ha_service', return_value=True)
+    def test_pattern_command_announces_spoken_phrase(self, mock_call_ha_service):
+        commands = CustomCommands({"enciende la luz de {entidad}": {
+            "action": "home_assistant_service", "domain": "light", "service": "turn_on",
+            "entity_id": "light.{entidad}"}})
+        handled, _ = _handle_custom_commands("enciende la luz de cocina", commands, {})
+        self.assertTrue(handled)
+        mock_call_ha_service.assert_called_with("light", "turn_on", "light.cocina", None)
+        self.mock_hablar.assert_called_with("Comando personalizado ejecutado: enciende la luz de cocina")
+
+    def test_no_match_returns_none(self):
+        router = CommandRouter({"cual es mi nombre": {"action": "user_data_lookup"}})
+        self.assertIsNone(router.match("cual es mi edad"))
+
+    def test_invalid_pattern_is_skipped(self):
+        with patch('logging.warning') as mock_warning:
+            router = CommandRouter({"(?P<roto>[": {"action": "a", "regex": True}, "hola": {"action": "b"}})
+        mock_warning.assert_called_once()
+        self.assertEqual(router.match("hola")[1], {"action": "b"})
+
+    def test_custom_commands_compiles_router_once(self):
+        commands = CustomCommands({"crear recordatorio (?P<que>.*) para (?P<cuando>.*)": {"action": "log_reminder", "regex": True}})
+        self.assertIs(get_command_router(commands), commands.router)
+        with patch('logging.info'):
+            handled, info = _handle_custom_commands("crear recordatorio pan para hoy", commands, {})
+        self.assertTrue(handled)
+        self.assertEqual(info["params"], {"que": "pan", "cuando": "hoy"})
+        self.mock_hablar.assert_called_with("Recordatorio creado: pan para hoy")
+
+class TestPluginDispatchIndex(unittest.TestCase):
+
+    def _plugin(self, name, triggers=None, response=None):
+        plugin = types.SimpleNamespace(__name__=name, handle_command=MagicMock(return_value=response))
+        if triggers is not None:
+            plugin.TRIGGERS = triggers
+        return plugin
+
+    def test_only_matching_plugins_are_candidates(self):
+        hora = self._plugin("time_plugin", ["dime la hora"])
+        tareas = self._plugin("todo_plugin", ["lista de tareas"])
+        index = PluginDispatchIndex([hora, tareas])
+        self.assertEqual(index.candidates("Dime la hora por favor"), [hora])
+        self.assertEqual(index.candidates("hola"), [])
+
+    def test_plugins_without_triggers_are_always_candidates_in_load_order(self):
+        legacy = self._plugin("legacy")
+        hora = self._plugin("time_plugin", ["dime la hora"])
+        index = PluginDispatchIndex([hora, legacy])
+        self.assertEqual(index.candidates("dime la hora"), [hora, legacy])
+        self.assertEqual(index.candidates("otra cosa"), [legacy])
+
+    def test_regex_triggers(self):
+        issue = self._plugin("github", [re.compile(r"comenta en el issue \d+")])
+        index = PluginDispatchIndex([issue])
+        self.assertEqual(index.candidates("comenta en el issue 12 del repositorio x con hola"), [issue])
+        self.assertEqual(index.candidates("comenta en el issue"), [])
+
+    @patch('asistente_voz.hablar')
+    def test_handle_command_plugins_skips_non_candidates(self, mock_hablar):
+        hora = self._plugin("time_plugin", ["dime la hora"], response="Son las 10:00")
+        tareas = self._plugin("todo_plugin", ["lista de tareas"])
+        self.assertTrue(_handle_command_plugins("dime la hora", CommandPlugins([tareas, hora])))
+        tareas.handle_command.assert_not_called()
+        hora.handle_command.assert_called_once_with("dime la hora")
+        mock_hablar.assert_called_once_with("Son las 10:00")
+
+class TestSpeechPipeline(unittest.TestCase):
+
+    def test_split_into_chunks_by_sentence(self):
+        texto = "Hola, soy tu asistente de voz. Hoy hace sol en Madrid! ¿Quieres algo más?"
+        self.assertEqual(_split_into_chunks(texto), [
+            "Hola, soy tu asistente de voz.",
+            "Hoy hace sol en Madrid!",
+            "¿Quieres algo más?",
+        ])
+
+    def test_split_into_chunks_merges_short_pieces(self):
+        self.assertEqual(_split_into_chunks("Sí. Claro. Enseguida lo hago por ti."), ["Sí. Claro. Enseguida lo hago por ti."])
+
+    def test_split_into_chunks_cuts_long_sentences_at_commas(self):
+        clause = "una parte bastante larga de la frase"
+        texto = ", ".join([clause] * 10) + "."
+        chunks = _split_into_chunks(texto)
+        self.assertGreater(len(chunks), 1)
+        self.assertTrue(all(len(chunk) <= 200 for chunk in chunks))
+        self.assertEqual(" ".join(chunks), texto)
+
+    @patch('asistente_voz.play')
+    @patch('asistente_voz._synthesize_chunk')
+    def test_speak_chunks_plays_in_order(self, mock_synthesize, mock_play):
+        mock_synthesize.side_effect = lambda chunk: f"audio:{chunk}"
+        with patch('logging.info'):
+            _speak_chunks(iter(["uno", "dos", "tres"]))
+        self.assertEqual([c.args[0] for c in mock_play.call_args_list], ["audio:uno", "audio:dos", "audio:tres"])
+
+    @patch('asistente_voz.play')
+    @patch('asistente_voz._synthesize_chunk')
+    def test_speak_chunks_stops_on_synthesis_failure(self, mock_synthesize, mock_play):
+        mock_synthesize.side_effect = ["audio:uno", Exception("sin red"), "audio:tres"]
+        with patch('logging.critical'), patch('logging.info'):
+            _speak_chunks(["uno", "dos", "tres"])
+        mock_play.assert_called_once_with("audio:uno")
+
+class TestTTSCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, "tts_cache")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_put_and_get_roundtrip(self):
+        cache = TTSCache(self.cache_dir, 10 * 1024 * 1024)
+        cache.put("Adiós.", "es", AudioSegment.silent(duration=200))
+        self.assertTrue(cache.contains("Adiós.", "es"))
+        self.assertFalse(cache.contains("Adiós.", "en"))
+        self.assertEqual(len(cache.get("Adiós.", "es")), 200)
+        # Una instancia nueva reconstruye el índice desde el disco
+        self.assertIsNotNone(TTSCache(self.cache_dir, 10 * 1024 * 1024).get("Adiós.", "es"))
+
+    def test_lru_eviction_respects_size_cap(self):
+        sound = AudioSegment.silent(duration=500)
+        entry_size = len(sound.export(io.BytesIO(), format="wav").getvalue())
+        cache = TTSCache(self.cache_dir, entry_size * 2 + 10)
+        cache.put("uno", "es", sound)
+        cache.put("dos", "es", sound)
+        cache.get("uno", "es")
+        cache.put("tres", "es", sound)
+        self.assertTrue(cache.contains("uno", "es"))
+        self.assertFalse(cache.contains("dos", "es"))
+        self.assertTrue(cache.contains("tres", "es"))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    @patch('asistente_voz.gTTS')
+    @patch('asistente_voz.AudioSegment.from_file')
+    def test_synthesize_chunk_uses_cache(self, mock_from_file, mock_gTTS):
+        cache = TTSCache(self.cache_dir, 10 * 1024 * 1024)
+        cache.put("No pude entender.", "es", AudioSegment.silent(duration=100))
+        cached_sound = MagicMock()
+        mock_from_file.return_value = cached_sound
+        with patch('asistente_voz.TTS_CACHE', cache):
+            self.assertIs(_synthesize_chunk("No pude entender."), cached_sound)
+        mock_gTTS.assert_not_called()
+
+    @patch('asistente_voz._synthesize_chunk')
+    def test_warm_tts_cache_skips_cached_chunks(self, mock_synthesize):
+        cache = TTSCache(self.cache_dir, 10 * 1024 * 1024)
+        cache.put("Lo siento, ocurrió un error inesperado.", "es", AudioSegment.silent(duration=100))
+        with patch('asistente_voz.TTS_CACHE', cache), patch('logging.info'):
+            warmed = warm_tts_cache(["Lo siento, ocurrió un error inesperado.", "Adiós a todos los presentes."])
+        self.assertEqual(warmed, 1)
+        mock_synthesize.assert_called_once_with("Adiós a todos los presentes.")
+
+class TestGeminiBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.contents = [{"role": "user", "parts": [{"text": "hola gemini"}]}]
+
+    def test_stub_backend_streams_words(self):
+        backend = StubGeminiBackend()
+        chunks = list(backend.stream(self.contents))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), "Respuesta de prueba a: hola gemini")
+        self.assertEqual(StubGeminiBackend(["Fijo."]).generate(self.contents), "Fijo.")
+
+    def test_run_worker_line_protocol(self):
+        stdin = io.StringIO(json.dumps({"id": 7, "contents": self.contents}) + "\n")
+        stdout = io.StringIO()
+        run_worker(StubGeminiBackend(["uno dos"]), stdin=stdin, stdout=stdout)
+        messages = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual(messages, [
+            {"id": 7, "chunk": "uno "},
+            {"id": 7, "chunk": "dos"},
+            {"id": 7, "done": True},
+        ])
+
+    def test_subprocess_backend_reuses_one_worker(self):
+        worker = os.path.join(os.path.dirname(__file__), '..', 'gemini_backend.py')
+        backend = SubprocessGeminiBackend([sys.executable, worker, "--worker", "--stub"])
+        try:
+            with patch('logging.info'):
+                self.assertEqual(backend.generate(self.contents), "Respuesta de prueba a: hola gemini")
+                pid = backend._process.pid
+                # Abandonar el stream a mitad no debe desincronizar la siguiente petición
+                stream = backend.stream(self.contents)
+                next(stream)
+                stream.close()
+                second = [{"role": "user", "parts": [{"text": "otra"}]}]
+                self.assertEqual(backend.generate(second), "Respuesta de prueba a: otra")
+            self.assertEqual(backend._process.pid, pid)
+        finally:
+            backend.close()
+
+    def test_subprocess_backend_kills_hung_worker(self):
+        hung = [sys.executable, "-c", "import sys, time; sys.stdin.readline(); time.sleep(30)"]
+        backend = SubprocessGeminiBackend(hung, timeout=0.2)
+        try:
+            with patch('logging.info'), patch('logging.warning'):
+                process = backend._ensure_process()
+                started = time.monotonic()
+                with self.assertRaises(GeminiBackendError):
+                    backend.generate(self.contents)
+            self.assertLess(time.monotonic() - started, 5)
+            self.assertIsNone(backend._process)
+            self.assertIsNotNone(process.wait(timeout=5))
+        finally:
+            backend.close()
+
+    def test_subprocess_backend_skips_non_protocol_lines(self):
+        script = ("import json, sys\n"
+                  "for line in sys.stdin:\n"
+                  "    request = json.loads(line)\n"
+                  "    print('aviso de una biblioteca', flush=True)\n"
+                  "    print('42', flush=True)\n"
+                  "    print(json.dumps({'id': request['id'], 'chunk': 'Hola'}), flush=True)\n"
+                  "    print(json.dumps({'id': request['id'], 'done': True}), flush=True)\n")
+        backend = SubprocessGeminiBackend([sys.executable, "-c", script], timeout=5)
+        try:
+            with patch('logging.info'), patch('logging.warning') as mock_warning:
+                self.assertEqual(backend.generate(self.contents), "Hola")
+            self.assertEqual(mock_warning.call_count, 2)
+        finally:
+            backend.close()
+
+    def test_subprocess_backend_drain_does_not_hang(self):
+        script = ("import json, sys, time\n"
+                  "request = json.loads(sys.stdin.readline())\n"
+                  "print(json.dumps({'id': request['id'], 'chunk': 'Hola '}), flush=True)\n"
+                  "time.sleep(30)\n")
+        backend = SubprocessGeminiBackend([sys.executable, "-c", script], timeout=0.2)
+        try:
+            with patch('logging.info'), patch('logging.warning'):
+                stream = backend.stream(self.contents)
+                self.assertEqual(next(stream), "Hola ")
+                process = backend._process
+                started = time.monotonic()
+                stream.close()
+            self.assertLess(time.monotonic() - started, 5)
+            self.assertIsNone(backend._process)
+            self.assertIsNotNone(process.wait(timeout=5))
+        finally:
+            backend.close()
+
+    def test_create_gemini_backend(self):
+        self.assertIsInstance(create_gemini_backend({"GEMINI_BACKEND": "cli"}), CliGeminiBackend)
+        self.assertIsInstance(create_gemini_backend({"GEMINI_BACKEND": "stub"}), StubGeminiBackend)
+        with self.assertRaises(GeminiBackendError):
+            create_gemini_backend({"GEMINI_BACKEND": "desconocido"})
+
+class TestStreamingResponse(unittest.TestCase):
+
+    def _fragments(self, text, size=3):
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    def test_sentences_from_stream_emits_closed_sentences(self):
+        texto = "La capital de Francia es París. Tiene unos dos millones de habitantes. Y mucha historia"
+        result = list(_sentences_from_stream(self._fragments(texto)))
+        self.assertEqual(result, [
+            ("La capital de Francia es París.", False),
+            ("Tiene unos dos millones de habitantes.", False),
+            ("Y mucha historia", True),
+        ])
+
+    def test_sentences_from_stream_is_incremental(self):
+        consumed = []
+
+        def fragments():
+            for fragment in ["Primera frase bastante larga. ", "Segunda ", "frase."]:
+                consumed.append(fragment)
+                yield fragment
+
+        stream = _sentences_from_stream(fragments())
+        self.assertEqual(next(stream), ("Primera frase bastante larga.", False))
+        self.assertEqual(len(consumed), 1)
+        self.assertEqual(list(stream), [("Segunda frase.", True)])
+
+    def test_sentences_from_stream_empty_final(self):
+        self.assertEqual(list(_sentences_from_stream(["Una frase que termina aquí. "])), [
+            ("Una frase que termina aquí.", False),
+            ("", True),
+        ])
+
+    def test_supports_streaming_response(self):
+        buffered = types.SimpleNamespace(__name__="p", process_response=lambda text: text)
+        chunked = types.SimpleNamespace(__name__="q", process_response=lambda text: text,
+                                        process_response_chunk=lambda text, final: text)
+        self.assertTrue(_supports_streaming_response([chunked]))
+        self.assertFalse(_supports_streaming_response([chunked, buffered]))
+
+    @patch('asistente_voz.play')
+    @patch('asistente_voz._synthesize_chunk', side_effect=lambda chunk: chunk)
+    def test_speak_gemini_stream(self, mock_synthesize, mock_play):
+        plugin = types.SimpleNamespace(
+            __name__="sufijo",
+            process_response_chunk=lambda text, final: f"{text} Fin." if final else text
+        )
+        backend = StubGeminiBackend(["Hoy hace un día estupendo. Ideal para pasear por el parque"])
+        contents = [{"role": "user", "parts": [{"text": "qué día hace"}]}]
+        with patch('logging.info'):
+            respuesta, interrupted = _speak_gemini_stream(backend, contents, [plugin])
+        self.assertEqual(respuesta, "Hoy hace un día estupendo. Ideal para pasear por el parque")
+        self.assertFalse(interrupted)
+        self.assertEqual([c.args[0] for c in mock_play.call_args_list], [
+            "Hoy hace un día estupendo.",
+            "Ideal para pasear por el parque Fin.",
+        ])
+
+    @patch('asistente_voz.play')
+    @patch('asistente_voz._synthesize_chunk', side_effect=lambda chunk: chunk)
+    def test_speak_gemini_stream_propagates_backend_errors(self, mock_synthesize, mock_play):
+        backend = MagicMock()
+
+        def failing_stream(contents):
+            yield "Empiezo a responder bien. "
+            raise GeminiBackendError("conexión perdida")
+
+        backend.stream.side_effect = failing_stream
+        with patch('logging.info'), self.assertRaises(GeminiBackendError):
+            _speak_gemini_stream(backend, [], [])
+        mock_play.assert_called_once_with("Empiezo a responder bien.")
+
+class TestSpeechRecognitionEngines(unittest.TestCase):
+
+    def _engine(self, name, result=None, error=None):
+        engine = MagicMock()
+        engine.name = name
+        if error is not None:
+            engine.recognize.side_effect = error
+        else:
+            engine.recognize.return_value = result
+        return engine
+
+    def test_google_engine_picks_most_confident_alternative(self):
+        recognizer = MagicMock()
+        recognizer.recognize_google.return_value = {"alternative": [
+            {"transcript": "hola mundo", "confidence": 0.7},
+            {"transcript": "ola mundo", "confidence": 0.9},
+        ]}
+        engine = GoogleSpeechEngine(recognizer, "es-ES")
+        self.assertEqual(engine.recognize("audio"), ("ola mundo", 0.9))
+        recognizer.recognize_google.assert_called_once_with("audio", language="es-ES", show_all=True)
+
+    def test_google_engine_no_result(self):
+        recognizer = MagicMock()
+        recognizer.recognize_google.return_value = []
+        with self.assertRaises(sr.UnknownValueError):
+            GoogleSpeechEngine(recognizer, "es-ES").recognize("audio")
+
+    def test_fallback_on_low_confidence(self):
+        local = self._engine("local", ("hola mondo", 0.3))
+        cloud = self._engine("cloud", ("hola mundo", 0.95))
+        with patch('logging.info'):
+            engine = FallbackSpeechEngine(local, cloud, 0.6)
+            self.assertEqual(engine.recognize("audio"), ("hola mundo", 0.95))
+
+    def test_fallback_keeps_primary_result_without_network(self):
+        local = self._engine("local", ("hola mondo", 0.3))
+        cloud = self._engine("cloud", error=sr.RequestError("sin red"))
+        with patch('logging.info'):
+            self.assertEqual(FallbackSpeechEngine(local, cloud, 0.6).recognize("audio"), ("hola mondo", 0.3))
+
+    def test_fallback_on_request_error(self):
+        cloud = self._engine("cloud", error=sr.RequestError("sin red"))
+        local = self._engine("local", ("enciende la luz", 0.8))
+        with patch('logging.info'):
+            self.assertEqual(FallbackSpeechEngine(cloud, local, 0.6).recognize("audio"), ("enciende la luz", 0.8))
+
+    def test_fallback_raises_primary_error_when_both_fail(self):
+        cloud = self._engine("cloud", error=sr.RequestError("sin red"))
+        local = self._engine("local", error=sr.UnknownValueError())
+        with patch('logging.info'), self.assertRaises(sr.RequestError):
+            FallbackSpeechEngine(cloud, local, 0.6).recognize("audio")
+
+    def test_vosk_engine_with_resident_model(self):
+        fake_vosk = types.ModuleType("vosk")
+        fake_vosk.Model = MagicMock()
+        fake_vosk.SetLogLevel = MagicMock()
+        kaldi = MagicMock()
+        kaldi.FinalResult.return_value = json.dumps({
+            "text": "qué hora es",
+            "result": [{"word": "qué", "conf": 1.0}, {"word": "hora", "conf": 0.8}, {"word": "es", "conf": 0.6}],
+        })
+        fake_vosk.KaldiRecognizer = MagicMock(return_value=kaldi)
+        audio = MagicMock()
+        audio.get_raw_data.return_value = b"\x00\x00"
+        with tempfile.TemporaryDirectory() as model_dir, \
+             patch.dict(sys.modules, {"vosk": fake_vosk}), patch('logging.info'):
+            engine = VoskSpeechEngine(model_dir)
+            text, confidence = engine.recognize(audio)
+            engine.recognize(audio)
+        self.assertEqual(text, "qué hora es")
+        self.assertAlmostEqual(confidence, 0.8)
+        fake_vosk.Model.assert_called_once_with(model_dir)
+        audio.get_raw_data.assert_called_with(convert_rate=16000, convert_width=2)
+
+    def test_create_stt_engine_falls_back_to_google_without_model(self):
+        config = {"STT_ENGINE": "vosk", "SPEECH_RECOGNITION_LANGUAGE": "es-ES",
+                  "VOSK_MODEL_PATH": "/no/existe", "STT_MIN_CONFIDENCE": 0.6}
+        with patch('logging.error'), patch('logging.warning'):
+            engine = create_stt_engine(config, MagicMock())
+        self.assertIsInstance(engine, GoogleSpeechEngine)
+
+class TestContinuousCapture(unittest.TestCase):
+    CHUNK = 1024
+    RATE = 16000
+
+    def setUp(self):
+        self.silence = bytes(self.CHUNK * 2)
+        self.speech = array.array("h", [3000, -3000] * (self.CHUNK // 2)).tobytes()
+
+    def _segmenter(self, phrase_time_limit=8):
+        return UtteranceSegmenter(self.RATE, 2, self.CHUNK, lambda: 300, 0.8, phrase_time_limit, 0.5, 0.3)
+
+    def _feed(self, segmenter, frames):
+        return [audio for audio in (segmenter.feed(frame) for frame in frames) if audio is not None]
+
+    def test_segments_utterance_with_pre_roll(self):
+        segmenter = self._segmenter()
+        utterances = self._feed(segmenter, [self.silence] * 10 + [self.speech] * 10 + [self.silence] * 20)
+        self.assertEqual(len(utterances), 1)
+        # 8 bloques de pre-roll + 10 de voz + 13 de silencio final (0.8 s)
+        self.assertEqual(len(utterances[0].frame_data), 31 * self.CHUNK * 2)
+        self.assertEqual(utterances[0].sample_rate, self.RATE)
+        self.assertFalse(segmenter.in_speech)
+
+    def test_short_noise_is_discarded(self):
+        segmenter = self._segmenter()
+        self.assertEqual(self._feed(segmenter, [self.speech] * 2 + [self.silence] * 20), [])
+
+    def test_phrase_time_limit(self):
+        segmenter = self._segmenter(phrase_time_limit=1)
+        utterances = self._feed(segmenter, [self.speech] * 40)
+        self.assertEqual(len(utterances), 2)
+        self.assertEqual(len(utterances[0].frame_data), 16 * self.CHUNK * 2)
+
+    def test_noise_tracker_follows_background_with_hysteresis(self):
+        recognizer = types.SimpleNamespace(energy_threshold=4000)
+        frame_seconds = self.CHUNK / self.RATE
+        tracker = NoiseFloorTracker(recognizer, frame_seconds, time_constant=2.0, factor=3.0, hysteresis=0.2,
+                                    min_threshold=100, max_threshold=4000, warmup_seconds=0.3, window_seconds=0.5)
+        with patch('logging.info'):
+            for _ in range(5):
+                tracker.update(100, False)
+            self.assertEqual(recognizer.energy_threshold, 300)
+            self.assertEqual(tracker.threshold_changes, 1)
+            # Variaciones pequeñas del ruido no mueven el umbral
+            for rms in [110, 90, 120, 95] * 20:
+                tracker.update(rms, False)
+            self.assertEqual(recognizer.energy_threshold, 300)
+            # La voz, con sus pausas entre palabras, no arrastra el nivel de ruido
+            for _ in range(10):
+                for rms in [3000] * 5 + [100] * 2:
+                    tracker.update(rms, rms > 300)
+            self.assertEqual(recognizer.energy_threshold, 300)
+            # Un fondo más ruidoso y persistente sí sube el umbral
+            for _ in range(200):
+                tracker.update(250, False)
+        self.assertAlmostEqual(recognizer.energy_threshold, 750, delta=150)
+        metrics = tracker.metrics()
+        self.assertEqual(metrics["threshold_changes"], tracker.threshold_changes)
+        self.assertEqual(metrics["speech_frames"], 50)
+        self.assertTrue(metrics["calibrated"])
+        self.assertEqual(metrics["last_change"][2], recognizer.energy_threshold)
+
+    def test_segmenter_calibrates_on_the_live_stream(self):
+        recognizer = types.SimpleNamespace(energy_threshold=4000)
+        tracker = NoiseFloorTracker(recognizer, self.CHUNK / self.RATE, warmup_seconds=0.3)
+        segmenter = UtteranceSegmenter(self.RATE, 2, self.CHUNK, lambda: recognizer.energy_threshold,
+                                       0.8, 8, 0.5, 0.3, noise_tracker=tracker)
+        noise = array.array("h", [200, -200] * (self.CHUNK // 2)).tobytes()
+        with patch('logging.info'):
+            # Con el umbral inicial (4000) la voz no se detectaría; tras calentar se detecta
+            utterances = self._feed(segmenter, [noise] * 10 + [self.speech] * 10 + [noise] * 20)
+        self.assertEqual(recognizer.energy_threshold, 600)
+        self.assertEqual(len(utterances), 1)
+
+    def test_frame_rms(self):
+        self.assertEqual(_frame_rms(self.silence, 2), 0)
+        self.assertAlmostEqual(_frame_rms(self.speech, 2), 3000)
+
+    def test_enqueue_drops_oldest_when_full(self):
+        capture = ContinuousAudioCapture(MagicMock(), {}, max_pending=2)
+        with patch('logging.warning'):
+            for i in range(3):
+                capture._enqueue(sr.AudioData(bytes([i, 0]), self.RATE, 2))
+        self.assertEqual([capture.utterances.get_nowait().frame_data[0] for _ in range(2)], [1, 2])
+
+    def test_activity_flag_nesting(self):
+        flag = ActivityFlag()
+        with flag:
+            with flag:
+                self.assertTrue(flag.is_set())
+            self.assertTrue(flag.is_set())
+        self.assertFalse(flag.is_set())
+
+class TestPipeline(unittest.TestCase):
+    CHUNK = 1024
+    RATE = 16000
+
+    def test_barge_in_requires_sustained_loud_frames(self):
+        quiet = array.array("h", [500, -500] * (self.CHUNK // 2)).tobytes()
+        loud = array.array("h", [3000, -3000] * (self.CHUNK // 2)).tobytes()
+        detector = BargeInDetector(2, self.CHUNK, self.RATE, lambda: 300, 3.0, 0.15)
+        # 0.15 s a 16 kHz con bloques de 1024 muestras son 3 bloques
+        self.assertFalse(detector.feed(quiet))
+        self.assertFalse(detector.feed(loud))
+        self.assertFalse(detector.feed(loud))
+        self.assertFalse(detector.feed(quiet))
+        results = [detector.feed(loud) for _ in range(3)]
+        self.assertEqual(results, [False, False, True])
+        self.assertEqual(list(detector.frames)[-3:], [loud] * 3)
+        detector.reset()
+        self.assertEqual(len(detector.frames), 0)
+
+    @patch('asistente_voz._play_audio')
+    @patch('asistente_voz._synthesize_chunk', side_effect=lambda text: text)
+    def test_output_stage_plays_in_order(self, mock_synth, mock_play):
+        stage = SpeechOutputStage(queue.Queue()).start()
+        try:
+            stage.say("Primera frase completa. Segunda frase también completa.")
+            self.assertTrue(stage.wait_until_idle(timeout=5))
+        finally:
+            stage.stop()
+        played = [call.args[0] for call in mock_play.call_args_list]
+        self.assertEqual(played, ["Primera frase completa.", "Segunda frase también completa."])
+
+    @patch('asistente_voz._play_audio')
+    @patch('asistente_voz._synthesize_chunk', side_effect=lambda text: text)
+    def test_output_stage_skips_interrupted_epoch(self, mock_synth, mock_play):
+        stage = SpeechOutputStage(queue.Queue())
+        stage.say_chunk("vieja")
+        stage.interrupt()
+        stage.say_chunk("nueva")
+        stage.start()
+        try:
+            self.assertTrue(stage.wait_until_idle(timeout=5))
+        finally:
+            stage.stop()
+        mock_synth.assert_called_once_with("nueva")
+        self.assertEqual([call.args[0] for call in mock_play.call_args_list], ["nueva"])
+
+    def test_stream_stops_generating_after_interrupt(self):
+        output = MagicMock()
+        output.epoch = 0
+
+        def say_chunk(chunk, epoch):
+            output.epoch = 1
+
+        output.say_chunk.side_effect = say_chunk
+        backend = StubGeminiBackend(["Primera frase larga de prueba. Segunda frase larga de prueba. Tercera frase larga."])
+        with patch('asistente_voz.speech_output', output):
+            _, interrupted = _speak_gemini_stream(backend, [], [])
+        output.say_chunk.assert_called_once_with("Primera frase larga de prueba.", 0)
+        self.assertTrue(interrupted)
+
+    @patch('asistente_voz.hablar')
+    def test_process_utterance_routes_to_gemini(self, mock_hablar):
+        backend = StubGeminiBackend(["Hola desde Gemini."])
+        session = AssistantSession([], CommandPlugins([]), CustomCommands({}), backend)
+        with patch.dict('asistente_voz.CONFIG', {"GEMINI_STREAMING": False}):
+            _process_utterance(session, "hola")
+        mock_hablar.assert_called_once_with("Hola desde Gemini.")
+        self.assertEqual([m["role"] for m in session.conversation_history], ["user", "model"])
+
+    @patch('asistente_voz.hablar')
+    def test_process_utterance_handles_custom_command(self, mock_hablar):
+        backend = MagicMock()
+        commands = CustomCommands({"recuerda pan": {"action": "log_reminder", "que": "pan", "cuando": "mañana"}})
+        session = AssistantSession([], CommandPlugins([]), commands, backend)
+        _process_utterance(session, "recuerda pan")
+        backend.generate.assert_not_called()
+        backend.stream.assert_not_called()
+        self.assertEqual(session.conversation_history, [])
+
+class TestHttpClient(unittest.TestCase):
+    def setUp(self):
+        self.client_ports = []
+        self.seen_headers = []
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                test.client_ports.append(self.client_address[1])
+                test.seen_headers.append(self.headers.get("Authorization"))
+                length = int(self.headers.get("Content-Length", 0))
+                self.rfile.read(length)
+                body = b'{"ok": true}'
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = HttpClient(timeout=(1, 2), retries=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_reuses_connection_and_host_headers(self):
+        self.client.set_host_headers(self.base_url, {"Authorization": "Bearer abc"})
+        for _ in range(3):
+            response = self.client.post(f"{self.base_url}/api/services/light/turn_on", json={"entity_id": "light.a"})
+            self.assertEqual(response.json(), {"ok": True})
+        self.assertEqual(len(set(self.client_ports)), 1)
+        self.assertEqual(self.seen_headers, ["Bearer abc"] * 3)
+
+    def test_one_session_per_host(self):
+        self.assertIs(self.client.session_for("http://host-a:8123/x"), self.client.session_for("http://HOST-A:8123/y"))
+        self.assertIsNot(self.client.session_for("http://host-a:8123/x"), self.client.session_for("http://host-b:8080/x"))
+
+    def test_default_timeout_and_retry_policy(self):
+        client = HttpClient(timeout=(2, 7), retries=3, backoff_factor=0.5)
+        session = client.session_for("http://ha.local:8123")
+        with patch.object(session, 'request') as mock_request:
+            client.get("http://ha.local:8123/api/states/sun.sun")
+            client.get("http://ha.local:8123/api/states/sun.sun", timeout=30)
+        self.assertEqual(mock_request.call_args_list[0].kwargs["timeout"], (2, 7))
+        self.assertEqual(mock_request.call_args_list[1].kwargs["timeout"], 30)
+        retry = session.get_adapter("http://ha.local:8123").max_retries
+        self.assertEqual(retry.total, 3)
+        self.assertEqual(retry.backoff_factor, 0.5)
+        self.assertNotIn("POST", retry.allowed_methods)
+        client.close()
+
+class FakeHAServer:
+    """Home Assistant falso: REST con http.server y websocket con una conexión guionizada."""
+
+    def __init__(self, states):
+        self.states = {state["entity_id"]: state for state in states}
+        self.requests = []
+        self.events = queue.Queue()
+        self.sent = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                if self.path == "/api/states":
+                    body = list(server.states.values())
+                elif self.path.startswith("/api/states/") and self.path[12:] in server.states:
+                    body = server.states[self.path[12:]]
+                else:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def ws_connect(self, url):
+        self.ws_url = url
+        server = self
+
+        class Connection:
+            def __init__(self):
+                self.outgoing = queue.Queue()
+                self.outgoing.put({"type": "auth_required"})
+
+            def send(self, raw):
+                message = json.loads(raw)
+                server.sent.append(message)
+                if message["type"] == "auth":
+                    self.outgoing.put({"type": "auth_ok"})
+                elif message["type"] == "subscribe_events":
+                    self.outgoing.put({"id": message["id"], "type": "result", "success": True})
+                elif message["type"] == "ping":
+                    self.outgoing.put({"id": message["id"], "type": "pong"})
+
+            def recv(self):
+                try:
+                    return json.dumps(self.outgoing.get_nowait())
+                except queue.Empty:
+                    pass
+                try:
+                    return json.dumps(server.events.get(timeout=0.05))
+                except queue.Empty:
+                    raise TimeoutError()
+
+            def close(self):
+                pass
+
+        return Connection()
+
+    def push_state(self, entity_id, new_state):
+        self.events.put({"type": "event", "event": {"event_type": "state_changed", "data": {"entity_id": entity_id, "new_state": new_state}}})
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class TestHAStateCache(unittest.TestCase):
+    def setUp(self):
+        self.ha = FakeHAServer([
+            {"entity_id": "sensor.temperatura_sala", "state": "21.5"},
+            {"entity_id": "light.luz_sala", "state": "off"},
+        ])
+        self.client = HttpClient(timeout=(1, 2), retries=0)
+
+    def tearDown(self):
+        self.client.close()
+        self.ha.close()
+
+    def _wait_for(self, condition):
+        deadline = time.monotonic() + 3
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("La condición no se cumplió a tiempo")
+            time.sleep(0.01)
+
+    def test_bootstrap_and_websocket_updates(self):
+        cache = HAStateCache(self.ha.url, "token", self.client, max_age=60, ws_connect=self.ha.ws_connect).start()
+        try:
+            self._wait_for(lambda: cache.connected)
+            self.assertEqual(self.ha.ws_url, self.ha.url.replace("http://", "ws://") + "/api/websocket")
+            self.assertEqual(self.ha.sent[0], {"type": "auth", "access_token": "token"})
+            self.assertEqual(self.ha.requests, ["/api/states"])
+            self.assertEqual(cache.get("sensor.temperatura_sala")["state"], "21.5")
+
+            self.ha.push_state("sensor.temperatura_sala", {"entity_id": "sensor.temperatura_sala", "state": "22.0"})
+            self._wait_for(lambda: cache.get("sensor.temperatura_sala")["state"] == "22.0")
+            self.ha.push_state("light.luz_sala", None)
+            self._wait_for(lambda: cache.get("light.luz_sala") is None)
+            self._wait_for(lambda: any(message["type"] == "ping" for message in self.ha.sent))
+        finally:
+            cache.stop()
+        self.assertEqual(self.ha.requests, ["/api/states"])
+
+    def test_get_ha_state_answers_from_cache(self):
+        cache = HAStateCache(self.ha.url, "token", self.client, max_age=60)
+        cache.bootstrap()
+        with patch('asistente_voz.ha_state_cache', cache), patch('asistente_voz.http_client.get') as mock_get:
+            self.assertEqual(get_ha_state("sensor.temperatura_sala")["state"], "21.5")
+        mock_get.assert_not_called()
+
+    def test_stale_entry_falls_back_to_rest(self):
+        cache = HAStateCache(self.ha.url, "token", self.client, max_age=60)
+        cache.update("sensor.temperatura_sala", {"entity_id": "sensor.temperatura_sala", "state": "19.0"})
+        with patch('asistente_voz.time.monotonic', return_value=time.monotonic() + 120):
+            self.assertIsNone(cache.get("sensor.temperatura_sala"))
+        cache.max_age = 0
+        with patch('asistente_voz.ha_state_cache', cache), \
+             patch('asistente_voz.http_client', self.client), \
+             patch.dict('asistente_voz.CONFIG', {"HA_URL": self.ha.url}):
+            state = get_ha_state("sensor.temperatura_sala")
+        self.assertEqual(state["state"], "21.5")
+        self.assertEqual(self.ha.requests, ["/api/states/sensor.temperatura_sala"])
+
+class TestHAServiceBatching(unittest.TestCase):
+    def test_batcher_coalesces_calls_within_window(self):
+        send = MagicMock(return_value=True)
+        batcher = HAServiceBatcher(send, window=0.05)
+        futures = [
+            batcher.submit("light", "turn_off", "light.cocina"),
+            batcher.submit("light", "turn_off", ["light.sala", "light.cocina"]),
+            batcher.submit("light", "turn_off", area_id="dormitorio"),
+            batcher.submit("light", "turn_on", "light.pasillo", {"brightness": 80}),
+        ]
+        self.assertTrue(all(future.result(timeout=2) for future in futures))
+        self.assertEqual(send.call_args_list, [
+            call("light", "turn_off", ["light.cocina", "light.sala"], None, ["dormitorio"]),
+            call("light", "turn_on", ["light.pasillo"], {"brightness": 80}, None),
+        ])
+
+    def test_all_absorbs_other_entities(self):
+        send = MagicMock(return_value=False)
+        batcher = HAServiceBatcher(send, window=10)
+        first = batcher.submit("switch", "turn_off", "switch.tv")
+        second = batcher.submit("switch", "turn_off", "all")
+        batcher.flush()
+        send.assert_called_once_with("switch", "turn_off", ["all"], None, None)
+        self.assertFalse(first.result(timeout=1))
+        self.assertFalse(second.result(timeout=1))
+
+    @patch('asistente_voz.call_ha_service', return_value=True)
+    def test_scene_is_one_request_per_service(self, mock_call_ha_service):
+        calls = [
+            {"domain": "light", "service": "turn_off", "entity_id": "light.sala"},
+            {"domain": "light", "service": "turn_off", "entity_id": "light.cocina"},
+            {"domain": "media_player", "service": "media_stop", "entity_id": "all"},
+        ]
+        self.assertTrue(call_ha_services(calls))
+        self.assertEqual(mock_call_ha_service.call_count, 2)
+        mock_call_ha_service.assert_any_call("light", "turn_off", ["light.sala", "light.cocina"], None, None)
+
+    @patch('asistente_voz.hablar')
+    @patch('asistente_voz.call_ha_service', return_value=True)
+    def test_custom_command_expands_spoken_list(self, mock_call_ha_service, mock_hablar):
+        commands = CustomCommands({
+            "enciende la luz de (?P<entidad>.*)": {
+                "action": "home_assistant_service",
+                "regex": True,
+                "domain": "light",
+                "service": "turn_on",
+                "entity_id": "light.{entidad}"
+            },
+            "apaga la planta": {
+                "action": "home_assistant_service",
+                "domain": "light",
+                "service": "turn_off",
+                "area_id": ["planta_baja", "garaje"]
+            }
+        })
+        handled, _ = _handle_custom_commands("enciende la luz de Cocina y sala de estar", commands, {})
+        self.assertTrue(handled)
+        mock_call_ha_service.assert_called_with("light", "turn_on", ["light.cocina", "light.sala_de_estar"], None)
+        _handle_custom_commands("apaga la planta", commands, {})
+        mock_call_ha_service.assert_called_with("light", "turn_off", None, None, ["planta_baja", "garaje"])
+
+class FakeMCPServer:
+    """Servidor JSON-RPC falso que responde los lotes en orden inverso."""
+
+    def __init__(self, supports_batch=True):
+        self.bodies = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                server.bodies.append(body)
+                if isinstance(body, list):
+                    if supports_batch:
+                        reply = [server.answer(message) for message in reversed(body)]
+                    else:
+                        reply = {"jsonrpc": "2.0", "error": {"code": -32600, "message": "Invalid Request"}, "id": None}
+                else:
+                    reply = server.answer(body)
+                data = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def answer(self, message):
+        if message["method"] == "github.fail":
+            return {"jsonrpc": "2.0", "error": {"code": -32601, "message": "Method not found"}, "id": message["id"]}
+        return {"jsonrpc": "2.0", "result": {"method": message["method"], "params": message["params"]}, "id": message["id"]}
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class TestMCPClient(unittest.TestCase):
+    def setUp(self):
+        self.http = HttpClient(timeout=(1, 2), retries=0)
+
+    def tearDown(self):
+        self.http.close()
+
+    def _client(self, server):
+        self.addCleanup(server.close)
+        config = patch.dict('asistente_voz.CONFIG', {"MCP_GITHUB_SERVER_URL": server.url})
+        config.start()
+        self.addCleanup(config.stop)
+        client = MCPClient(self.http, batch_window=0.01)
+        self.addCleanup(client.close)
+        return client
+
+    def test_ids_increase(self):
+        server = FakeMCPServer()
+        client = self._client(server)
+        client.call("github.issues.list", {"state": "open"})
+        client.call("github.issues.list")
+        self.assertEqual([body["id"] for body in server.bodies], [1, 2])
+        self.assertEqual(server.bodies[1]["params"], {})
+
+    def test_batch_correlates_out_of_order_responses(self):
+        server = FakeMCPServer()
+        client = self._client(server)
+        futures = client.call_many([
+            ("github.pull_requests.list", {"state": "open"}),
+            ("github.fail", None),
+            ("github.issues.list", {"state": "open"}),
+        ])
+        self.assertEqual(futures[0].result(timeout=2)["method"], "github.pull_requests.list")
+        self.assertEqual(futures[2].result(timeout=2)["method"], "github.issues.list")
+        with self.assertRaises(MCPError):
+            futures[1].result(timeout=2)
+        self.assertEqual(len(server.bodies), 1)
+        self.assertEqual([message["id"] for message in server.bodies[0]], [1, 2, 3])
+
+    def test_submits_within_window_share_a_request(self):
+        server = FakeMCPServer()
+        client = self._client(server)
+        first = client.submit("github.pull_requests.list")
+        second = client.submit("github.issues.list")
+        self.assertEqual(first.result(timeout=2)["method"], "github.pull_requests.list")
+        self.assertEqual(second.result(timeout=2)["method"], "github.issues.list")
+        self.assertEqual(len(server.bodies), 1)
+
+    def test_falls_back_to_parallel_single_calls(self):
+        server = FakeMCPServer(supports_batch=False)
+        client = self._client(server)
+        futures = client.call_many([("github.pull_requests.list", None), ("github.issues.list", None)])
+        self.assertEqual([future.result(timeout=2)["method"] for future in futures], ["github.pull_requests.list", "github.issues.list"])
+        self.assertFalse(client.supports_batch)
+        self.assertEqual(len(server.bodies), 3)
+
+    @patch('asistente_voz.hablar')
+    def test_send_mcp_requests_reports_failures_once(self, mock_hablar):
+        server = FakeMCPServer()
+        client = self._client(server)
+        with patch('asistente_voz.mcp_client', client), patch('logging.error'):
+            results = send_mcp_requests([("github.issues.list", {}), ("github.fail", {}), ("github.fail", {})])
+        self.assertEqual(results[0]["method"], "github.issues.list")
+        self.assertEqual(results[1:], [None, None])
+        mock_hablar.assert_called_once_with(ERROR_MESSAGES["mcp_request_failed"])
+
+    def _fake_client(self, body=None, error=None):
+        response = MagicMock()
+        if error is not None:
+            response.json.side_effect = error
+        else:
+            response.json.return_value = body
+        http = MagicMock()
+        http.post.return_value = response
+        client = MCPClient(http, batch_window=0.01)
+        self.addCleanup(client.close)
+        return client
+
+    def test_malformed_batch_resolves_every_future(self):
+        client = self._fake_client([
+            {"jsonrpc": "2.0", "result": "bien", "id": 1},
+            {"jsonrpc": "2.0", "result": "sin id"},
+            {"jsonrpc": "2.0", "result": "id raro", "id": [2]},
+            "basura",
+        ])
+        with patch('logging.error'):
+            futures = client.call_many([("github.a", None), ("github.b", None), ("github.c", None)])
+        self.assertEqual(futures[0].result(timeout=1), "bien")
+        for future in futures[1:]:
+            with self.assertRaises(MCPError):
+                future.result(timeout=1)
+
+    def test_invalid_json_is_an_mcp_error(self):
+        client = self._fake_client(error=ValueError("Expecting value"))
+        with self.assertRaises(MCPError):
+            client.call("github.issues.list")
+        futures = client.call_many([("github.a", None), ("github.b", None)])
+        for future in futures:
+            with self.assertRaises(MCPError):
+                future.result(timeout=1)
+
+    @patch('asistente_voz.hablar')
+    def test_send_mcp_requests_survives_malformed_responses(self, mock_hablar):
+        client = self._fake_client([{"jsonrpc": "2.0", "result": "bien", "id": 1}, ["no", "es", "un", "mensaje"]])
+        with patch('asistente_voz.mcp_client', client), patch('logging.error'):
+            results = send_mcp_requests([("github.a", {}), ("github.b", {})])
+        self.assertEqual(results, ["bien", None])
+        mock_hablar.assert_called_once_with(ERROR_MESSAGES["mcp_request_failed"])
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache({"github.issues.list": 60, "weather.current": 600})
+
+    def test_read_through_with_ttl(self):
+        fetch = MagicMock(side_effect=["primero", "segundo"])
+        self.assertEqual(self.cache.get_or_fetch("github.issues.list", {"state": "open"}, fetch), "primero")
+        self.assertEqual(self.cache.get_or_fetch("github.issues.list", {"state": "open"}, fetch), "primero")
+        self.assertEqual(fetch.call_count, 1)
+        with patch('asistente_voz.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertEqual(self.cache.get_or_fetch("github.issues.list", {"state": "open"}, fetch), "segundo")
+
+    def test_params_are_part_of_the_key(self):
+        self.cache.get_or_fetch("weather.current", {"city": "madrid"}, lambda: "sol")
+        self.assertEqual(self.cache.get_or_fetch("weather.current", {"city": "oviedo"}, lambda: "lluvia"), "lluvia")
+        self.assertEqual(self.cache.peek("weather.current", {"city": "madrid"}), (True, "sol"))
+
+    def test_single_flight(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait(2)
+            return "dato"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.cache.get_or_fetch("weather.current", {"city": "madrid"}, fetch))) for _ in range(3)]
+        threads[0].start()
+        started.wait(2)
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual(results, ["dato"] * 3)
+        self.assertEqual(len(calls), 1)
+
+    def test_errors_are_not_cached(self):
+        fetch = MagicMock(side_effect=[requests.exceptions.ConnectionError("caído"), "ok"])
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            self.cache.get_or_fetch("github.issues.list", {}, fetch)
+        self.assertEqual(self.cache.get_or_fetch("github.issues.list", {}, fetch), "ok")
+
+    def test_write_invalidates_namespace(self):
+        self.cache.get_or_fetch("github.issues.list", {"state": "open"}, lambda: ["#1"])
+        self.cache.get_or_fetch("weather.current", {"city": "madrid"}, lambda: "sol")
+        write = MagicMock(return_value={"number": 2})
+        self.cache.get_or_fetch("github.issues.create", {"title": "nuevo"}, write)
+        self.cache.get_or_fetch("github.issues.create", {"title": "nuevo"}, write)
+        self.assertEqual(write.call_count, 2)
+        self.assertEqual(self.cache.peek("github.issues.list", {"state": "open"}), (False, None))
+        self.assertTrue(self.cache.peek("weather.current", {"city": "madrid"})[0])
+
+    def test_explicit_invalidation_rules(self):
+        cache = ResponseCache({"github.pull_requests.list": 60}, {"github.pull_requests.merge": ["github.pull_requests", "github.issues"]})
+        cache.get_or_fetch("github.pull_requests.list", {}, lambda: [])
+        cache.invalidate_after_write("github.pull_requests.merge")
+        self.assertFalse(cache.peek("github.pull_requests.list", {})[0])
+
+    def test_send_mcp_request_uses_cache(self):
+        server = FakeMCPServer()
+        self.addCleanup(server.close)
+        http = HttpClient(timeout=(1, 2), retries=0)
+        self.addCleanup(http.close)
+        client = MCPClient(http)
+        with patch.dict('asistente_voz.CONFIG', {"MCP_GITHUB_SERVER_URL": server.url}), \
+             patch('asistente_voz.mcp_client', client), \
+             patch('asistente_voz.response_cache', self.cache):
+            first = send_mcp_request("github.issues.list", {"state": "open"})
+            second = send_mcp_request("github.issues.list", {"state": "open"})
+            results = send_mcp_requests([("github.issues.list", {"state": "open"}), ("github.pull_requests.list", {"state": "open"})])
+        self.assertEqual(first, second)
+        self.assertEqual(results[0], first)
+        self.assertEqual(len(server.bodies), 2)
+        self.assertEqual(server.bodies[1]["method"], "github.pull_requests.list")
+
+class TestCommandScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.state_file = os.path.join(self.tmpdir.name, "scheduler_state.json")
+        self.now = datetime.datetime(2025, 3, 14, 7, 59, 30)  # viernes
+
+    def test_cron_next_after(self):
+        self.assertEqual(CronSchedule("0 8 * * *").next_after(self.now), datetime.datetime(2025, 3, 14, 8, 0))
+        self.assertEqual(CronSchedule("*/15 9-10 * * 1-5").next_after(self.now), datetime.datetime(2025, 3, 14, 9, 0))
+        # Domingo: 0 y 7 son equivalentes
+        self.assertEqual(CronSchedule("30 10 * * 0").next_after(self.now), datetime.datetime(2025, 3, 16, 10, 30))
+        self.assertEqual(CronSchedule("30 10 * * 7").next_after(self.now), datetime.datetime(2025, 3, 16, 10, 30))
+        self.assertEqual(CronSchedule("0 0 29 2 *").next_after(self.now), datetime.datetime(2028, 2, 29, 0, 0))
+        with self.assertRaises(ValueError):
+            CronSchedule("61 * * * *")
+
+    def test_cron_steps(self):
+        self.assertEqual(CronSchedule("*/15 * * * *").minutes, {0, 15, 30, 45})
+        self.assertEqual(CronSchedule("10-40/15 * * * *").minutes, {10, 25, 40})
+        self.assertEqual(CronSchedule("5/15 * * * *").minutes, {5, 20, 35, 50})
+        self.assertEqual(CronSchedule("0 3/8 * * *").hours, {3, 11, 19})
+
+    def test_trigger_time_with_days_and_one_shot(self):
+        weekend = parse_command_schedule({"trigger_time": "09:30", "trigger_days": ["fin de semana"]})
+        self.assertEqual(weekend.next_after(self.now), datetime.datetime(2025, 3, 15, 9, 30))
+        monday = parse_command_schedule({"trigger_time": "07:00", "trigger_days": "lunes"})
+        self.assertEqual(monday.next_after(self.now), datetime.datetime(2025, 3, 17, 7, 0))
+        reminder = parse_command_schedule({"trigger_at": "2025-03-14T18:00"})
+        self.assertEqual(reminder.next_after(self.now), datetime.datetime(2025, 3, 14, 18, 0))
+        self.assertIsNone(reminder.next_after(datetime.datetime(2025, 3, 14, 18, 0)))
+        self.assertIsNone(parse_command_schedule({"action": "log_reminder"}))
+
+    def test_heap_orders_commands(self):
+        commands = {
+            "tarde": {"trigger_time": "20:00"},
+            "pronto": {"trigger_time": "08:00"},
+            "sin hora": {"action": "log_reminder"},
+        }
+        scheduler = CommandScheduler(commands, MagicMock(), clock=lambda: self.now)
+        self.assertEqual(scheduler.next_fire_time(), datetime.datetime(2025, 3, 14, 8, 0))
+        self.assertEqual(len(scheduler._heap), 2)
+
+    def _run_once(self, scheduler, run_due):
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        deadline = time.monotonic() + 2
+        while not run_due.called and time.monotonic() < deadline:
+            time.sleep(0.01)
+        scheduler.stop()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_fires_due_commands_together_and_persists(self):
+        commands = {
+            "luces": {"trigger_time": "08:00", "action": "home_assistant_service"},
+            "resumen": {"cron": "0 8 * * 1-5", "action": "morning_summary"},
+        }
+        clock = [self.now]
+        run_due = MagicMock()
+        scheduler = CommandScheduler(commands, run_due, self.state_file, clock=lambda: clock[0])
+        clock[0] = datetime.datetime(2025, 3, 14, 8, 0, 1)
+        self._run_once(scheduler, run_due)
+        run_due.assert_called_once()
+        self.assertEqual([phrase for phrase, _ in run_due.call_args[0][0]], ["luces", "resumen"])
+        with open(self.state_file, encoding='utf-8') as f:
+            self.assertEqual(json.load(f), {"luces": "2025-03-14T08:00:00", "resumen": "2025-03-14T08:00:00"})
+        self.assertEqual(scheduler.next_fire_time(), datetime.datetime(2025, 3, 15, 8, 0))
+
+    def test_catches_up_missed_run_once(self):
+        with open(self.state_file, 'w', encoding='utf-8') as f:
+            json.dump({"luces": "2025-03-11T08:00:00", "viejo": "2025-03-01T08:00:00"}, f)
+        commands = {
+            "luces": {"trigger_time": "08:00"},
+            "viejo": {"trigger_time": "08:00", "trigger_days": "lunes"},
+        }
+        now = datetime.datetime(2025, 3, 14, 9, 0)
+        scheduler = CommandScheduler(commands, MagicMock(), self.state_file, catch_up_hours=12, clock=lambda: now)
+        fires = sorted((entry[0], entry[2]) for entry in scheduler._heap)
+        self.assertEqual(fires, [
+            (datetime.datetime(2025, 3, 14, 8, 0), "luces"),
+            (datetime.datetime(2025, 3, 17, 8, 0), "viejo"),
+        ])
+
+    def test_idle_scheduler_sleeps_without_timeout_and_stops_instantly(self):
+        scheduler = CommandScheduler({}, MagicMock())
+        with patch.object(scheduler._wakeup, 'wait', wraps=scheduler._wakeup.wait) as mock_wait:
+            thread = threading.Thread(target=scheduler.run)
+            thread.start()
+            time.sleep(0.05)
+            started = time.monotonic()
+            scheduler.stop()
+            thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.monotonic() - started, 0.5)
+        mock_wait.assert_called_with(None)
+
+class TestTimedActions(unittest.TestCase):
+    @patch('asistente_voz.hablar')
+    def test_morning_summary_fetches_concurrently_and_speaks_in_order(self, mock_hablar):
+        def slow(text):
+            def fetch():
+                time.sleep(0.2)
+                return text
+            return fetch
+
+        def broken():
+            raise RuntimeError("sin red")
+
+        sources = [
+            ("calendario", slow("Eventos"), "Sin calendario."),
+            ("tareas", slow("Tareas"), "Sin tareas."),
+            ("tiempo", broken, "Sin tiempo."),
+        ]
+        with patch('asistente_voz.MORNING_SUMMARY_SOURCES', sources), patch('logging.error'):
+            started = time.monotonic()
+            _morning_summary(timeout=5)
+            elapsed = time.monotonic() - started
+        self.assertLess(elapsed, 0.35)
+        self.assertEqual([c.args[0] for c in mock_hablar.call_args_list],
+                         ["Buenos días. Aquí está tu resumen matutino.", "Eventos", "Tareas", "Sin tiempo."])
+
+    @patch('asistente_voz.hablar')
+    def test_morning_summary_timeout(self, mock_hablar):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        sources = [("calendario", lambda: release.wait(2) and "tarde", "Sin calendario."), ("tareas", lambda: "Tareas", "Sin tareas.")]
+        with patch('asistente_voz.MORNING_SUMMARY_SOURCES', sources), patch('logging.error'):
+            _morning_summary(timeout=0.1)
+        self.assertEqual([c.args[0] for c in mock_hablar.call_args_list],
+                         ["Buenos días. Aquí está tu resumen matutino.", "Sin calendario.", "Tareas"])
+
+    @patch('asistente_voz.hablar')
+    def test_slow_action_does_not_block_others_and_times_out(self, mock_hablar):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        reminders = []
+
+        def execute(command_phrase, command_details, pending):
+            if command_phrase == "lento":
+                release.wait(2)
+            else:
+                reminders.append(command_phrase)
+
+        scheduler = CommandScheduler({}, MagicMock())
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        self.addCleanup(thread.join, 1)
+        self.addCleanup(scheduler.stop)
+        due = [("lento", {"action": "mcp_request", "timeout": 0.1}), ("rápido", {"action": "log_reminder"})]
+        with patch('asistente_voz.command_scheduler', scheduler), \
+             patch('asistente_voz._execute_timed_command', side_effect=execute), \
+             patch('logging.warning') as mock_warning:
+            started = time.monotonic()
+            futures = _run_due_commands(due)
+            self.assertLess(time.monotonic() - started, 0.1)
+            futures[1].result(timeout=1)
+            self.assertEqual(reminders, ["rápido"])
+            deadline = time.monotonic() + 2
+            while not mock_hablar.called and time.monotonic() < deadline:
+                time.sleep(0.01)
+        mock_hablar.assert_called_once_with("El comando programado lento sigue en curso.")
+        self.assertIn("superó el tiempo máximo", mock_warning.call_args[0][0])
+
+    @patch('asistente_voz.hablar')
+    def test_queued_action_past_deadline_is_cancelled(self, mock_hablar):
+        future = Future()
+        scheduler = MagicMock()
+        scheduler.clock.return_value = datetime.datetime(2024, 1, 1, 8, 0)
+        with patch('asistente_voz.command_scheduler', scheduler), patch('logging.error'):
+            _watch_timed_action("en cola", future, 5)
+            check = scheduler.call_at.call_args[0][1]
+            check()
+        self.assertTrue(future.cancelled())
+        mock_hablar.assert_called_once_with("Fallo al ejecutar comando programado: en cola")
+
+class TestUserDataStore(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.db_path = os.path.join(self.tmpdir.name, "user_data.db")
+        self.json_path = os.path.join(self.tmpdir.name, "user_data.json")
+
+    def _store(self):
+        store = UserDataStore(self.db_path, self.json_path)
+        self.addCleanup(store.close)
+        return store
+
+    def test_per_key_get_set_persist(self):
+        store = self._store()
+        store.set("nombre_usuario", "Ana")
+        store.set("ciudades", ["Madrid", "Oviedo"])
+        self.assertEqual(store.get("nombre_usuario"), "Ana")
+        self.assertIsNone(store.get("no_existe"))
+        # Las lecturas devuelven copias: modificarlas no cambia el almacén
+        store.get("ciudades").append("Vigo")
+        self.assertEqual(store.get("ciudades"), ["Madrid", "Oviedo"])
+        store.delete("ciudades")
+        store.close()
+        reopened = self._store()
+        self.assertEqual(reopened.all(), {"nombre_usuario": "Ana"})
+        mode = reopened._conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, "wal")
+
+    def test_migrates_legacy_json_once(self):
+        with open(self.json_path, 'w', encoding='utf-8') as f:
+            json.dump({"nombre_usuario": "Luis", "default_city": "Sevilla"}, f)
+        store = self._store()
+        self.assertEqual(store.all(), {"nombre_usuario": "Luis", "default_city": "Sevilla"})
+        self.assertFalse(os.path.exists(self.json_path))
+        self.assertTrue(os.path.exists(self.json_path + ".migrated"))
+
+    @patch('asistente_voz.hablar')
+    def test_corrupt_legacy_json_is_kept_aside(self, mock_hablar):
+        with open(self.json_path, 'w', encoding='utf-8') as f:
+            f.write("{roto")
+        with patch('logging.warning'):
+            store = self._store()
+        self.assertEqual(store.all(), {})
+        self.assertTrue(os.path.exists(self.json_path + ".corrupt"))
+        mock_hablar.assert_called_once_with(ERROR_MESSAGES["user_data_corrupt"])
+
+    def test_replace_all_and_failed_write_is_rolled_back(self):
+        store = self._store()
+        store.update({"a": 1, "b": 2})
+        store.replace_all({"c": 3})
+        self.assertEqual(store.all(), {"c": 3})
+        with self.assertRaises(TypeError):
+            store.update({"d": 4, "e": object()})
+        self.assertEqual(store.all(), {"c": 3})
+        self.assertEqual(store._conn.execute("SELECT COUNT(*) FROM user_data").fetchone()[0], 1)
+
+    def test_concurrent_sets(self):
+        store = self._store()
+        threads = [threading.Thread(target=lambda i=i: [store.set(f"clave_{i}_{j}", j) for j in range(20)]) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(store.all()), 100)
+
+    def test_module_wrappers_use_configured_store(self):
+        with patch.dict('asistente_voz.CONFIG', {"USER_DATA_DB": self.db_path, "USER_DATA_FILE": self.json_path}):
+            save_user_data({"nombre_usuario": "Eva"})
+            self.assertEqual(load_user_data(), {"nombre_usuario": "Eva"})
+            get_user_data_store().close()
+
+class TestTodoPlugin(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        plugin_path = os.path.join(os.path.dirname(__file__), '..', 'plugins', 'todo_plugin.py')
+        spec = importlib.util.spec_from_file_location("todo_plugin_test", plugin_path)
+        self.todo = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.todo)
+        self.todo.TASKS_FILE = os.path.join(self.tmpdir.name, "tareas.json")
+        self.todo.TASKS_LOG_FILE = ""
+        self.log_path = os.path.join(self.tmpdir.name, "tareas.jsonl")
+
+    def test_duplicate_descriptions_complete_the_right_task(self):
+        self.todo.add_task("comprar pan")
+        self.todo.add_task("llamar a mamá")
+        self.todo.add_task("comprar pan")
+        self.assertEqual(self.todo.complete_task("3"), "Tarea 'comprar pan' marcada como completada.")
+        tasks = self.todo.get_tasks()
+        self.assertEqual([task["completed"] for task in tasks], [False, False, True])
+        self.assertEqual(self.todo.list_tasks(), "Tus tareas pendientes son:\n1. comprar pan\n2. llamar a mamá\n")
+        self.assertEqual(self.todo.complete_task("7"), "Número de tarea inválido.")
+        self.assertEqual(self.todo.complete_task("tres"), "Por favor, di un número de tarea válido.")
+
+    def test_appends_events_instead_of_rewriting(self):
+        self.todo.add_task("regar las plantas")
+        self.todo.complete_task("1")
+        with open(self.log_path, encoding='utf-8') as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual([event["op"] for event in events], ["add", "complete"])
+        self.assertEqual(events[1]["id"], events[0]["id"])
+
+    def test_due_dates_and_priorities(self):
+        today = datetime.date(2025, 3, 14)
+        self.assertEqual(self.todo._parse_task("pagar la luz para mañana con prioridad alta", today), ("pagar la luz", "2025-03-15", 0))
+        self.assertEqual(self.todo._parse_task("renovar el DNI para el 2 de enero", today), ("renovar el DNI", "2026-01-02", 1))
+        self.assertEqual(self.todo._parse_task("leer un libro con prioridad baja", today), ("leer un libro", None, 2))
+        store = self.todo.get_store()
+        store.add("leer un libro", priority=2)
+        store.add("pagar la luz", due="2025-03-15", priority=0)
+        store.add("renovar el DNI", due="2025-03-20")
+        store.add("sacar al perro")
+        self.assertEqual([task["description"] for task in store.pending()], ["pagar la luz", "renovar el DNI", "sacar al perro", "leer un libro"])
+        self.assertIn("1. pagar la luz (para el 2025-03-15, prioridad alta)", self.todo.list_tasks())
+
+    def test_reloads_when_file_changes_on_disk(self):
+        store = self.todo.get_store()
+        store.add("tarea local")
+        other = self.todo.TaskStore(self.log_path)
+        other.add("tarea de otro proceso")
+        self.assertEqual([task["description"] for task in store.pending()], ["tarea local", "tarea de otro proceso"])
+        other.compact()
+        other.complete(1)
+        self.assertEqual([task["description"] for task in store.pending()], ["tarea de otro proceso"])
+
+    def test_migrates_legacy_json_and_compacts(self):
+        with open(self.todo.TASKS_FILE, 'w', encoding='utf-8') as f:
+            json.dump([{"description": "vieja", "completed": True}, {"description": "pendiente", "completed": False}], f)
+        store = self.todo.get_store()
+        self.assertEqual([task["description"] for task in store.pending()], ["pendiente"])
+        self.assertTrue(os.path.exists(self.todo.TASKS_FILE + ".migrated"))
+        store.COMPACT_MIN_LINES = 4
+        for i in range(6):
+            store.add(f"tarea {i}")
+            store.complete(store.pending_at(1)["id"])
+        with open(self.log_path, encoding='utf-8') as f:
+            lines = f.readlines()
+        self.assertLess(len(lines), 14)
+        self.assertEqual(len(store.all()), 8)
+        self.assertEqual(len(store.pending()), 1)
+
+    def test_completing_keeps_pending_order_without_resorting(self):
+        store = self.todo.get_store()
+        for description, priority in [("b", 1), ("a", 0), ("c", 2), ("d", 0)]:
+            store.add(description, priority=priority)
+        self.assertEqual(store.pending_at(2)["description"], "d")
+        store.complete(store.pending_at(2)["id"])
+        with patch('builtins.sorted', side_effect=AssertionError("no se debe reordenar")):
+            self.assertEqual([task["description"] for task in store.pending()], ["a", "b", "c"])
+            self.assertEqual(store.pending_at(3)["description"], "c")
+            self.assertIsNone(store.pending_at(4))
+
+    def test_bad_legacy_records_are_skipped(self):
+        with open(self.todo.TASKS_FILE, 'w', encoding='utf-8') as f:
+            json.dump([{"description": "buena"}, {"completed": True}, "texto suelto", {"description": "otra", "completed": False}], f)
+        with self.assertLogs(level="WARNING") as logs:
+            store = self.todo.get_store()
+        self.assertEqual([task["description"] for task in store.pending()], ["buena", "otra"])
+        self.assertEqual(len(logs.records), 2)
+
+class TestLazyPlugins(unittest.TestCase):
+    PLUGINS = {
+        "pesado_plugin.py": '''"""Plugin con una importación cara."""
+import logging
+IMPORTS = IMPORTS + 1 if "IMPORTS" in globals() else 1
+TRIGGERS = ["enciende el horno"]
+
+def handle_command(text):
+    if "enciende el horno" in text:
+        return "Horno encendido"
+    return None
+''',
+        "eco_plugin.py": '''def handle_input(text):
+    return text.upper()
+''',
+        "regex_plugin.py": '''import re
+TRIGGERS = [re.compile(r"pon (\\d+) minutos")]
+
+def handle_command(text):
+    return False
+''',
+        "roto_plugin.py": '''TRIGGERS = ["rompe algo"]
+raise RuntimeError("fallo al importar")
+
+def handle_command(text):
+    return True
+''',
+    }
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        for filename, source in self.PLUGINS.items():
+            with open(os.path.join(self.tmpdir.name, filename), 'w', encoding='utf-8') as f:
+                f.write(source)
+        patcher = patch.dict('asistente_voz.CONFIG', {"PLUGINS_DIR": self.tmpdir.name, "PLUGINS_LAZY": True})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ("loaded_plugins", "plugin_load_stats"):
+            patcher = patch(f'asistente_voz.{name}', {})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self._forget_plugins)
+
+    def _forget_plugins(self):
+        for filename in self.PLUGINS:
+            sys.modules.pop(filename[:-3], None)
+        if self.tmpdir.name in sys.path:
+            sys.path.remove(self.tmpdir.name)
+
+    def _plugins_by_name(self, plugins):
+        return {plugin.__name__: plugin for plugin in plugins}
+
+    def test_manifest_is_read_without_importing(self):
+        manifest = read_plugin_manifest(os.path.join(self.tmpdir.name, "pesado_plugin.py"))
+        self.assertEqual(manifest["name"], "pesado_plugin")
+        self.assertEqual(manifest["triggers"], ["enciende el horno"])
+        self.assertEqual(manifest["hooks"], {"handle_command"})
+        self.assertEqual(manifest["description"], "Plugin con una importación cara.")
+        self.assertNotIn("pesado_plugin", sys.modules)
+        self.assertIsNone(read_plugin_manifest(os.path.join(self.tmpdir.name, "regex_plugin.py")))
+
+    @patch('asistente_voz.hablar')
+    def test_plugin_is_imported_on_first_dispatch(self, mock_hablar):
+        regular_plugins, command_plugins = load_plugins()
+        commands = self._plugins_by_name(command_plugins)
+        self.assertIsInstance(commands["pesado_plugin"], LazyPlugin)
+        self.assertIsInstance(self._plugins_by_name(regular_plugins)["eco_plugin"], LazyPlugin)
+        # regex_plugin no tiene manifiesto literal: se importa al arrancar
+        self.assertNotIsInstance(commands["regex_plugin"], LazyPlugin)
+        self.assertNotIn("pesado_plugin", sys.modules)
+
+        self.assertFalse(_handle_command_plugins("qué hora es", command_plugins))
+        self.assertFalse(commands["pesado_plugin"].loaded)
+
+        self.assertTrue(_handle_command_plugins("enciende el horno", command_plugins))
+        mock_hablar.assert_called_once_with("Horno encendido")
+        self.assertTrue(commands["pesado_plugin"].loaded)
+        _handle_command_plugins("enciende el horno", command_plugins)
+        self.assertEqual(sys.modules["pesado_plugin"].IMPORTS, 1)
+        self.assertEqual(_handle_regular_plugins_input("hola", regular_plugins), "HOLA")
+
+    @patch('asistente_voz.logging.error')
+    def test_failed_lazy_import_is_skipped(self, mock_error):
+        _, command_plugins = load_plugins()
+        self.assertFalse(_handle_command_plugins("rompe algo", command_plugins))
+        mock_error.assert_called_once_with("Error al cargar el plugin roto_plugin: fallo al importar")
+        self.assertFalse(_handle_command_plugins("rompe algo", command_plugins))
+        self.assertEqual(mock_error.call_count, 1)
+
+    @patch('asistente_voz.hablar')
+    def test_load_report_lists_import_time_and_memory(self, mock_hablar):
+        with patch.dict('asistente_voz.CONFIG', {"PLUGINS_PROFILE_MEMORY": True}):
+            _, command_plugins = load_plugins()
+            report = plugin_load_report()
+            self.assertIn("pesado_plugin: diferido", report)
+            self.assertTrue(any(re.match(r"regex_plugin: importado, [\d.]+ ms, \d+ KB \(con tracemalloc", line) for line in report))
+            _handle_command_plugins("enciende el horno", command_plugins)
+        self.assertTrue(any(re.match(r"pesado_plugin: importado, [\d.]+ ms", line) for line in plugin_load_report()))
+
+    def test_import_time_is_untraced_by_default(self):
+        with patch('asistente_voz.tracemalloc.start') as mock_start:
+            load_plugins()
+        mock_start.assert_not_called()
+        self.assertTrue(any(re.fullmatch(r"regex_plugin: importado, [\d.]+ ms", line) for line in plugin_load_report()))
+
+    def test_eager_loading_when_disabled(self):
+        with patch.dict('asistente_voz.CONFIG', {"PLUGINS_LAZY": False}):
+            regular_plugins, command_plugins = load_plugins()
+        self.assertFalse(any(isinstance(plugin, LazyPlugin) for plugin in list(regular_plugins) + list(command_plugins)))
+        self.assertIn("pesado_plugin", sys.modules)
+        self.assertNotIn("roto_plugin", self._plugins_by_name(command_plugins))
+
+class TestHotReload(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.plugins_dir = os.path.join(self.tmpdir.name, "plugins")
+        os.makedirs(self.plugins_dir)
+        self.commands_file = os.path.join(self.tmpdir.name, "custom_commands.json")
+        self._write_commands({"modo cine": {"action": "home_assistant_service", "domain": "scene", "service": "turn_on", "entity_id": "scene.cine"}})
+        self._write_plugin("saludo_plugin", 'TRIGGERS = ["saluda"]\n\ndef handle_command(text):\n    return "Hola"\n')
+        self._write_plugin("eco_plugin", 'def handle_input(text):\n    return text\n')
+        patcher = patch.dict('asistente_voz.CONFIG', {"PLUGINS_DIR": self.plugins_dir, "PLUGINS_LAZY": True, "CUSTOM_COMMANDS_FILE": self.commands_file})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for name in ("loaded_plugins", "plugin_load_stats"):
+            patcher = patch(f'asistente_voz.{name}', {})
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self._forget_plugins)
+        regular_plugins, command_plugins = load_plugins()
+        self.session = AssistantSession(regular_plugins, command_plugins, load_custom_commands(), gemini_backend=None)
+        self.reloader = HotReloader(self.session, self.commands_file, self.plugins_dir)
+
+    def _forget_plugins(self):
+        for name in ("saludo_plugin", "eco_plugin", "nuevo_plugin"):
+            sys.modules.pop(name, None)
+        if self.plugins_dir in sys.path:
+            sys.path.remove(self.plugins_dir)
+
+    def _write_commands(self, commands):
+        with open(self.commands_file, 'w', encoding='utf-8') as f:
+            json.dump(commands, f)
+
+    def _write_plugin(self, name, source):
+        path = os.path.join(self.plugins_dir, f"{name}.py")
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(source)
+        return path
+
+    @patch('asistente_voz.command_scheduler')
+    def test_custom_commands_are_swapped_and_scheduler_reloaded(self, mock_scheduler):
+        previous = self.session.custom_commands
+        self._write_commands({"modo cine": {"action": "home_assistant_service", "domain": "scene", "service": "turn_on", "entity_id": "scene.teatro"}})
+        self.reloader.handle_changes({self.commands_file})
+        commands = self.session.custom_commands
+        self.assertIsNot(commands, previous)
+        self.assertEqual(commands.router.match("modo cine")[1]["entity_id"], "scene.teatro")
+        self.assertEqual(previous.router.match("modo cine")[1]["entity_id"], "scene.cine")
+        mock_scheduler.reload.assert_called_once_with(commands)
+
+        self._write_commands({"pon {n} minutos": {"action": "user_data_lookup"}})
+        self.reloader.handle_changes({self.commands_file})
+        self.assertEqual(self.session.custom_commands.router.match("pon 5 minutos")[2], {"n": "5"})
+        self.assertIsNone(self.session.custom_commands.router.match("modo cine"))
+
+    def test_router_is_reused_when_only_details_change(self):
+        with open(self.commands_file, 'w', encoding='utf-8') as f:
+            json.dump({"pon {n} minutos": {"action": "a"}, "hola": {"action": "b"}}, f)
+        self.reloader.reload_custom_commands()
+        first = self.session.custom_commands
+        with open(self.commands_file, 'w', encoding='utf-8') as f:
+            json.dump({"pon {n} minutos": {"action": "c"}, "hola": {"action": "d"}}, f)
+        self.reloader.reload_custom_commands()
+        second = self.session.custom_commands
+        self.assertIs(second.router._combined, first.router._combined)
+        self.assertEqual(second.router.match("pon 3 minutos")[1], {"action": "c"})
+        self.assertEqual(second.router.match("hola")[1], {"action": "d"})
+
+    @patch('asistente_voz.command_scheduler')
+    def test_invalid_json_keeps_current_commands(self, mock_scheduler):
+        previous = self.session.custom_commands
+        with open(self.commands_file, 'w', encoding='utf-8') as f:
+            f.write('{"modo cine": ')
+        self.assertFalse(self.reloader.reload_custom_commands())
+        self.assertIs(self.session.custom_commands, previous)
+        mock_scheduler.reload.assert_not_called()
+
+    @patch('asistente_voz.hablar')
+    def test_only_changed_plugins_are_reloaded(self, mock_hablar):
+        eco = self.session.regular_plugins[0]
+        _handle_command_plugins("saluda", self.session.command_plugins)
+        mock_hablar.assert_called_with("Hola")
+
+        changed = self._write_plugin("saludo_plugin", 'TRIGGERS = ["saluda"]\n\ndef handle_command(text):\n    return "Buenos días"\n')
+        added = self._write_plugin("nuevo_plugin", 'TRIGGERS = ["despídete"]\n\ndef handle_command(text):\n    return "Adiós"\n')
+        old_command_plugins = self.session.command_plugins
+        self.reloader.handle_changes({changed, added})
+
+        self.assertIs(self.session.regular_plugins[0], eco)
+        self.assertEqual([plugin.__name__ for plugin in self.session.command_plugins], ["saludo_plugin", "nuevo_plugin"])
+        self.assertEqual(len(old_command_plugins), 1)
+        _handle_command_plugins("saluda", self.session.command_plugins)
+        mock_hablar.assert_called_with("Buenos días")
+        _handle_command_plugins("despídete", self.session.command_plugins)
+        mock_hablar.assert_called_with("Adiós")
+
+        os.remove(changed)
+        self.reloader.handle_changes({changed})
+        self.assertEqual([plugin.__name__ for plugin in self.session.command_plugins], ["nuevo_plugin"])
+        self.assertNotIn("saludo_plugin", sys.modules)
+
+    def test_file_watcher_reports_changes_by_polling(self):
+        changes = queue.Queue()
+        watcher = FileWatcher([self.commands_file, self.plugins_dir], changes.put, interval=0.02, debounce=0.02, use_inotify=False)
+        self.assertEqual(watcher.check(), set())
+        watcher.start()
+        self.addCleanup(watcher.stop)
+        added = self._write_plugin("nuevo_plugin", "X = 1\n")
+        self.assertEqual(changes.get(timeout=2), {added})
+        self._write_commands({})
+        self.assertEqual(changes.get(timeout=2), {self.commands_file})
+
+class TestStartup(unittest.TestCase):
+    def test_phases_run_in_parallel_with_timeline(self):
+        startup = StartupOrchestrator(max_workers=3)
+        self.addCleanup(startup.shutdown)
+        started = time.monotonic()
+        slow = [startup.submit(f"fase {i}", time.sleep, 0.2) for i in range(3)]
+        failing = startup.submit("rota", lambda: 1 / 0)
+        for future in slow:
+            future.result()
+        self.assertLess(time.monotonic() - started, 0.5)
+        with self.assertRaises(ZeroDivisionError):
+            failing.result()
+        startup.mark("escuchando")
+
+        timeline = {name: (start, end, status) for name, start, end, status in startup.timeline()}
+        self.assertEqual(timeline["fase 0"][2], "ok")
+        self.assertGreaterEqual(timeline["fase 0"][1] - timeline["fase 0"][0], 190)
+        self.assertEqual(timeline["rota"][2], "error")
+        self.assertEqual(timeline["escuchando"][2], "hito")
+        self.assertEqual(startup.timeline()[-1][0], "escuchando")
+        self.assertTrue(any(line.endswith("rota: 0 ms (error)") for line in startup.format_timeline()))
+
+    def test_deferred_import_loads_on_first_use(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, "modulo_diferido.py"), 'w', encoding='utf-8') as f:
+                f.write("def saluda(nombre):\n    return 'hola ' + nombre\n")
+            sys.path.insert(0, tmpdir)
+            try:
+                deferred = _DeferredImport("modulo_diferido")
+                function = _DeferredImport("modulo_diferido", "saluda")
+                self.assertNotIn("modulo_diferido", sys.modules)
+                self.assertEqual(function("Ana"), "hola Ana")
+                self.assertIn("modulo_diferido", sys.modules)
+                self.assertIs(deferred.saluda, sys.modules["modulo_diferido"].saluda)
+            finally:
+                sys.path.remove(tmpdir)
+                sys.modules.pop("modulo_diferido", None)
+
+    def test_heavy_audio_modules_are_not_imported_with_the_assistant(self):
+        repo_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        code = "import sys, asistente_voz; print(sorted(name for name in ('gtts', 'pydub', 'speech_recognition') if name in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", code], cwd=repo_dir, capture_output=True, text=True, timeout=60)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(result.stdout.strip(), "[]")
+
+    def test_http_warm_up_tolerates_unreachable_hosts(self):
+        client = HttpClient(timeout=(0.2, 0.2), retries=0)
+        self.addCleanup(client.close)
+        self.assertFalse(client.warm("http://127.0.0.1:9"))
+
+class TestWakeWord(unittest.TestCase):
+    RATE = 16000
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.now = 0.0
+        # Grabaciones de prueba: cada una con una duración distinta que identifica su contenido
+        self.transcripts = {}
+        self.fixtures = {}
+        for name, seconds, transcript in [
+            ("tele", 1.0, "[unk] [unk] [unk]"),
+            ("activacion", 0.6, "oye asistente"),
+            ("orden", 1.4, "[unk] [unk]"),
+            ("activacion_y_orden", 2.0, "oye asistente [unk] [unk]"),
+        ]:
+            path = os.path.join(self.tmpdir.name, f"{name}.wav")
+            samples = array.array("h", [int(3000 * math.sin(i / 5)) for i in range(int(self.RATE * seconds))])
+            with wave.open(path, "wb") as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(self.RATE)
+                wav.writeframes(samples.tobytes())
+            self.fixtures[name] = path
+            self.transcripts[int(self.RATE * seconds) * 2] = transcript
+        self.spotter = MagicMock()
+        self.spotter.transcribe.side_effect = lambda audio: self.transcripts[len(audio.frame_data)]
+        self.gate = WakeWordGate(self.spotter, ["Oye asistente"], window_seconds=8, clock=lambda: self.now)
+
+    def _audio(self, name):
+        return load_wav_audio(self.fixtures[name])
+
+    def test_only_addressed_speech_passes(self):
+        self.assertEqual(self._audio("tele").sample_rate, self.RATE)
+        self.assertEqual(self.gate.check(self._audio("tele")), WakeWordGate.REJECT)
+        self.assertEqual(self.gate.check(self._audio("orden")), WakeWordGate.REJECT)
+        self.assertEqual(self.gate.check(self._audio("activacion")), WakeWordGate.WAKE)
+        self.now = 5
+        self.assertEqual(self.gate.check(self._audio("orden")), WakeWordGate.PASS)
+        self.now = 20
+        self.assertEqual(self.gate.check(self._audio("orden")), WakeWordGate.REJECT)
+        self.assertEqual(self.gate.check(self._audio("activacion_y_orden")), WakeWordGate.PASS)
+        self.assertEqual(self.gate.stats, {"accepted": 2, "rejected": 3, "wakeups": 2})
+
+    def test_strip_wake_phrase(self):
+        self.assertEqual(self.gate.strip_wake_phrase("Oye asistente, enciende la luz"), "enciende la luz")
+        self.assertEqual(self.gate.strip_wake_phrase("enciende la luz"), "enciende la luz")
+
+    def test_handler_skips_recognition_for_unaddressed_speech(self):
+        handler = AudioInputHandler.__new__(AudioInputHandler)
+        handler.wake_gate = self.gate
+        handler.reconocer = MagicMock(return_value="oye asistente apaga la tele")
+        with patch('logging.info'):
+            self.assertEqual(handler._recognize_if_addressed(self._audio("tele")), "")
+            handler.reconocer.assert_not_called()
+            self.assertEqual(handler._recognize_if_addressed(self._audio("activacion_y_orden")), "apaga la tele")
+        handler.reconocer.assert_called_once()
+
+    def test_vosk_spotter_uses_grammar_and_shares_model(self):
+        fake_vosk = types.ModuleType("vosk")
+        fake_vosk.Model = MagicMock()
+        fake_vosk.SetLogLevel = MagicMock()
+        kaldi = MagicMock()
+        kaldi.FinalResult.return_value = json.dumps({"text": "oye asistente"})
+        fake_vosk.KaldiRecognizer = MagicMock(return_value=kaldi)
+        shared_model = object()
+        with patch.dict(sys.modules, {"vosk": fake_vosk}):
+            spotter = VoskKeywordSpotter("/no/existe", ["Oye asistente", "hola casa"], model=shared_model)
+            self.assertEqual(spotter.transcribe(self._audio("activacion")), "oye asistente")
+        fake_vosk.Model.assert_not_called()
+        fake_vosk.KaldiRecognizer.assert_called_once_with(shared_model, 16000, '["oye asistente", "hola casa", "[unk]"]')
+
+    def test_gate_disabled_without_vosk(self):
+        self.assertIsNone(create_wake_word_gate({"WAKE_WORD_ENABLED": False}))
+        config = {"WAKE_WORD_ENABLED": True, "VOSK_MODEL_PATH": "/no/existe", "WAKE_WORD_PHRASES": ["oye asistente"], "WAKE_WORD_WINDOW_SECONDS": 8}
+        with patch.dict(sys.modules, {"vosk": None}), patch('logging.error') as mock_error:
+            self.assertIsNone(create_wake_word_gate(config))
+        mock_error.assert_called_once()
+
+class TestConversationHistory(unittest.TestCase):
+    def _turn(self, history, question, answer):
+        history.append({"role": "user", "parts": [{"text": question}]})
+        history.append({"role": "model", "parts": [{"text": answer}]})
+        return history.trim()
+
+    def test_trims_whole_turns_by_token_budget(self):
+        history = ConversationHistory(max_tokens=60)
+        with patch('logging.info'):
+            self.assertEqual(self._turn(history, "hola", "buenas"), 0)
+            self._turn(history, "¿qué es un agujero negro?", "Una región del espacio " * 8)
+            self._turn(history, "gracias", "de nada")
+        roles = [message["role"] for message in history]
+        self.assertEqual(roles[0], "user")
+        self.assertEqual(roles, ["user", "model"] * (len(roles) // 2))
+        self.assertLessEqual(history.tokens(), 60)
+        self.assertEqual(history[-1]["parts"][0]["text"], "de nada")
+
+    def test_last_turn_is_kept_even_over_budget(self):
+        history = ConversationHistory(max_tokens=10)
+        self._turn(history, "cuéntame una historia", "Había una vez " * 50)
+        self.assertEqual(len(history), 2)
+
+    def test_folded_turns_become_a_summary(self):
+        calls = []
+
+        def summarize(previous, messages):
+            calls.append((previous, [message["parts"][0]["text"] for message in messages]))
+            return f"{previous} resumen{len(calls)}".strip()
+
+        history = ConversationHistory(max_tokens=30, summarize=summarize, background=False)
+        with patch('logging.info'):
+            self._turn(history, "me llamo Ana", "Encantado, Ana")
+            self._turn(history, "vivo en Sevilla y me gusta el flamenco", "Qué bien")
+            self._turn(history, "¿cómo me llamo?", "Te llamas Ana")
+        self.assertEqual(calls[0], ("", ["me llamo Ana", "Encantado, Ana"]))
+        self.assertTrue(history.summary.endswith(f"resumen{len(calls)}"))
+        contents = history.contents()
+        self.assertEqual(contents[0]["role"], "user")
+        self.assertTrue(contents[0]["parts"][0]["text"].startswith("Resumen de la conversación anterior: "))
+        self.assertEqual(contents[1]["role"], "model")
+        self.assertEqual(contents[2:], list(history))
+
+    def test_summary_runs_in_background(self):
+        release = threading.Event()
+
+        def summarize(previous, messages):
+            release.wait(2)
+            return "resumen"
+
+        history = ConversationHistory(max_tokens=20, summarize=summarize)
+        with patch('logging.info'):
+            self._turn(history, "primera pregunta bastante larga", "primera respuesta bastante larga")
+            self._turn(history, "segunda", "respuesta")
+        self.assertEqual(history.summary, "")
+        release.set()
+        history.wait_for_summary(2)
+        self.assertEqual(history.summary, "resumen")
+
+    def test_gemini_summarizer_prompt(self):
+        backend = MagicMock()
+        backend.generate.return_value = "Ana vive en Sevilla."
+        summarize = gemini_history_summarizer(backend, 100)
+        messages = [{"role": "user", "parts": [{"text": "vivo en Sevilla"}]}, {"role": "model", "parts": [{"text": "Bonita ciudad"}]}]
+        self.assertEqual(summarize("Se llama Ana.", messages), "Ana vive en Sevilla.")
+        prompt = backend.generate.call_args[0][0][0]["parts"][0]["text"]
+        self.assertIn("60 palabras", prompt)
+        self.assertIn("Resumen anterior: Se llama Ana.\nUsuario: vivo en Sevilla\nAsistente: Bonita ciudad", prompt)
+        self.assertEqual(estimate_tokens("a" * 40), 14)
+
+    def test_summaries_do_not_share_the_worker(self):
+        backend = SubprocessGeminiBackend(["gemini-worker"], timeout=5)
+        with patch.dict('asistente_voz.CONFIG', {"HISTORY_SUMMARIZE": True}):
+            session = AssistantSession([], CommandPlugins([]), CustomCommands({}), backend)
+        self.assertIsInstance(session.summary_backend, SubprocessGeminiBackend)
+        self.assertIsNot(session.summary_backend, backend)
+        self.assertIsNot(session.summary_backend._lock, backend._lock)
+        stub = StubGeminiBackend()
+        with patch.dict('asistente_voz.CONFIG', {"HISTORY_SUMMARIZE": True}):
+            self.assertIs(AssistantSession([], CommandPlugins([]), CustomCommands({}), stub).summary_backend, stub)
+
+class TestGeminiAnswerCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        self.cache = GeminiAnswerCache(ttl=3600, threshold=0.85, clock=lambda: self.now)
+        self.cache.store("¿Quién escribió el Quijote?", "Miguel de Cervantes.")
+        self.cache.store("¿Cuál es la capital de Francia?", "París.")
+
+    def test_exact_and_similar_questions_hit(self):
+        self.assertEqual(self.cache.lookup("dime la capital de francia"), "París.")
+        self.assertEqual(self.cache.lookup("quien escribio don quijote"), "Miguel de Cervantes.")
+        self.assertIsNone(self.cache.lookup("quién escribió Hamlet"))
+        self.assertIsNone(self.cache.lookup("cuál es la capital de Italia"))
+        self.assertEqual(self.cache.stats, {"exact_hits": 1, "similar_hits": 1, "misses": 2})
+
+    def test_time_sensitive_and_personal_questions_are_not_cached(self):
+        self.assertFalse(self.cache.store("¿qué hora es ahora?", "Las cinco."))
+        self.assertFalse(self.cache.store("¿cómo me llamo yo?", "Ana."))
+        self.assertFalse(self.cache.store("sí, claro", "Perfecto."))
+        self.assertIsNone(self.cache.lookup("qué hora es ahora"))
+        custom = GeminiAnswerCache(exclude=["francia"])
+        self.assertFalse(custom.cacheable("capital de Francia"))
+
+    def test_entries_expire(self):
+        self.now += 3601
+        self.assertIsNone(self.cache.lookup("capital de francia"))
+        self.assertEqual(len(self.cache._entries), 0)
+
+    def test_persists_and_evicts(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db_path = os.path.join(tmpdir, "respuestas.db")
+            cache = GeminiAnswerCache(db_path, max_entries=2, clock=lambda: self.now)
+            cache.store("¿Quién escribió el Quijote?", "Cervantes.")
+            cache.store("¿Cuál es la capital de Francia?", "París.")
+            cache.store("¿Cuántos planetas hay en el sistema solar?", "Ocho.")
+            cache.close()
+            reopened = GeminiAnswerCache(db_path, clock=lambda: self.now)
+            self.assertIsNone(reopened.lookup("quién escribió el quijote"))
+            self.assertEqual(reopened.lookup("cuántos planetas tiene el sistema solar"), "Ocho.")
+            reopened.close()
+
+    @patch('asistente_voz.hablar')
+    def test_repeated_question_skips_gemini(self, mock_hablar):
+        backend = MagicMock()
+        backend.generate.return_value = "Unos 384.400 km."
+        session = AssistantSession([], CommandPlugins([]), CustomCommands({}), backend, GeminiAnswerCache())
+        with patch.dict('asistente_voz.CONFIG', {"GEMINI_STREAMING": False}), patch('logging.info'):
+            _process_utterance(session, "¿A qué distancia está la Luna?")
+            _process_utterance(session, "a que distancia esta la luna")
+        backend.generate.assert_called_once()
+        self.assertEqual(mock_hablar.call_args_list, [call("Unos 384.400 km."), call("Unos 384.400 km.")])
+        self.assertEqual([m["role"] for m in session.conversation_history], ["user", "model", "user", "model"])
+
+    def test_interrupted_answer_is_not_cached(self):
+        output = MagicMock()
+        output.epoch = 0
+
+        def say_chunk(chunk, epoch):
+            output.epoch = 1
+
+        output.say_chunk.side_effect = say_chunk
+        backend = StubGeminiBackend(["La Luna está a unos 384.400 km. Esa distancia varía a lo largo de su órbita."])
+        cache = GeminiAnswerCache()
+        session = AssistantSession([], CommandPlugins([]), CustomCommands({}), backend, cache)
+        with patch.dict('asistente_voz.CONFIG', {"GEMINI_STREAMING": True}), \
+                patch('asistente_voz.speech_output', output), patch('logging.info'):
+            _process_utterance(session, "¿A qué distancia está la Luna?")
+        self.assertIsNone(cache.lookup("a que distancia esta la luna"))
+        self.assertEqual(list(session.conversation_history), [])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file